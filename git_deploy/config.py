@@ -10,9 +10,9 @@ __authors__ = {
 __date__ = '2013-09-08'
 __license__ = 'GPL v2.0 (or later)'
 
-from dulwich.repo import Repo
-import subprocess
-from deploylog.deploylog import DeployLogDefault
+import os
+import re
+import json
 import logging
 
 # Native git call
@@ -70,6 +70,16 @@ exit_codes = {
     39: 'Call to SSH failed. Exiting.',
     40: 'Failed to run sync script. Exiting.',
     41: 'Missing system configuration item "remote-url". Exiting.',
+    42: 'Unknown target group, see "git config deploy.group.<name>". '
+        'Exiting.',
+    43: 'Unknown lock backend, see "git config deploy.lock-backend". '
+        'Exiting.',
+    44: 'Invalid hook manifest or hook dependency cycle. Exiting.',
+    45: 'No traced runs, enable tracing with '
+        '"git config deploy.trace true". Exiting.',
+    46: 'Push to the remote failed. Exiting.',
+    47: 'Invalid date, use YYYY-MM-DD[THH:MM:SS] or seconds since the '
+        'epoch. Exiting.',
     50: 'Failed to read the .deploy file. Exiting.',
     60: 'Invalid git deploy action. Exiting.',
 }
@@ -126,58 +136,254 @@ def set_log(args, out, err):
     log.setLevel(level)
 
 
-def set_deploy_log(target, path, user, key_path):
-    """ Sets the deploy logger to the target """
+def set_deploy_log(target, path, user, key_path, buffered=False,
+                   spool_dir=None):
+    """ Sets the deploy logger to the target, returns the logger """
+    # Imported here, deploylog itself imports this module
+    from deploylog.deploylog import DeployLogDefault
+
     global deploy_log
     if not deploy_log:
-        deploy_log = DeployLogDefault(target, path, user, key_path)
-    else:
-        return deploy_log
+        deploy_log = DeployLogDefault(target, path, user, key_path,
+                                      buffered=buffered, spool_dir=spool_dir)
+    return deploy_log
+
+
+def config_bool(value):
+    """ Interpret a git config string as a boolean """
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def split_targets(value):
+    """ Split a comma and/or whitespace separated list of targets """
+    return [target for target in re.split(r'[\s,]+', value or '') if target]
+
+
+# Snapshot of the git config items, in .git/deploy
+CONFIG_CACHE_FILE = 'config-cache'
+CONFIG_CACHE_VERSION = 1
+
+# Required elements - key names, git config names, and error codes
+CONFIG_ELEMENTS = {
+    'hook_dir': ('deploy', 'hook-dir', 21),
+    'path': ('deploy', 'path', 23),
+    'user': ('deploy', 'user', 24),
+    'target': ('deploy', 'target', 25),
+    'repo_name': ('deploy', 'tag-prefix', 22),
+    'client_path': ('deploy', 'client-path', 19),
+    'user.name': ('user', 'name', 28),
+    'user.email': ('user', 'email', 29),
+    'deploy.key_path': ('deploy', 'key-path', 37),
+    'deploy.test_repo': ('deploy', 'test-repo-path', 38),
+    'deploy.remote_url': ('deploy', 'remote-url', 41),
+}
+
+# Optional elements - key names, git config names, and default values
+CONFIG_OPTIONAL = {
+    'deploy.log_buffered': ('deploy', 'log-buffered', 'false'),
+    'deploy.stage_workers': ('deploy', 'stage-workers', '1'),
+    'deploy.sync_workers': ('deploy', 'sync-workers', '10'),
+    'deploy.sync_batches': ('deploy', 'sync-batches', '100%'),
+    'deploy.sync_timeout': ('deploy', 'sync-timeout', '0'),
+    'deploy.lock_lease': ('deploy', 'lock-lease', '0'),
+    'deploy.lock_heartbeat': ('deploy', 'lock-heartbeat', 'true'),
+    'deploy.lock_backend': ('deploy', 'lock-backend', 'ssh'),
+    'deploy.hook_workers': ('deploy', 'hook-workers', '4'),
+    'deploy.hook_log_remote': ('deploy', 'hook-log-remote', 'false'),
+    'deploy.hook_timeout': ('deploy', 'hook-timeout', '0'),
+    'deploy.hook_cpu': ('deploy', 'hook-cpu', '0'),
+    'deploy.hook_memory': ('deploy', 'hook-memory', '0'),
+    'deploy.trace': ('deploy', 'trace', 'false'),
+    'deploy.ssh_port': ('deploy', 'ssh-port', '22'),
+    'deploy.remote_workers': ('deploy', 'remote-workers', '16'),
+    'deploy.daemon': ('deploy', 'daemon', 'false'),
+    'deploy.daemon_idle': ('deploy', 'daemon-idle', '600'),
+    'deploy.object_cache_mb': ('deploy', 'object-cache-mb', '64'),
+}
+
+# top_dir -> (signature, git config items)
+_config_snapshots = {}
+
+
+def find_top_dir(path=None):
+    """
+    Returns the top level directory of the work tree containing `path`, the
+    current directory by default - the nearest directory holding .git, or
+    $GIT_WORK_TREE if set.  Like git rev-parse --show-toplevel, without
+    running git.
+    """
+    if os.environ.get('GIT_WORK_TREE'):
+        return os.path.abspath(os.environ['GIT_WORK_TREE'])
+
+    path = os.path.abspath(path or os.getcwd())
+    while True:
+        if os.path.exists(os.path.join(path, '.git')):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            raise GitDeployConfigError(message=exit_codes[20], exit_code=20)
+        path = parent
+
+
+def _config_paths(top_dir):
+    """ The git config files read by _config_stack, repository first """
+    xdg_config_home = os.environ.get('XDG_CONFIG_HOME',
+                                     os.path.expanduser('~/.config/'))
+    paths = [os.path.join(top_dir, '.git', 'config'),
+             os.path.expanduser('~/.gitconfig'),
+             os.path.join(xdg_config_home, 'git', 'config')]
+    if 'GIT_CONFIG_NOSYSTEM' not in os.environ:
+        paths.append('/etc/gitconfig')
+    return paths
+
+
+def _config_signature(top_dir):
+    """ The stat data of the git config files, changes on every edit """
+    signature = []
+    for path in _config_paths(top_dir):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        signature.append([path, st.st_mtime, st.st_size])
+    return signature
+
+
+def _config_stack(top_dir):
+    """
+    The repository, global and system git config, as returned by
+    Repo.get_config_stack, without loading the rest of dulwich
+    """
+    from dulwich.config import ConfigFile, StackedConfig
+
+    try:
+        repo_config = ConfigFile.from_path(os.path.join(top_dir, '.git',
+                                                        'config'))
+    except (IOError, OSError):
+        repo_config = ConfigFile()
+
+    backends = [repo_config] + StackedConfig.default_backends()
+    return StackedConfig(backends, writable=repo_config)
+
+
+def _read_config_items(top_dir):
+    """
+    Reads the config elements from git config, returns a dict of key name
+    -> value, None where unset, and 'target_groups'
+    """
+    sc = _config_stack(top_dir)
+
+    items = {}
+    for key, value in CONFIG_ELEMENTS.items() + CONFIG_OPTIONAL.items():
+        try:
+            items[key] = sc.get(value[0], value[1])
+        except KeyError:
+            items[key] = None
+
+    # Named target groups - git config deploy.group.<name> "host1 host2"
+    items['target_groups'] = {}
+    for backend in reversed(sc.backends):
+        if backend.has_section(('deploy', 'group')):
+            for name, value in backend.iteritems(('deploy', 'group')):
+                items['target_groups'][name] = split_targets(value)
+    return items
+
+
+def _encode(value):
+    """ Strings read back from JSON as str, like those from git config """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_encode(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_encode(k), _encode(v)) for k, v in value.iteritems())
+    return value
+
+
+def _config_items(top_dir):
+    """
+    Returns the config items of _read_config_items for `top_dir`.  They are
+    kept in memory and in .git/deploy/config-cache along with the stat data
+    of the git config files, and only read again once one of those changed.
+    """
+    signature = _config_signature(top_dir)
+    snapshot = _config_snapshots.get(top_dir)
+    if snapshot and snapshot[0] == signature:
+        return snapshot[1]
+
+    cache_path = os.path.join(top_dir, '.git', 'deploy', CONFIG_CACHE_FILE)
+    items = None
+    try:
+        with open(cache_path) as f:
+            data = json.load(f)
+        # A cache written before a config element was added is stale too
+        if data.get('version') == CONFIG_CACHE_VERSION and \
+                data.get('signature') == signature and \
+                set(CONFIG_ELEMENTS).union(CONFIG_OPTIONAL).issubset(
+                    data['items']):
+            items = _encode(data['items'])
+    except (IOError, OSError, ValueError, AttributeError, KeyError,
+            TypeError):
+        pass
+
+    if items is None:
+        items = _read_config_items(top_dir)
+        if os.path.isdir(os.path.dirname(cache_path)):
+            try:
+                tmp_path = '{0}.{1}'.format(cache_path, os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump({'version': CONFIG_CACHE_VERSION,
+                               'signature': signature,
+                               'items': items}, f)
+                os.rename(tmp_path, cache_path)
+            except (IOError, OSError) as e:
+                log.info('{0} :: Could not write config cache -> {1}'.format(
+                    __name__, e))
+
+    _config_snapshots[top_dir] = (signature, items)
+    return items
 
 
 def configure(**kwargs):
-    """ Parse configuration from git config """
+    """
+    Parse configuration from git config
+
+    The git config items are read once per change of the git config files,
+    see _config_items, kwargs override them.
+    """
     config = {}
 
     # Get top level directory of project
-    proc = subprocess.Popen(['git', 'rev-parse', '--show-toplevel'],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    config['top_dir'] = proc.communicate()[0].strip()
-    _repo = Repo(config['top_dir'])
-    sc = _repo.get_config_stack()
-
-    if proc.returncode != 0:
-        # log.error("{0} :: {1}".format(__name__, exit_codes[exit_code]))
-        raise GitDeployConfigError(message=exit_codes[20], exit_code=20)
-
-    # Define the key names, git config names, and error codes
-    config_elements = {
-        'hook_dir': ('deploy', 'hook-dir', 21),
-        'path': ('deploy', 'path', 23),
-        'user': ('deploy', 'user', 24),
-        'target': ('deploy', 'target', 25),
-        'repo_name': ('deploy', 'tag-prefix', 22),
-        'client_path': ('deploy', 'client-path', 19),
-        'user.name': ('user', 'name', 28),
-        'user.email': ('user', 'email', 29),
-        'deploy.key_path': ('deploy', 'key-path', 37),
-        'deploy.test_repo': ('deploy', 'test-repo-path', 38),
-        'deploy.remote_url': ('deploy', 'remote-url', 41),
-    }
+    config['top_dir'] = find_top_dir()
+    items = _config_items(config['top_dir'])
 
     # Assign the values of each git config element
-    for key, value in config_elements.iteritems():
-        try:
-            # Override with kwargs if the attribute exists
-            if key in kwargs:
-                config[key] = kwargs[key]
-            else:
-                config[key] = sc.get(value[0], value[1])
-        except KeyError as e:
-            log.error("{0} :: {1}".format(__name__, e.message))
+    for key, value in CONFIG_ELEMENTS.iteritems():
+        # Override with kwargs if the attribute exists
+        if key in kwargs:
+            config[key] = kwargs[key]
+        elif items.get(key) is not None:
+            config[key] = items[key]
+        else:
+            log.error("{0} :: Missing git config {1}.{2}".format(
+                __name__, value[0], value[1]))
             raise GitDeployConfigError(message=exit_codes[15], exit_code=15)
 
+    for key, value in CONFIG_OPTIONAL.iteritems():
+        if key in kwargs:
+            config[key] = kwargs[key]
+        elif items.get(key) is not None:
+            config[key] = items[key]
+        else:
+            config[key] = value[2]
+
+    # "target" may list several hosts, the first one holds the lock & log
+    config['targets'] = split_targets(config['target'])
+    if config['targets']:
+        config['target'] = config['targets'][0]
+
+    config['target_groups'] = dict(items['target_groups'])
+
     config['sync_dir'] = '{0}/sync'.format(config['hook_dir'])
 
     config['deploy_root'] = config['client_path'] + '/.git/deploy'
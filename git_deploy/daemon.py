@@ -0,0 +1,373 @@
+"""
+Long-running git-deploy process serving commands over a Unix socket
+
+The daemon keeps the config, the GitDeploy and GitMethods singletons, the
+tag index and the pooled SSH connections of one repository between
+commands.  `call` hands a command line to the daemon of the current
+repository, spawning it if needed, and relays its output.  The daemon
+runs one command at a time and exits once idle for deploy.daemon-idle
+seconds, or when the git config changed.
+
+A client waits DAEMON_BUSY_TIMEOUT seconds for the daemon to take its
+command - while a long sync runs it does not - and otherwise runs the
+command in its own process.  Once the command was sent it is never run
+again, if the daemon exits during the command the client fails.
+"""
+
+__date__ = '2026-10-18'
+__license__ = 'GPL v2.0 (or later)'
+
+import os
+import sys
+import json
+import time
+import errno
+import fcntl
+import socket
+import traceback
+import subprocess
+
+from config import log, configure, find_top_dir, GitDeployConfigError, \
+    _encode
+
+
+# Files of the daemon, in .git/deploy
+DAEMON_SOCKET = 'daemon.sock'
+DAEMON_LOCK = 'daemon.lock'
+DAEMON_LOG = 'daemon.log'
+
+# Seconds a client waits for a spawned daemon to listen
+DAEMON_START_TIMEOUT = 10
+
+# Seconds a client waits for a busy daemon to take its command
+DAEMON_BUSY_TIMEOUT = 1
+
+# Reply of _request when the daemon is replaced after a config change
+RESTART = 'restart'
+
+# Set to run commands in-process, the daemon's own hooks see it too
+NO_DAEMON_ENV = 'GIT_DEPLOY_NO_DAEMON'
+
+# Longest path of a Unix socket
+SOCKET_PATH_MAX = 100
+
+
+def _deploy_path(top_dir, name):
+    return os.path.join(top_dir, '.git', 'deploy', name)
+
+
+def _send(conn, **message):
+    """ Write one JSON message line, the client may have gone away """
+    try:
+        conn.sendall(json.dumps(message) + '\n')
+    except socket.error:
+        pass
+
+
+class _Stream(object):
+    """ File-like object relaying writes to the client as messages """
+
+    def __init__(self, conn, name):
+        self.conn = conn
+        self.name = name
+
+    def write(self, data):
+        if data:
+            _send(self.conn, **{self.name: data})
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class DeployDaemon(object):
+    """ Serves git-deploy commands for the repository in `top_dir` """
+
+    def __init__(self, top_dir, idle_timeout=600):
+        self.top_dir = top_dir
+        self.idle_timeout = idle_timeout
+        self.socket_path = _deploy_path(top_dir, DAEMON_SOCKET)
+        self._config = None
+        self._running = False
+
+    def serve(self):
+        """
+        Listen on the socket and run commands until idle.  Returns at once
+        if another daemon serves the repository.
+        """
+        lock_file = open(_deploy_path(self.top_dir, DAEMON_LOCK), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return
+
+        os.chdir(self.top_dir)
+        self._config = configure()
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        # Only the owner may connect, from the moment the socket exists
+        umask = os.umask(0o077)
+        try:
+            server.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        server.listen(16)
+        server.settimeout(self.idle_timeout)
+        log.info('{0} :: Serving {1}.'.format(__name__, self.top_dir))
+
+        self._running = True
+        try:
+            while self._running:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    log.info('{0} :: Idle, exiting.'.format(__name__))
+                    break
+                conn.settimeout(None)
+                try:
+                    self._handle(conn)
+                except Exception:
+                    # The client reports the command as failed
+                    traceback.print_exc()
+                finally:
+                    conn.close()
+        finally:
+            server.close()
+            os.remove(self.socket_path)
+            lock_file.close()
+
+    def _handle(self, conn):
+        """
+        Greet the client, then run the command of its request.  A client
+        that gave up waiting has closed the connection.
+        """
+        _send(conn, ready=True)
+        line = conn.makefile('r').readline()
+        try:
+            request = _encode(json.loads(line))
+        except ValueError:
+            return
+
+        if request.get('stop'):
+            self._running = False
+            _send(conn, exit=0)
+            return
+
+        # Singletons hold the config they were created with
+        try:
+            config = configure()
+        except GitDeployConfigError as e:
+            _send(conn, err=e.message + '\n', exit=e.exit_code)
+            self._running = False
+            return
+        if config != self._config:
+            log.info('{0} :: Git config changed, exiting.'.format(__name__))
+            self._running = False
+            _send(conn, restart=True)
+            return
+
+        _send(conn, exit=self._run(conn, request))
+
+    def _run(self, conn, request):
+        """
+        Run git-deploy main with the client's arguments, environment and
+        working directory, output goes to the client.  Returns the exit
+        code.
+        """
+        from git_deploy_console import main
+        from tracing import get_tracer, RUN_ID_ENV
+        import config
+
+        out, err = _Stream(conn, 'out'), _Stream(conn, 'err')
+        saved = (sys.stdout, sys.stderr, dict(os.environ), os.getcwd(),
+                 list(log.handlers), log.level)
+        try:
+            os.environ.clear()
+            os.environ.update(request['env'])
+            os.environ[NO_DAEMON_ENV] = '1'
+            os.chdir(request['cwd'])
+            sys.stdout, sys.stderr = out, err
+            get_tracer().run_id = os.environ.get(RUN_ID_ENV) or \
+                os.urandom(6).encode('hex')
+
+            try:
+                exit_code = main(out, err, argv=request['argv'])
+            except SystemExit as e:
+                exit_code = e.code
+            except Exception:
+                traceback.print_exc(file=err)
+                exit_code = 1
+            finally:
+                # Work left for process exit otherwise
+                if config.deploy_log:
+                    config.deploy_log.flush()
+                get_tracer().flush()
+        finally:
+            sys.stdout, sys.stderr = saved[0], saved[1]
+            os.environ.clear()
+            os.environ.update(saved[2])
+            os.chdir(saved[3])
+            log.handlers[:] = saved[4]
+            log.setLevel(saved[5])
+
+        if exit_code is None:
+            return 0
+        if not isinstance(exit_code, int):
+            err.write('{0}\n'.format(exit_code))
+            return 1
+        return exit_code
+
+
+def _connect(socket_path):
+    """ A connection to the daemon at socket_path, or None """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+    except socket.error as e:
+        conn.close()
+        if e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+            log.info('{0} :: {1}'.format(__name__, e))
+        return None
+    return conn
+
+
+def _spawn(top_dir, socket_path):
+    """ Start a daemon for top_dir, returns a connection once it listens """
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [package_dir] + filter(None, [env.get('PYTHONPATH')]))
+
+    with open(os.devnull) as devnull, \
+            open(_deploy_path(top_dir, DAEMON_LOG), 'a') as daemon_log:
+        subprocess.Popen([sys.executable, '-c',
+                          'from git_deploy.daemon import main; main()',
+                          top_dir],
+                         cwd=top_dir, env=env, stdin=devnull,
+                         stdout=daemon_log, stderr=subprocess.STDOUT,
+                         close_fds=True, preexec_fn=os.setsid)
+
+    deadline = time.time() + DAEMON_START_TIMEOUT
+    while time.time() < deadline:
+        conn = _connect(socket_path)
+        if conn is not None:
+            return conn
+        time.sleep(0.02)
+    return None
+
+
+def _request(conn, message, out, err, timeout=None):
+    """
+    Send a request once the daemon greets the connection and relay the
+    replies.  Returns the exit code, RESTART if the daemon asked for a
+    restart, or None if it was busy for `timeout` seconds or went away
+    before taking the request.  A daemon exiting after it took the
+    request may have run part of the command, that fails with exit code
+    1.
+    """
+    replies = conn.makefile('r')
+    conn.settimeout(timeout)
+    try:
+        greeting = replies.readline()
+    except socket.timeout:
+        log.info('{0} :: Daemon busy.'.format(__name__))
+        return None
+    conn.settimeout(None)
+    if not greeting:
+        return None
+
+    try:
+        conn.sendall(json.dumps(message) + '\n')
+    except socket.error:
+        return None
+
+    try:
+        for line in replies:
+            reply = _encode(json.loads(line))
+            if 'out' in reply:
+                out.write(reply['out'])
+            if 'err' in reply:
+                err.write(reply['err'])
+            if 'restart' in reply:
+                return RESTART
+            if 'exit' in reply:
+                out.flush()
+                return reply['exit']
+    except (socket.error, ValueError):
+        pass
+
+    err.write('git-deploy daemon exited during the command, see '
+              '.git/deploy/{0}\n'.format(DAEMON_LOG))
+    return 1
+
+
+def call(argv, out=None, err=None):
+    """
+    Run the command line `argv` on the daemon of the current repository,
+    spawning it if needed.  Returns the exit code, or None if no daemon
+    took the command and it should run in this process.
+    """
+    out = out or sys.stdout
+    err = err or sys.stderr
+
+    try:
+        top_dir = find_top_dir()
+    except GitDeployConfigError:
+        return None
+    socket_path = _deploy_path(top_dir, DAEMON_SOCKET)
+    if len(socket_path) > SOCKET_PATH_MAX or \
+            not os.path.isdir(os.path.dirname(socket_path)):
+        return None
+
+    message = {'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}
+
+    # A daemon restarting for a config change is replaced once
+    for _ in range(2):
+        conn = _connect(socket_path) or _spawn(top_dir, socket_path)
+        if conn is None:
+            return None
+        try:
+            exit_code = _request(conn, message, out, err,
+                                 timeout=DAEMON_BUSY_TIMEOUT)
+        finally:
+            conn.close()
+        if exit_code is not RESTART:
+            return exit_code
+        # Let the old daemon release its socket
+        time.sleep(0.05)
+    return None
+
+
+def stop(top_dir):
+    """ Stop the daemon of top_dir, returns True if one was running """
+    conn = _connect(_deploy_path(top_dir, DAEMON_SOCKET))
+    if conn is None:
+        return False
+    try:
+        _request(conn, {'stop': True}, sys.stdout, sys.stderr)
+    finally:
+        conn.close()
+    return True
+
+
+def main():
+    """ Run the daemon for the repository given on the command line """
+    top_dir = os.path.abspath(sys.argv[1])
+    sys.argv = ['git-deploy']
+    os.chdir(top_dir)
+    os.environ[NO_DAEMON_ENV] = '1'
+    try:
+        idle_timeout = float(configure()['deploy.daemon_idle'])
+    except (GitDeployConfigError, ValueError):
+        idle_timeout = 600
+    DeployDaemon(top_dir, idle_timeout).serve()
@@ -0,0 +1,245 @@
+"""
+Streaming diff of two trees, for git deploy diff
+
+Changes are generated one at a time while the trees are walked, and each
+format yields its output file by file, so memory use is bounded by the
+largest changed file rather than by the size of the diff.  Rename
+detection is the exception, it pairs the added and removed files of the
+whole diff, or of each path the diff is limited to, before yielding.
+
+Imported on first use by git_methods, it loads dulwich.
+"""
+
+__date__ = '2026-10-18'
+__license__ = 'GPL v2.0 (or later)'
+
+import stat
+import posixpath
+
+from collections import Counter
+from difflib import SequenceMatcher
+
+from dulwich.diff_tree import tree_changes, RenameDetector, TreeChange, \
+    CHANGE_MODIFY, CHANGE_RENAME
+from dulwich.objects import Blob, TreeEntry, S_ISGITLINK
+from dulwich.object_store import tree_lookup_path
+from dulwich.errors import NotTreeError
+from dulwich.patch import gen_diff_header, unified_diff, is_binary, \
+    patch_filename
+
+
+# Output formats of format_changes
+DIFF_FORMATS = ('patch', 'stat', 'name-only')
+
+# Widest +/- bar of a --stat line
+STAT_BAR_WIDTH = 40
+
+# Lines left after the common head and tail above which --stat counts a
+# file's changes without a line diff, which is superlinear
+STAT_DIFF_MAX_LINES = 5000
+
+_NO_ENTRY = TreeEntry(None, None, None)
+
+
+def _lookup(store, tree, path):
+    """ The (mode, sha) of path in tree, (None, None) if there is none """
+    if tree is None:
+        return None, None
+    try:
+        return tree_lookup_path(store.__getitem__, tree, path)
+    except (KeyError, NotTreeError):
+        return None, None
+
+
+def _prefixed(change, path):
+    """ A change of a subtree with the paths of its entries below path """
+    old, new = change.old, change.new
+    if old.path is not None:
+        old = TreeEntry(posixpath.join(path, old.path), old.mode, old.sha)
+    if new.path is not None:
+        new = TreeEntry(posixpath.join(path, new.path), new.mode, new.sha)
+    return TreeChange(change.type, old, new)
+
+
+def _path_changes(store, old_tree, new_tree, path, detector):
+    """
+    Yields the changes at or below `path`, only the subtrees at `path` are
+    walked
+    """
+    old_mode, old_sha = _lookup(store, old_tree, path)
+    new_mode, new_sha = _lookup(store, new_tree, path)
+    old_dir = old_mode is not None and stat.S_ISDIR(old_mode)
+    new_dir = new_mode is not None and stat.S_ISDIR(new_mode)
+
+    if old_dir or new_dir:
+        for change in tree_changes(store, old_sha if old_dir else None,
+                                   new_sha if new_dir else None,
+                                   rename_detector=detector):
+            yield _prefixed(change, path)
+
+    # A file at path itself
+    old = TreeEntry(path, old_mode, old_sha) \
+        if old_mode is not None and not old_dir else _NO_ENTRY
+    new = TreeEntry(path, new_mode, new_sha) \
+        if new_mode is not None and not new_dir else _NO_ENTRY
+    if old == new:
+        return
+    if old.path is None:
+        yield TreeChange.add(new)
+    elif new.path is None:
+        yield TreeChange.delete(old)
+    elif stat.S_IFMT(old.mode) != stat.S_IFMT(new.mode):
+        yield TreeChange.delete(old)
+        yield TreeChange.add(new)
+    else:
+        yield TreeChange(CHANGE_MODIFY, old, new)
+
+
+def iter_changes(store, old_tree, new_tree, paths=None, renames=False):
+    """
+    Yields a dulwich TreeChange for each file that differs between the
+    trees `old_tree` and `new_tree`.  Subtrees with the same sha on both
+    sides are not walked.
+
+    :param paths:   only files at or below these paths, only the subtrees
+                    at these paths are walked.  Renames are detected within
+                    each of them.
+    :param renames: pair removed and added files into renames
+    """
+    detector = RenameDetector(store) if renames else None
+    if not paths:
+        for change in tree_changes(store, old_tree, new_tree,
+                                   rename_detector=detector):
+            yield change
+        return
+
+    # Paths below another one are covered by it
+    paths = sorted(set(p.strip('/') for p in paths if p.strip('/')))
+    for path in paths:
+        if any(path.startswith(other + '/') for other in paths):
+            continue
+        for change in _path_changes(store, old_tree, new_tree, path,
+                                    detector):
+            yield change
+
+
+def _blob(store, entry):
+    """ The blob of a tree entry, empty for a missing side """
+    if entry.sha is None:
+        return Blob.from_string('')
+    if S_ISGITLINK(entry.mode):
+        return Blob.from_string('Subproject commit ' + entry.sha + '\n')
+    return store[entry.sha]
+
+
+def format_name_only(changes):
+    """ Yields the path of each change, without reading any blob """
+    for change in changes:
+        yield (change.new.path or change.old.path) + '\n'
+
+
+def format_patch(store, changes):
+    """ Yields a git style patch of the changes, file by file """
+    for change in changes:
+        old, new = change.old, change.new
+        header = gen_diff_header((old.path, new.path), (old.mode, new.mode),
+                                 (old.sha, new.sha))
+        yield next(header)
+        if change.type == CHANGE_RENAME:
+            yield 'rename from {0}\nrename to {1}\n'.format(old.path,
+                                                            new.path)
+        for chunk in header:
+            yield chunk
+
+        old_blob, new_blob = _blob(store, old), _blob(store, new)
+        if is_binary(old_blob.data) or is_binary(new_blob.data):
+            yield 'Binary files {0} and {1} differ\n'.format(
+                patch_filename(old.path, 'a'), patch_filename(new.path, 'b'))
+            continue
+        for chunk in unified_diff(old_blob.splitlines(),
+                                  new_blob.splitlines(),
+                                  patch_filename(old.path, 'a'),
+                                  patch_filename(new.path, 'b')):
+            yield chunk
+
+
+def _count_lines(old_lines, new_lines):
+    """
+    Returns the (inserted, deleted) line counts between two versions of a
+    file.  Past the common head and tail, more than STAT_DIFF_MAX_LINES
+    lines are compared as multisets in linear time - a moved line then
+    counts as unchanged.
+    """
+    head = 0
+    end = min(len(old_lines), len(new_lines))
+    while head < end and old_lines[head] == new_lines[head]:
+        head += 1
+    tail = 0
+    while tail < end - head and \
+            old_lines[-1 - tail] == new_lines[-1 - tail]:
+        tail += 1
+    old_lines = old_lines[head:len(old_lines) - tail]
+    new_lines = new_lines[head:len(new_lines) - tail]
+
+    if len(old_lines) + len(new_lines) > STAT_DIFF_MAX_LINES:
+        old_counts, new_counts = Counter(old_lines), Counter(new_lines)
+        return (sum((new_counts - old_counts).values()),
+                sum((old_counts - new_counts).values()))
+
+    added = removed = 0
+    for tag, i1, i2, j1, j2 in SequenceMatcher(
+            None, old_lines, new_lines).get_opcodes():
+        if tag in ('replace', 'delete'):
+            removed += i2 - i1
+        if tag in ('replace', 'insert'):
+            added += j2 - j1
+    return added, removed
+
+
+def format_stat(store, changes):
+    """
+    Yields a line of inserted and deleted line counts per change, then the
+    totals.  Blobs are read to count lines, no patch text is built, see
+    _count_lines.
+    """
+    files = insertions = deletions = 0
+    for change in changes:
+        old, new = change.old, change.new
+        if change.type == CHANGE_RENAME:
+            path = '{0} => {1}'.format(old.path, new.path)
+        else:
+            path = new.path or old.path
+        files += 1
+
+        old_data, new_data = _blob(store, old).data, _blob(store, new).data
+        if is_binary(old_data) or is_binary(new_data):
+            yield ' {0} | Bin {1} -> {2} bytes\n'.format(
+                path, len(old_data), len(new_data))
+            continue
+
+        added, removed = _count_lines(old_data.splitlines(),
+                                      new_data.splitlines())
+        insertions += added
+        deletions += removed
+
+        # Scale long bars down, keeping at least one of each sign shown
+        total = added + removed
+        scale = min(1.0, float(STAT_BAR_WIDTH) / total) if total else 1.0
+        plus = int(round(added * scale)) or (1 if added else 0)
+        minus = int(round(removed * scale)) or (1 if removed else 0)
+        yield ' {0} | {1} {2}{3}\n'.format(path, total, '+' * plus,
+                                           '-' * minus)
+
+    yield ' {0} file{1} changed, {2} insertion{3}(+), {4} deletion{5}(-)\n' \
+        .format(files, '' if files == 1 else 's',
+                insertions, '' if insertions == 1 else 's',
+                deletions, '' if deletions == 1 else 's')
+
+
+def format_changes(store, changes, fmt='patch'):
+    """ Yields the output of `changes` in one of DIFF_FORMATS """
+    if fmt == 'name-only':
+        return format_name_only(changes)
+    if fmt == 'stat':
+        return format_stat(store, changes)
+    return format_patch(store, changes)
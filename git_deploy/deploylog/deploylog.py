@@ -6,9 +6,13 @@ __date__ = '2014-01-14'
 __license__ = 'GPL v2.0 (or later)'
 
 import re
+import os
+import atexit
+import threading
 
 from git_deploy.utils import ssh_command_target
 from git_deploy.config import log
+from git_deploy.tracing import traced
 
 
 class DeployLogError(Exception):
@@ -30,15 +34,22 @@ class DeployLogDefault(object):
     `log_archive` append-flushes the active log to the archive log.
 
     This is stored in a file on the target as specified in the singleton init.
+
+    In buffered mode log lines are appended to a local spool file and sent to
+    the target in a single SSH call by `flush`, `log_archive` or at process
+    exit.  Lines left in the spool by a crashed run are sent with the next
+    flush.
     """
 
     LOGNAME_ARCHIVE = 'git-deploy.log'
     LOGNAME_ACTIVE = 'git-deploy-active.log'
+    LOGNAME_SPOOL = 'log-spool'
 
     # class instance
     __instance = None
 
-    def __init__(self, target, path, user, local_key_path):
+    def __init__(self, target, path, user, local_key_path, buffered=False,
+                 spool_dir=None):
         """ Initialize class instance """
         self.__class__.__instance = self
 
@@ -47,6 +58,14 @@ class DeployLogDefault(object):
         self.user = user
         self.key_path = local_key_path
 
+        self.buffered = buffered and spool_dir is not None
+
+        # Lines are spooled from hook threads while a flush may be running
+        self._spool_lock = threading.Lock()
+        if self.buffered:
+            self.spool_path = os.path.join(spool_dir, self.LOGNAME_SPOOL)
+            atexit.register(self.flush)
+
     def __new__(cls, *args, **kwargs):
         """ This class is Singleton, return only one instance """
         if not cls.__instance:
@@ -61,7 +80,7 @@ class DeployLogDefault(object):
         ret = ssh_command_target(cmd, self.target, self.user, self.key_path)
 
         # Parse the count and add the file if it's missing
-        if int(ret['stdout'][0].strip()) > 0:
+        if int(ret['stdout'][0].strip()) == 0:
             cmd = 'touch {0}/{1}'.format(path, filename)
             ssh_command_target(cmd, self.target, self.user, self.key_path)
 
@@ -74,6 +93,9 @@ class DeployLogDefault(object):
         Returns True on successful logging, false otherwise.
         """
 
+        if self.buffered:
+            return self._spool(line)
+
         self._check_and_add(self.path, self.LOGNAME_ACTIVE)
 
         # escape logline
@@ -89,12 +111,87 @@ class DeployLogDefault(object):
 
         return True
 
+    def _spool(self, line):
+        """
+        Appends a line to the local spool file, synced to disk so that it
+        survives a crash before the next flush.
+        """
+        try:
+            with self._spool_lock, open(self.spool_path, 'a') as f:
+                f.write(line.replace('\n', ' ') + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        except (IOError, OSError):
+            log.error("Failed to spool '{0}'".format(line))
+            return False
+        return True
+
+    def _read_spool(self):
+        """ Returns the contents of the local spool file """
+        try:
+            with open(self.spool_path) as f:
+                return f.read()
+        except (IOError, OSError):
+            return ''
+
+    def _send_spool(self, cmd):
+        """
+        Runs `cmd` on the target with the spooled lines on stdin and empties
+        the spool on success.
+        """
+        data = self._read_spool()
+        try:
+            ret = ssh_command_target(cmd, self.target, self.user,
+                                     self.key_path, data=data)
+        except Exception:
+            return False
+
+        if ret['exit_status'] != 0:
+            return False
+        if not data:
+            return True
+
+        # Only drop what was sent, lines may have been spooled since
+        with self._spool_lock, open(self.spool_path, 'r+') as f:
+            remainder = f.read()[len(data):]
+            f.seek(0)
+            f.write(remainder)
+            f.truncate()
+        return True
+
+    @traced('deploy log flush')
+    def flush(self):
+        """
+        Sends the spooled log lines to the active log on the target in one
+        SSH call.  Returns True on success, false otherwise.
+        """
+        if not self.buffered or not self._read_spool():
+            return True
+
+        cmd = "mkdir -p {0} && cat >> {0}/{1}".format(self.path,
+                                                      self.LOGNAME_ACTIVE)
+        if not self._send_spool(cmd):
+            log.error("Failed to flush deploy log, lines kept in "
+                      "{0}".format(self.spool_path))
+            return False
+        return True
+
+    @traced('deploy log archive')
     def log_archive(self):
         """
         Dumps the active log to the archive. Returns True on successful
         logging, false otherwise.
         """
 
+        if self.buffered:
+            cmd = "mkdir -p {0} && cat >> {0}/{1} && " \
+                  "cat {0}/{1} >> {0}/{2} && rm -f {0}/{1}".format(
+                      self.path, self.LOGNAME_ACTIVE, self.LOGNAME_ARCHIVE)
+            if not self._send_spool(cmd):
+                log.error("Failed to append active log to archive.")
+                return False
+            return True
+
         self._check_and_add(self.path, self.LOGNAME_ARCHIVE)
 
         cmd = "cat {0}/{1} >> {2}/{3}".format(self.path,
@@ -5,12 +5,16 @@ Driver model that allows customized deploy bahaviour
 __date__ = '2013-12-11'
 __license__ = 'GPL v2.0 (or later)'
 
-import subprocess
 import os
 
 from git_deploy.git_methods import GitMethods
-from git_deploy.config import log, exit_codes, \
+from git_deploy.drivers.hooks import hook_graph, run_graph, run_hook, \
+    HookGraphError
+from git_deploy.config import log, exit_codes, config_bool, \
     DEFAULT_HOOK
+from git_deploy import config
+from git_deploy.remote import get_remote_executor
+from git_deploy.tracing import span, span_env, get_tracer, RUN_ID_ENV
 
 
 class DeployDriverError(Exception):
@@ -24,57 +28,108 @@ class DeployDriverError(Exception):
         return self._exit_code
 
 
-def _call_hooks(path, phase, dryrun=False):
+def _call_hooks(path, phase, dryrun=False, env=None, workers=1,
+                log_remote=False, limits=None):
     """Performs calls on path/phase dependent hooks
 
+    Hooks run in sorted order, one at a time, unless the hook manifest in
+    `path` declares their dependencies - see drivers.hooks.  Independent
+    hooks then run concurrently on up to `workers` threads.
+
+    Hook output is logged line by line while the hook runs.  The last lines
+    are repeated in the error log if the hook fails.
+
+    Each hook runs within the timeout, CPU and memory limits in `limits`,
+    or those of its phase or its own section in the manifest.
+
     :param path: hooks path
     :param phase: deploy phase
+    :param env: extra environment variables for the hooks
+    :param workers: maximum number of hooks run at once
+    :param log_remote: also write hook output to the deploy log
+    :param limits: default hook limits, see drivers.hooks.HOOK_LIMITS
 
     """
-    if os.path.exists(path):
-        sorted_path = sorted(os.listdir(path))
-        for item in sorted_path:
-            item_phase = item.split('.')[0]
-
-            # CALL hook and log
-            if phase == item_phase:
-                cmd = path + '/' + item
-                log_msg = 'CALLING \'{0}\' ON PHASE \'{1}\''.format(
-                  cmd, phase
-                )
-                log.info(__name__ + ' :: {0}'.format(log_msg))
-                if dryrun:
-                    print ''
-                    with open(cmd) as f:
-                        for line in f.readlines():
-                            if not line[-1] == '\n':
-                                print '\t' + line[:-1]
-                            else:
-                                print '\t' + line[:-1]
-                    print ''
-
-                else:
-                    proc = subprocess.Popen(path + '/' + item,
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE)
-                    log.info(cmd + ' OUT -> ' + '; '.join(
-                        filter(lambda x: x, proc.communicate())))
-
-                    # Flag a failed hook
-                    if proc.returncode:
-                        raise DeployDriverError(exit_code=17,
-                                                message=exit_codes[17])
-
-    else:
+    if not os.path.exists(path):
         log.error(__name__ + ' :: CANNOT FIND HOOK PATH \'{0}\''.format(
             path))
         raise DeployDriverError(exit_code=17, message=exit_codes[17])
 
+    try:
+        hooks, deps, hook_limits = hook_graph(path, phase, limits)
+    except HookGraphError as e:
+        raise DeployDriverError(message=e.message, exit_code=e.exit_code)
+
+    if dryrun:
+        workers = 1
+
+    hook_env = dict(os.environ)
+    hook_env.update(env or {})
+
+    # Hooks run on pool threads, their spans belong to the caller's span
+    parent = get_tracer().current()
+
+    def run(item):
+        cmd = path + '/' + item
+        log_msg = 'CALLING \'{0}\' ON PHASE \'{1}\''.format(
+          cmd, phase
+        )
+        log.info(__name__ + ' :: {0}'.format(log_msg))
+        if dryrun:
+            print ''
+            with open(cmd) as f:
+                for line in f.readlines():
+                    print '\t' + line.rstrip('\n')
+            print ''
+            return 0, []
+
+        # The hook's own spans, if it traces, belong to this one
+        with span('hook ' + item, parent=parent) as span_id:
+            run_env = dict(hook_env, **span_env(span_id))
+            returncode, tail = run_hook(cmd, item, sink, env=run_env,
+                                        limits=hook_limits[item])
+        return returncode, tail
+
+    def sink(line):
+        log.info(__name__ + ' :: ' + line)
+        if log_remote:
+            config.deploy_log.log(line)
+
+    def report(item, result):
+        if not dryrun:
+            log.info('{0} :: \'{1}/{2}\' exited with {3}.'.format(
+                __name__, path, item, result[0]))
 
-def _make_release_tag(tag, author):
-    """ Generates a release tag for the deploy """
     try:
-        GitMethods()._dulwich_tag(tag, author)
+        failed = run_graph(hooks, deps, run, workers=workers, report=report)
+    except HookGraphError as e:
+        raise DeployDriverError(message=e.message, exit_code=e.exit_code)
+
+    # Flag a failed hook
+    if failed:
+        log.error('{0} :: Hook \'{1}\' failed with {2}.'.format(
+            __name__, failed[0], failed[1][0]))
+        for line in failed[1][1]:
+            log.error('{0} :: {1}'.format(__name__, line))
+        raise DeployDriverError(exit_code=17, message=exit_codes[17])
+
+
+def _hook_env(args):
+    """ Environment variables describing the deploy, passed to hooks """
+    return {
+        'GIT_DEPLOY_TAG': args['tag'] if args['release'] else '',
+        'GIT_DEPLOY_ENV': args['env'] or '',
+        'GIT_DEPLOY_BRANCH': args['branch'],
+        'GIT_DEPLOY_TARGETS': ' '.join(args.get('targets') or []),
+        RUN_ID_ENV: get_tracer().run_id,
+    }
+
+
+def _make_release_tag(tag, author, env):
+    """ Generates a release tag for the deploy, recording the env """
+    try:
+        GitMethods()._dulwich_tag(tag, author,
+                                  GitMethods()._make_tag_message(env))
     except Exception as e:
         log.error(str(e))
         raise DeployDriverError(message=exit_codes[12], exit_code=12)
@@ -93,8 +148,9 @@ class DeployDriverDefault(object):
     def __new__(cls, *args, **kwargs):
         """ This class is Singleton, return only one instance """
         if not cls.__instance:
-            cls.__instance = super(DeployDriverDefault, cls).__new__(cls, *args,
-                                                                    **kwargs)
+            cls.__instance = super(DeployDriverDefault, cls).__new__(cls,
+                                                                     *args,
+                                                                     **kwargs)
         return cls.__instance
 
     def sync(self, args):
@@ -109,40 +165,72 @@ class DeployDriverDefault(object):
         """
 
         app_path = '{0}/{1}'.format(args['deploy_apps'], args['env'])
+        hook_args = {
+            'env': _hook_env(args),
+            'workers': int(args.get('deploy.hook_workers', 1)),
+            'log_remote': config_bool(args.get('deploy.hook_log_remote',
+                                               'false')),
+            'limits': {
+                'timeout': args.get('deploy.hook_timeout', 0),
+                'cpu': args.get('deploy.hook_cpu', 0),
+                'memory': args.get('deploy.hook_memory', 0),
+            },
+        }
 
         # 1. CALL deploy/apps/common
         log.info('{0} :: Calling pre-sync common: "{1}" ...'.
             format(__name__, args['deploy_apps_common']))
-        _call_hooks(args['deploy_apps_common'], 'pre-sync', args['dryrun'])
+        with span('pre-sync common'):
+            _call_hooks(args['deploy_apps_common'], 'pre-sync',
+                        args['dryrun'], **hook_args)
 
         # 2. CALL deploy/apps/$env
         if not args['default']:
             log.info('{0} :: Calling pre-sync app: "{1}" ...'.
                 format(__name__, app_path))
-            _call_hooks(app_path, 'pre-sync', args['dryrun'])
+            with span('pre-sync app'):
+                _call_hooks(app_path, 'pre-sync', args['dryrun'],
+                            **hook_args)
 
         # 3. Apply optional release tag here
         if args['release'] and not args['dryrun']:
-            _make_release_tag(args['tag'], args['author'])
+            with span('release tag'):
+                _make_release_tag(args['tag'], args['author'], args['env'])
 
         # 4. CALL sync, deploy/apps/sync/$env.sync
         log.info('{0} :: Calling pre-sync app: "{1}" ...'.
             format(__name__, args['deploy_sync']))
-        if args['default'] or not args['env']:
-            _call_hooks(args['deploy_sync'], 'default', args['dryrun'])
-        else:
-            _call_hooks(args['deploy_sync'], args['env'], args['dryrun'])
-
-        # 4. CALL app post sync, deploy/apps/$env
-        if not args['default']:
+        with span('sync hook'):
+            if args['default'] or not args['env']:
+                _call_hooks(args['deploy_sync'], 'default', args['dryrun'],
+                            **hook_args)
+            else:
+                _call_hooks(args['deploy_sync'], args['env'],
+                            args['dryrun'], **hook_args)
+
+        # Send the log lines so far while the post-sync hooks run
+        flushed = None
+        if config.deploy_log and not args['dryrun']:
+            flushed = get_remote_executor().submit(config.deploy_log.flush)
+
+        try:
+            # 4. CALL app post sync, deploy/apps/$env
+            if not args['default']:
+                log.info('{0} :: Calling post-sync app: "{1}" ...'.
+                    format(__name__, app_path))
+                with span('post-sync app'):
+                    _call_hooks(app_path, 'post-sync', args['dryrun'],
+                                **hook_args)
+
+            # 4. CALL common post sync, deploy/apps/common
             log.info('{0} :: Calling post-sync app: "{1}" ...'.
-                format(__name__, app_path))
-            _call_hooks(app_path, 'post-sync', args['dryrun'])
-
-        # 4. CALL common post sync, deploy/apps/common
-        log.info('{0} :: Calling post-sync app: "{1}" ...'.
-            format(__name__, args['deploy_apps_common']))
-        _call_hooks(args['deploy_apps_common'], 'post-sync', args['dryrun'])
+                format(__name__, args['deploy_apps_common']))
+            with span('post-sync common'):
+                _call_hooks(args['deploy_apps_common'], 'post-sync',
+                            args['dryrun'], **hook_args)
+        finally:
+            if flushed is not None:
+                flushed.get()
 
 
 class DeployDriverDryRun(object):
@@ -178,7 +266,3 @@ class DeployDriverDryRun(object):
         DeployDriverDefault().sync(args)
 
         log.info('{0} :: DRYRUN SYNC COMPLETE'.format(__name__))
-
-
-
-
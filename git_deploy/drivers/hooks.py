@@ -0,0 +1,315 @@
+"""
+Hook graph - the order and concurrency in which deploy hooks run
+"""
+
+__date__ = '2026-10-18'
+__license__ = 'GPL v2.0 (or later)'
+
+import os
+import time
+import signal
+import resource
+import threading
+import subprocess
+
+from Queue import Queue
+from collections import deque
+from ConfigParser import RawConfigParser, Error as ConfigParserError
+
+from git_deploy.config import log, exit_codes, split_targets
+
+
+# Sidecar manifest, in a hook directory, declaring hook dependencies
+HOOK_MANIFEST = 'hooks.conf'
+
+# Lines of hook output kept for failure reports
+HOOK_TAIL_LINES = 50
+
+# Hook limits - wall-clock timeout and CPU time in seconds, memory in MB,
+# 0 for no limit
+HOOK_LIMITS = ('timeout', 'cpu', 'memory')
+
+# Seconds between SIGTERM and SIGKILL for a hook that timed out
+HOOK_KILL_GRACE = 5
+
+
+class HookGraphError(Exception):
+    """ Basic exception class for hook graph errors """
+    def __init__(self, message="Hook graph error.", exit_code=1):
+        Exception.__init__(self, message)
+        self._exit_code = int(exit_code)
+
+    @property
+    def exit_code(self):
+        return self._exit_code
+
+
+def read_manifest(path):
+    """
+    Reads the hook manifest in `path`, returns a dict of section -> dict of
+    options.  A section names either a hook file or a phase:
+
+        [phase pre-sync]
+        timeout = 600
+
+        [pre-sync.assets]
+        after = pre-sync.schema
+        memory = 2048
+
+        [pre-sync.cache-warm]
+        after =
+
+    Hooks run after the hooks named in `after`.  Limits of a hook section
+    override those of its phase section.
+    """
+    manifest = {}
+    parser = RawConfigParser()
+    try:
+        if not parser.read(os.path.join(path, HOOK_MANIFEST)):
+            return manifest
+    except ConfigParserError as e:
+        log.error('{0} :: {1}'.format(__name__, e))
+        raise HookGraphError(message=exit_codes[44], exit_code=44)
+
+    for section in parser.sections():
+        manifest[section] = dict(parser.items(section))
+    return manifest
+
+
+def hook_limits(manifest, phase, hook, defaults=None):
+    """
+    Returns the limits of a hook - `defaults`, overridden by the phase
+    section and then the hook section of the manifest.
+    """
+    limits = dict((name, 0) for name in HOOK_LIMITS)
+    limits.update(defaults or {})
+    for section in ('phase ' + phase, hook):
+        for name in HOOK_LIMITS:
+            if name in manifest.get(section, {}):
+                limits[name] = manifest[section][name]
+    try:
+        return dict((name, int(value)) for name, value in limits.iteritems())
+    except ValueError:
+        log.error('{0} :: Invalid limits for {1} - {2}'.format(
+            __name__, hook, limits))
+        raise HookGraphError(message=exit_codes[44], exit_code=44)
+
+
+def hook_graph(path, phase, defaults=None):
+    """
+    Returns (hooks, deps, limits) for the hooks of `phase` in `path` - the
+    hook names in sorted order, a dict of hook name -> set of hook names
+    that must finish first and a dict of hook name -> limits.
+
+    Hooks listed in the manifest depend only on the hooks named in their
+    `after` option.  Any other hook depends on every hook sorted before it,
+    so a directory without a manifest runs one hook at a time as before.
+    """
+    hooks = [item for item in sorted(os.listdir(path))
+             if item.split('.')[0] == phase and item != HOOK_MANIFEST]
+    manifest = read_manifest(path)
+
+    deps, limits = {}, {}
+    for idx, hook in enumerate(hooks):
+        limits[hook] = hook_limits(manifest, phase, hook, defaults)
+        if hook in manifest:
+            after = set(split_targets(manifest[hook].get('after')))
+            deps[hook] = after & set(hooks)
+            if after - set(hooks):
+                log.warning('{0} :: {1} runs after unknown hook(s) {2}, '
+                            'ignored.'.format(__name__, hook,
+                                              ', '.join(sorted(after -
+                                                               set(hooks)))))
+        else:
+            deps[hook] = set(hooks[:idx])
+    return hooks, deps, limits
+
+
+def run_graph(hooks, deps, run, workers=1, report=None):
+    """
+    Runs `run(hook)` for every hook once all of its dependencies succeeded,
+    on a pool of at most `workers` threads.  `run` returns a
+    (returncode, output lines) pair.
+
+    Once a hook fails no further hooks are started.  `report(hook, result)`
+    is called in the order of `hooks` regardless of completion order.
+    Returns the first failed (hook, result) in that order, or None.
+    """
+
+    def safe_run(hook):
+        try:
+            return run(hook)
+        except Exception as e:
+            return 1, [str(e)]
+
+    from multiprocessing.pool import ThreadPool
+
+    pending = list(hooks)
+    running = set()
+    results = {}
+    reported = 0
+    failed = False
+
+    done = Queue()
+    pool = ThreadPool(max(1, min(workers, len(hooks))))
+    try:
+        while pending or running:
+            if not failed:
+                for hook in list(pending):
+                    if all(results.get(dep, (1,))[0] == 0
+                           for dep in deps[hook]):
+                        pending.remove(hook)
+                        running.add(hook)
+                        pool.apply_async(safe_run, (hook,),
+                                         callback=lambda r, h=hook:
+                                         done.put((h, r)))
+
+            if not running:
+                if pending and not failed:
+                    log.error('{0} :: Hook dependency cycle in {1}.'.format(
+                        __name__, ', '.join(pending)))
+                    raise HookGraphError(message=exit_codes[44],
+                                         exit_code=44)
+                break
+
+            hook, result = done.get()
+            running.discard(hook)
+            results[hook] = result
+            failed = failed or result[0] != 0
+
+            # Report finished hooks in their sorted order
+            while reported < len(hooks) and hooks[reported] in results:
+                if report:
+                    report(hooks[reported], results[hooks[reported]])
+                reported += 1
+    finally:
+        pool.close()
+        pool.join()
+
+    # Hooks finished after one that never ran
+    if report:
+        for hook in hooks[reported:]:
+            if hook in results:
+                report(hook, results[hook])
+
+    for hook in hooks:
+        if hook in results and results[hook][0] != 0:
+            return hook, results[hook]
+    return None
+
+
+def stream_output(proc, name, sink, tail_lines=HOOK_TAIL_LINES):
+    """
+    Passes every line the hook process `proc` writes to stdout or stderr to
+    `sink(line)` as soon as it is written, prefixed with the time, the hook
+    name and the stream.  Only the last `tail_lines` lines are kept.
+
+    Waits for the process to exit, returns the kept lines.
+    """
+    tail = deque(maxlen=tail_lines)
+    lock = threading.Lock()
+
+    def pump(pipe, stream):
+        for line in iter(pipe.readline, ''):
+            line = '{0} {1} [{2}] {3}'.format(time.strftime('%H:%M:%S'),
+                                              name, stream,
+                                              line.rstrip('\n'))
+            with lock:
+                tail.append(line)
+                sink(line)
+        pipe.close()
+
+    pumps = [threading.Thread(target=pump, args=(proc.stdout, 'out')),
+             threading.Thread(target=pump, args=(proc.stderr, 'err'))]
+    for thread in pumps:
+        thread.daemon = True
+        thread.start()
+    for thread in pumps:
+        thread.join()
+    proc.wait()
+    return list(tail)
+
+
+def _limit_process(limits):
+    """
+    Returns the preexec_fn for a hook process - it starts a new process
+    group, so that the hook and its children can be killed together, and
+    sets the CPU and memory rlimits, which apply to each process.
+    """
+    def preexec():
+        os.setsid()
+        if limits.get('cpu'):
+            resource.setrlimit(resource.RLIMIT_CPU,
+                               (limits['cpu'], limits['cpu'] + 1))
+        if limits.get('memory'):
+            size = limits['memory'] * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (size, size))
+    return preexec
+
+
+def _kill_group(proc, sig):
+    """ Signal the process group of a hook """
+    try:
+        os.killpg(proc.pid, sig)
+    except OSError:
+        pass
+
+
+def run_hook(cmd, name, sink, env=None, limits=None):
+    """
+    Runs the hook `cmd` within `limits` and streams its output to `sink`,
+    see stream_output.  A hook still running after its timeout is sent
+    SIGTERM, and SIGKILL HOOK_KILL_GRACE seconds later, along with its
+    whole process group.
+
+    Returns (returncode, last output lines).  If the hook hit a limit the
+    last line says which.
+    """
+    limits = limits or {}
+    proc = subprocess.Popen(cmd,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            bufsize=-1,
+                            env=env,
+                            preexec_fn=_limit_process(limits))
+
+    expired = threading.Event()
+    timers = []
+
+    def expire():
+        expired.set()
+        _kill_group(proc, signal.SIGTERM)
+        timer = threading.Timer(HOOK_KILL_GRACE, _kill_group,
+                                (proc, signal.SIGKILL))
+        timer.daemon = True
+        timer.start()
+        timers.append(timer)
+
+    if limits.get('timeout'):
+        timer = threading.Timer(limits['timeout'], expire)
+        timer.daemon = True
+        timer.start()
+        timers.append(timer)
+
+    try:
+        tail = stream_output(proc, name, sink)
+    finally:
+        for timer in list(timers):
+            timer.cancel()
+
+    limit_hit = None
+    if expired.is_set():
+        limit_hit = 'timeout of {0}s'.format(limits['timeout'])
+    elif proc.returncode == -signal.SIGXCPU or \
+            (proc.returncode == -signal.SIGKILL and limits.get('cpu')):
+        limit_hit = 'cpu limit of {0}s'.format(limits['cpu'])
+    elif proc.returncode and limits.get('memory'):
+        limit_hit = 'failure, memory limit of {0} MB in effect'.format(
+            limits['memory'])
+
+    if limit_hit:
+        line = '{0} {1} [limit] {2}'.format(time.strftime('%H:%M:%S'),
+                                            name, limit_hit)
+        sink(line)
+        tail.append(line)
+    return proc.returncode or int(bool(limit_hit)), tail
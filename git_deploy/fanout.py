@@ -0,0 +1,173 @@
+"""
+Runs a deploy operation against many targets concurrently, in batches
+"""
+
+__date__ = '2026-10-18'
+__license__ = 'GPL v2.0 (or later)'
+
+import time
+import math
+import Queue
+import threading
+
+from config import log, split_targets
+
+
+class FanOutError(Exception):
+    """ Basic exception class for fan-out failures """
+    def __init__(self, message="Fan-out error.", exit_code=1):
+        Exception.__init__(self, message)
+        self._exit_code = int(exit_code)
+
+    @property
+    def exit_code(self):
+        return self._exit_code
+
+
+class FanOutResult(object):
+    """ Outcome of an operation on one target """
+
+    OK = 'ok'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+
+    def __init__(self, target, status, elapsed=0.0, value=None, error=None):
+        self.target = target
+        self.status = status
+        self.elapsed = elapsed
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.status == self.OK
+
+
+def parse_batches(spec, total):
+    """
+    Turns a batch spec such as '1,10%,100%' into a list of cumulative target
+    counts, e.g. [1, 30, 300] for 300 targets.  Each entry is either a
+    number of targets or a percentage of all targets.  The final batch always
+    covers every target.
+    """
+    sizes = []
+    for item in split_targets(spec):
+        if item.endswith('%'):
+            size = int(math.ceil(total * float(item[:-1]) / 100))
+        else:
+            size = int(item)
+        size = min(max(size, 1), total)
+        if not sizes or size > sizes[-1]:
+            sizes.append(size)
+
+    if total and (not sizes or sizes[-1] < total):
+        sizes.append(total)
+    return sizes
+
+
+def _run_batch(run, batch, workers, timeout):
+    """
+    Runs `run(target)` for the targets of a batch, at most `workers` at
+    once, each on a daemon thread.  A target still running after `timeout`
+    seconds is failed and its thread abandoned, which frees its place for
+    the next target.  Returns the results in the order of `batch`.
+    """
+    done = Queue.Queue()
+    results = [None] * len(batch)
+    started = {}
+    pending = range(len(batch))
+
+    def call(idx):
+        done.put((idx, run(batch[idx])))
+
+    while pending or started:
+        while pending and len(started) < workers:
+            idx = pending.pop(0)
+            started[idx] = time.time()
+            thread = threading.Thread(target=call, args=(idx,))
+            thread.daemon = True
+            thread.start()
+
+        # Wake up for the first deadline, or now and then so that the
+        # wait can be interrupted
+        wait = 1.0
+        if timeout:
+            wait = max(0, min(started.values()) + timeout - time.time())
+        try:
+            idx, result = done.get(True, wait)
+        except Queue.Empty:
+            now = time.time()
+            for idx, start in started.items():
+                if timeout and now - start >= timeout:
+                    del started[idx]
+                    results[idx] = FanOutResult(
+                        batch[idx], FanOutResult.FAILED, now - start,
+                        error='timed out after {0:g}s'.format(timeout))
+            continue
+
+        # Unless it timed out already
+        if idx in started:
+            del started[idx]
+            results[idx] = result
+    return results
+
+
+def fan_out(func, targets, workers=10, batches='100%', timeout=None):
+    """
+    Calls `func(target)` for every target on up to `workers` threads.
+
+    Targets are processed in the batches described by `batches` (see
+    parse_batches).  If any target in a batch fails, the remaining batches
+    are skipped.  Returns a list of FanOutResult in the order of `targets`.
+
+    :param func: callable run per target, exceptions mark the target failed
+    :param targets: list of target hosts
+    :param workers: maximum number of targets processed at once
+    :param batches: batch spec
+    :param timeout: seconds allowed per target, a target taking longer is
+                    failed without waiting for func to return
+    """
+
+    def run(target):
+        start = time.time()
+        try:
+            value = func(target)
+        except Exception as e:
+            return FanOutResult(target, FanOutResult.FAILED,
+                                time.time() - start, error=str(e) or
+                                e.__class__.__name__)
+        return FanOutResult(target, FanOutResult.OK, time.time() - start,
+                            value=value)
+
+    results = []
+    done = 0
+    for size in parse_batches(batches, len(targets)):
+        batch = targets[done:size]
+        log.info('{0} :: Batch of {1} target(s), {2}/{3} done.'.format(
+            __name__, len(batch), done, len(targets)))
+        results.extend(_run_batch(run, batch, max(1, workers), timeout))
+        done = size
+        if not all(result.ok for result in results):
+            break
+
+    results.extend(FanOutResult(target, FanOutResult.SKIPPED)
+                   for target in targets[len(results):])
+    return results
+
+
+def format_report(results):
+    """ Returns the lines of a summary report for fan-out results """
+    lines = []
+    for result in results:
+        line = '{0:<30} {1:<8} {2:7.2f}s'.format(result.target,
+                                                 result.status.upper(),
+                                                 result.elapsed)
+        if result.error:
+            line += '  ' + result.error
+        lines.append(line)
+
+    ok = [result for result in results if result.ok]
+    slowest = max([result.elapsed for result in results] or [0.0])
+    lines.append('{0}/{1} target(s) succeeded, slowest {2:.2f}s.'.format(
+        len(ok), len(results), slowest))
+    return lines
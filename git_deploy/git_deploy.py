@@ -12,12 +12,19 @@ __date__ = '2013-09-08'
 __license__ = 'GPL v2.0 (or later)'
 
 import os
-
-from lockers.locker import DeployLockerDefault
-from git_methods import GitMethods
+import sys
+import json
+import time
+
+from lockers.locker import get_locker, DeployLockerError
+from git_methods import GitMethods, GitMethodsError
+from utils import get_ssh_pool
+from remote import get_remote_executor
+from tracing import span, get_tracer, load_runs, format_profile, \
+    TRACE_FILE
 from drivers.driver import DeployDriverDefault, DeployDriverDryRun
-from config import deploy_log, set_deploy_log, log, configure, exit_codes, \
-    DEFAULT_BRANCH, DEFAULT_REMOTE, \
+from config import set_deploy_log, log, configure, exit_codes, \
+    config_bool, DEFAULT_BRANCH, DEFAULT_REMOTE, \
     DEFAULT_REMOTE_ARG_IDX, DEFAULT_BRANCH_ARG_IDX
 
 
@@ -32,6 +39,23 @@ class GitDeployError(Exception):
         return self._exit_code
 
 
+def _parse_time(value):
+    """
+    Seconds since the epoch of a local YYYY-MM-DD[THH:MM:SS] date, or of a
+    number of seconds, None if value is empty
+    """
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    for fmt in ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return int(time.mktime(time.strptime(value, fmt)))
+        except ValueError:
+            continue
+    raise GitDeployError(message=exit_codes[47], exit_code=47)
+
+
 class GitDeploy(object):
 
     # Pattern for git-deploy tags
@@ -59,23 +83,42 @@ class GitDeploy(object):
         if not os.path.exists(self.DEPLOY_DIR):
             os.mkdir(self.DEPLOY_DIR)
 
-        # Locking model
-        self._locker = DeployLockerDefault(
-            deploy_path=self.config['path'] + self.DEPLOY_DIR,
-            target=self.config['target'],
-            user=self.config['user.name'],
-            key_path=self.config['deploy.key_path'],
-            lock_handle=self.LOCK_FILE_HANDLE
-        )
+        # SSH port of the targets - git config deploy.ssh-port
+        get_ssh_pool().port = int(self.config['deploy.ssh_port'])
+
+        # Remote operations at once - git config deploy.remote-workers
+        get_remote_executor().workers = int(
+            self.config['deploy.remote_workers'])
+
+        # Locking model - git config deploy.lock-backend.  Created once, it
+        # keeps its cached lock state and heartbeat across GitDeploy() calls
+        if getattr(self, '_locker', None) is None:
+            try:
+                self._locker = get_locker(
+                    self.config['deploy.lock_backend'],
+                    deploy_path=self.config['path'] + self.DEPLOY_DIR,
+                    target=self.config['target'],
+                    user=self.config['user.name'],
+                    key_path=self.config['deploy.key_path'],
+                    lock_handle=self.LOCK_FILE_HANDLE,
+                    lease=self.config['deploy.lock_lease']
+                )
+            except DeployLockerError as e:
+                raise GitDeployError(message=e.message, exit_code=e.exit_code)
+
+        # Timing spans - git config deploy.trace
+        if config_bool(self.config['deploy.trace']):
+            get_tracer().enable(self.DEPLOY_DIR + TRACE_FILE)
 
         # Deploy Logger
-        set_deploy_log(
+        self.deploy_log = set_deploy_log(
             self.config['target'],
             self.config['path'] + self.DEPLOY_DIR,
             self.config['user.name'],
-            self.config['deploy.key_path']
+            self.config['deploy.key_path'],
+            buffered=config_bool(self.config['deploy.log_buffered']),
+            spool_dir=self.DEPLOY_DIR
         )
-        self.deploy_log = deploy_log
 
     def __new__(cls, *args, **kwargs):
         """ This class is Singleton, return only one instance """
@@ -106,6 +149,19 @@ class GitDeploy(object):
 
         return remote, branch
 
+    def _parse_targets(self, args):
+        """
+        Returns the sync targets - the hosts of the target group named on the
+        command line, or else every host in deploy.target
+        """
+        group = getattr(args, 'group', '')
+        if not group:
+            return self.config['targets']
+        try:
+            return self.config['target_groups'][group]
+        except KeyError:
+            raise GitDeployError(message=exit_codes[42], exit_code=42)
+
     @property
     def locker(self):
         return self._locker
@@ -115,11 +171,11 @@ class GitDeploy(object):
             * write a lock file
         """
 
-        # Create lock file - check if it already exists
-        if self._locker.check_lock():
-            raise GitDeployError(message=exit_codes[2])
-
-        self._locker.add_lock()
+        # Create lock - fails if it is already held
+        try:
+            self._locker.add_lock()
+        except DeployLockerError as e:
+            raise GitDeployError(message=e.message, exit_code=e.exit_code)
 
         logline = 'STARTING git deploy.'
         self.deploy_log.log('user(' + self.config['user.name'] +
@@ -136,12 +192,31 @@ class GitDeploy(object):
         log.info(__name__ + ' :: ' + logline)
         self.deploy_log.log('user(' + self.config['user.name'] +
                             ') ' + logline)
-        self.deploy_log.log_archive()
 
-        # Remove lock file
-        self._locker.remove_lock()
+        self._archive_log_and_unlock()
         return 0
 
+    def _archive_log_and_unlock(self, check_lock=False):
+        """
+        Append the active deploy log to the archive and remove the lock
+        file, if held when `check_lock` is set.
+
+        Buffered log lines, such as the one logged by remove_lock, are
+        spooled and sent in order, so the log is archived while the lock
+        is removed.  Unbuffered lines are SSH commands of their own that
+        would race the archive, it completes first.
+        """
+        if not self.deploy_log.buffered:
+            self.deploy_log.log_archive()
+            if not check_lock or self._locker.check_lock():
+                self._locker.remove_lock()
+            return
+
+        archived = get_remote_executor().submit(self.deploy_log.log_archive)
+        if not check_lock or self._locker.check_lock():
+            self._locker.remove_lock()
+        archived.get()
+
     def sync(self, args):
         """
             * add a sync tag
@@ -153,6 +228,7 @@ class GitDeploy(object):
             raise GitDeployError(message=exit_codes[30], exit_code=30)
 
         remote, branch = self._parse_remote(args)
+        targets = self._parse_targets(args)
 
         kwargs = {
             'author': GitMethods()._make_author(),
@@ -168,6 +244,7 @@ class GitDeploy(object):
 
         for key, value in self.config.iteritems():
             kwargs[key] = value
+        kwargs['targets'] = targets
 
         return self._sync(kwargs)
 
@@ -190,12 +267,17 @@ class GitDeploy(object):
             self.deploy_log.log('user(' + self.config['user.name'] +
                                 ') ' + logline)
 
-            DeployDriverDefault().sync(kwargs)
+            # Keep the lock's lease alive while the hooks run
+            if config_bool(self.config['deploy.lock_heartbeat']):
+                self._locker.start_heartbeat()
+            try:
+                with span('driver sync'):
+                    DeployDriverDefault().sync(kwargs)
+            finally:
+                self._locker.stop_heartbeat()
 
             # Clean-up
-            self.deploy_log.log_archive()
-            if self._locker.check_lock():
-                self._locker.remove_lock()
+            self._archive_log_and_unlock(check_lock=True)
 
         logline = 'SYNC successful!'
         self.deploy_log.log('user(' + self.config['user.name'] +
@@ -233,8 +315,8 @@ class GitDeploy(object):
         #
         # Rollback to tag:
         #
-        #   1. get a commit list
-        #   2. perform no-commit reverts
+        #   1. check the tag is an ancestor of HEAD
+        #   2. restore the tag's tree in the index and working tree
         #   3. commit
         #
 
@@ -244,18 +326,18 @@ class GitDeploy(object):
                             ') ' + logline)
 
         tag_commit_sha = GitMethods()._get_commit_sha_for_tag(tag)
-        commit_sha = None
-        for commit_sha in GitMethods()._git_commit_list():
-            if commit_sha == tag_commit_sha:
-                break
-            GitMethods()._git_revert(commit_sha)
-
-        # Ensure the commit tag was matched
-        if commit_sha != tag_commit_sha or not commit_sha:
-            GitMethods()._dulwich_reset_to_tag()
+        commits = GitMethods()._git_commits_since(tag_commit_sha)
+
+        # Ensure the tag commit is an ancestor of HEAD
+        if commits is None:
             raise GitDeployError(message=exit_codes[35], exit_code=35)
-        GitMethods()._dulwich_commit(GitMethods()._make_author(),
-                                     message='Rollback to {0}.'.format(tag))
+
+        log.info(__name__ + ' :: REVERT -> {0} commit(s) to revert'.format(
+            len(commits)))
+
+        GitMethods()._dulwich_rollback(tag_commit_sha,
+                                       GitMethods()._make_author(),
+                                       message='Rollback to {0}.'.format(tag))
 
         logline = 'REVERT -> Reverted to tag: \'{0}\', call "git deploy ' \
                   'sync" to persist'.format(tag)
@@ -268,12 +350,13 @@ class GitDeploy(object):
 
         return 0
 
-    def finish(self):
+    def finish(self, _):
         """
         * Remove lock file
         """
         if self._locker.check_lock():
             self._locker.remove_lock()
+        return 0
 
     def show_tag(self, _):
         """
@@ -285,46 +368,83 @@ class GitDeploy(object):
 
     def log_deploys(self, args):
         """
-            * show last x deploys
+            * show the last x deploys, newest first, after the --skip newest
+            * filter by --env, --author, --since and --until
+            * --json emits one JSON object per deploy
         """
         # Get number of deploy tags to emit
         try:
             num_tags = args.count
-        except NameError:
+        except AttributeError:
             raise GitDeployError(message=exit_codes[10], exit_code=10)
 
-        tags = GitMethods()._get_deploy_tags()
-
-        if num_tags <= len(tags):
-            tags = tags[:num_tags]
-
-        for tag in tags:
-            print tag
+        deploys = GitMethods()._get_deploy_history(
+            num_tags,
+            skip=getattr(args, 'skip', 0),
+            env=getattr(args, 'env', None),
+            author=getattr(args, 'author', None),
+            since=_parse_time(getattr(args, 'since', None)),
+            until=_parse_time(getattr(args, 'until', None)))
+
+        for deploy in deploys:
+            if getattr(args, 'json', False):
+                print json.dumps({'tag': deploy.tag,
+                                  'sha': deploy.sha,
+                                  'commit_time': deploy.time,
+                                  'author': deploy.author,
+                                  'env': deploy.env})
+            else:
+                print deploy.tag
         return 0
 
-    def diff(self, _):
+    def diff(self, args):
         """
             * show a git diff of the last deploy and it's previous deploy
+            * --stat or --name-only summarise it, --find-renames detects
+              renames, paths after the method limit it to those paths
         """
 
-        tags = GitMethods()._get_deploy_tags()
+        deploys = GitMethods()._get_deploy_history(2)
 
-        # Check the return code & whether at least two sync tags were
-        # returned
-        if len(tags) < 2:
+        # Check whether at least two sync tags were returned
+        if len(deploys) < 2:
             raise GitDeployError(message=exit_codes[7], exit_code=7)
 
-        # Get the associated commit hashes for those tags
-        sha_1 = GitMethods()._get_commit_sha_for_tag(tags[0])
-        sha_2 = GitMethods()._get_commit_sha_for_tag(tags[1])
+        fmt = 'patch'
+        if getattr(args, 'stat', False):
+            fmt = 'stat'
+        elif getattr(args, 'name_only', False):
+            fmt = 'name-only'
 
-        # Produce the diff
-        lines = GitMethods()._git_diff(sha_1, sha_2)
-        for line in lines:
-            print line
+        # Produce the diff from the previous deploy to the latest, written
+        # as it is generated
+        try:
+            chunks = GitMethods()._git_diff(
+                deploys[1].sha, deploys[0].sha, fmt=fmt,
+                paths=getattr(args, 'ordered_args', [])[1:],
+                renames=getattr(args, 'find_renames', False))
+        except GitMethodsError as e:
+            raise GitDeployError(message=e.message, exit_code=e.exit_code)
+        for chunk in chunks:
+            sys.stdout.write(chunk)
 
         return 0
 
+    def profile(self, args):
+        """
+            * show where the time of the last x traced runs went
+        """
+        # Don't record this run itself
+        get_tracer().disable()
+
+        runs = load_runs(self.DEPLOY_DIR + TRACE_FILE, args.count)
+        if not runs:
+            raise GitDeployError(message=exit_codes[45], exit_code=45)
+
+        for line in format_profile(runs):
+            print line
+        return 0
+
     def dummy(self, args):
         """
         dummy method to test the entry point.
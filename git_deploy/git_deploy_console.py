@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+    git_deploy.git_deploy_console
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Command line entry point of git-deploy.  With git config deploy.daemon
+    set commands are handed to a long-running git-deploy daemon, see
+    git_deploy.daemon, and run in this process if it is unavailable.
+
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import sys
+import argparse
+
+# git_deploy.git_deploy is imported by main, a command handed to the daemon
+# only needs the config
+from config import set_log, log, exit_codes, config_bool, \
+    configure, GitDeployConfigError
+
+
+def parseargs(argv=None):
+    """Parse command line arguments, :data:`sys.argv` if argv is None.
+
+    Returns *args*, the list of arguments left over after processing.
+
+    """
+    parser = argparse.ArgumentParser(
+        description="This script serves as the entry point for git deploy.",
+        epilog="",
+        conflict_handler="resolve",
+        usage="git-deploy method [remote] [branch]"
+              "\n\t[-q --quiet] \n\t[-s --silent] "
+              "\n\t[-v --verbose] \n\t[-c --count [0-9]+] \n\t[-f --force] "
+              "\n\t[-t --tag] \n\t[-a --auto_sync] "
+              "\n\t[-y --sync SCRIPT NAME] "
+              "\n\t[--skip [0-9]+] \n\t[--author PATTERN] "
+              "\n\t[--since DATE] \n\t[--until DATE] \n\t[--json] "
+              "\n\t[--stat] \n\t[--name-only] \n\t[-M --find-renames] "
+              "\n\nmethod=[start|sync|abort|revert|diff|show_tag|"
+              "log_deploys|finish|profile]"
+    )
+
+    parser.allow_interspersed_args = False
+
+    defaults = {
+        "quiet": 0,
+        "silent": False,
+        "verbose": 1,
+    }
+
+    # Global options.
+    parser.add_argument('ordered_args', metavar='ordered_args', type=str,
+                        nargs='+', help='Specifies the git deploy method and '
+                                        'additional args depending on the '
+                                        'method called.')
+    parser.add_argument("-c", "--count",
+                        default=1, type=int,
+                        help="number of tags to log, or runs to profile")
+    parser.add_argument("-q", "--quiet",
+                        default=defaults["quiet"], action="count",
+                        help="decrease the logging verbosity")
+    parser.add_argument("-s", "--silent",
+                        default=defaults["silent"], action="store_true",
+                        help="silence the logger")
+    parser.add_argument("-v", "--verbose",
+                        default=defaults["verbose"], action="count",
+                        help="increase the logging verbosity")
+    parser.add_argument("-f", "--force",
+                        action="store_true",
+                        help="force the action, bypass sanity checks.")
+    parser.add_argument("-t", "--tag",
+                        default='', type=str,
+                        help="Specify the tag for the revert action.")
+    parser.add_argument("-a", "--auto_sync",
+                        default='', action="store_true",
+                        help="Auto sync flag.")
+    parser.add_argument("-D", "--default", action='store_true',
+                        help="Flag to override with default sync.")
+    parser.add_argument("-e", "--env",
+                        default='', type=str,
+                        help="Environment to deploy to, or of the "
+                             "deploys to log.")
+    parser.add_argument("-d", "--dryrun",
+                        action='store_true',
+                        help="Execute as a dryrun.")
+    parser.add_argument("-r", "--release",
+                        action='store_true',
+                        help="Add release tag in sync.")
+    parser.add_argument("-g", "--group",
+                        default='', type=str,
+                        help="Target group to sync to, see "
+                             "deploy.group.<name> in git config.")
+
+    parser.add_argument("--skip",
+                        default=0, type=int,
+                        help="number of most recent deploys not to log")
+    parser.add_argument("--author",
+                        default='', type=str,
+                        help="log only deploys by authors matching this "
+                             "pattern")
+    parser.add_argument("--since",
+                        default='', type=str,
+                        help="log only deploys of commits from this date, "
+                             "YYYY-MM-DD[THH:MM:SS] or seconds since the "
+                             "epoch")
+    parser.add_argument("--until",
+                        default='', type=str,
+                        help="log only deploys of commits up to this date")
+    parser.add_argument("--json",
+                        action='store_true',
+                        help="log deploys as JSON lines")
+
+    parser.add_argument("--stat",
+                        action='store_true',
+                        help="diff: show changed line counts per file")
+    parser.add_argument("--name-only",
+                        action='store_true',
+                        help="diff: show only the changed paths")
+    parser.add_argument("-M", "--find-renames",
+                        action='store_true',
+                        help="diff: detect renamed files")
+
+    args = parser.parse_args(argv)
+    return args
+
+
+def main(out=None, err=None, argv=None):
+    """Main entry point.
+
+    Returns a value that can be understood by :func:`sys.exit`.
+
+    :param argv: a list of command line arguments, :data:`sys.argv` if None.
+    :param out: stream to write messages; :data:`sys.stdout` if None.
+    :param err: stream to write error messages; :data:`sys.stderr` if None.
+    """
+    from git_deploy import GitDeployError, GitDeploy
+    from tracing import span
+
+    if out is None:  # pragma: nocover
+        out = sys.stdout
+    if err is None:  # pragma: nocover
+        err = sys.stderr
+    args = parseargs(argv)
+    set_log(args, out, err)
+
+    log.debug("git-deploy is ready to run")
+
+    # Inline call to functionality - if GitDeploy does not possess this
+    #  attribute flag with logger
+    if not args.ordered_args[0]:
+        log.error(exit_codes[3])
+        print args.help
+        return
+
+    # Set up GitDeploy - an unknown lock backend is reported here
+    try:
+        GitDeploy()
+    except (GitDeployError, GitDeployConfigError) as e:
+        log.error(__name__ + ' :: GIT DEPLOY FAILED -> ' + e.message)
+        return e.exit_code
+
+    method_exists = hasattr(GitDeploy(), args.ordered_args[0])
+
+    if not hasattr(GitDeploy(), args.ordered_args[0]):
+        log.error(exit_codes[60])
+        return
+
+    method_callable = callable(getattr(GitDeploy(), args.ordered_args[0]))
+    if method_exists and method_callable:
+
+        try:
+            with span('git-deploy ' + args.ordered_args[0]):
+                getattr(GitDeploy(), args.ordered_args[0])(args)
+
+        except (GitDeployError, GitDeployConfigError) as e:
+
+            log.error(__name__ + ' :: GIT DEPLOY FAILED -> ' + e.message)
+
+            if GitDeploy()._locker.check_lock():
+                log.info(__name__ + ' :: ABORTING DEPLOY -> Removing lock.')
+
+                try:
+                    GitDeploy()._locker.remove_lock()
+                except Exception as e:
+                    log.error(__name__ + ' :: Could not remove lock '
+                                         '-> "{0}".'.format(e.message))
+
+            if hasattr(e, 'exit_code'):
+                return e.exit_code
+            else:
+                return -1
+
+    else:
+        log.error(__name__ + ' :: No function called %(method)s.' % {
+            'method': args.ordered_args[0]})
+
+    return 0
+
+
+def use_daemon():
+    """
+    Whether commands go to the daemon - git config deploy.daemon, unless
+    $GIT_DEPLOY_NO_DAEMON is set
+    """
+    from daemon import NO_DAEMON_ENV
+    if os.environ.get(NO_DAEMON_ENV):
+        return False
+    try:
+        return config_bool(configure()['deploy.daemon'])
+    except GitDeployConfigError:
+        return False
+
+
+def cli():
+    if use_daemon():
+        from daemon import call
+        exit_code = call(sys.argv[1:])
+        if exit_code is not None:
+            sys.exit(exit_code)
+    sys.exit(main())
@@ -7,20 +7,18 @@ __license__ = 'GPL v2.0 (or later)'
 
 import sys
 import os
+import stat
 import subprocess
 from datetime import datetime
 
 from re import search
 from collections import OrderedDict
 
-from dulwich import walk
-from dulwich import index
-from dulwich import porcelain
-from dulwich.repo import Repo
-from dulwich.diff_tree import tree_changes
-from dulwich.porcelain import push, pull, commit, tag
-
-from config import log, exit_codes, configure
+# dulwich is imported by the methods using it, commands that only read the
+# tag index (show_tag, log_deploys) start without loading it
+from config import log, exit_codes, configure, config_bool
+from tag_index import TagIndex, ENV_TRAILER
+from tracing import traced, get_tracer, RUN_ID_ENV, TRACE_FILE
 
 
 class GitMethodsError(Exception):
@@ -34,6 +32,22 @@ class GitMethodsError(Exception):
         return self._exit_code
 
 
+def _index_entry_matches(entry, st):
+    """ Compare an index entry with the stat data of its file """
+    from dulwich import index
+    mtime = entry.mtime[0] if isinstance(entry.mtime, tuple) \
+        else int(entry.mtime)
+    return (entry.mode == index.cleanup_mode(st.st_mode) and
+            entry.size == st.st_size and entry.ino == st.st_ino and
+            mtime == int(st.st_mtime))
+
+
+def _blob_from_change(change):
+    """ Read a blob for a (tree path, full path, stat) tuple """
+    from dulwich import index
+    return index.blob_from_path_and_stat(change[1], change[2])
+
+
 class GitMethods(object):
 
     # Module level attribute for tagging datetime format
@@ -65,12 +79,22 @@ class GitMethods(object):
     def _configure(self, **kwargs):
         self.config = configure(**kwargs)
 
+        # In a hook, such as default.sync, the spans join the traced run
+        if config_bool(self.config['deploy.trace']) and \
+                os.environ.get(RUN_ID_ENV):
+            get_tracer().join(os.path.join(self.config['top_dir'], '.git',
+                                           'deploy', TRACE_FILE))
+
     def _get_latest_deploy_tag(self):
         """
         Returns the latest tag containing 'sync'
         Sets self._tag to tag string
         """
-        return self._get_deploy_tags()[-1]
+        f = lambda x: search(self.config['repo_name'] + '-sync-', x)
+        tag = self._get_tag_index().latest(match=f)
+        if tag is None:
+            raise GitMethodsError(message=exit_codes[11], exit_code=11)
+        return tag
 
     def _get_deploy_tags(self):
         """
@@ -78,15 +102,78 @@ class GitMethods(object):
         """
         # 1. Pull last 'num_tags' sync tags
         # 2. Filter only matched deploy tags
-        tags = GitMethods()._dulwich_get_tags().keys()
+        tags = self._get_tag_index().tags().keys()
         f = lambda x: search(self.config['repo_name'] + '-sync-', x)
         return filter(f, tags)
 
+    def _get_deploy_history(self, num, skip=0, env=None, author=None,
+                            since=None, until=None):
+        """
+        Returns the `num` most recent deploy tags after the `skip` most
+        recent ones, newest first, as a list of tag_index.TagInfo.
+
+        :param env:     only deploys to this environment
+        :param author:  only deploys whose author matches this pattern
+        :param since:   only commits from this time (seconds since epoch)
+        :param until:   only commits up to this time (seconds since epoch)
+        """
+        prefix = self.config['repo_name'] + '-sync-'
+
+        def match(info):
+            return (search(prefix, info.tag) and
+                    (not env or info.env == env) and
+                    (not author or search(author, info.author)) and
+                    (since is None or info.time >= since) and
+                    (until is None or info.time <= until))
+
+        return self._get_tag_index().newest(num, skip=skip, match=match)
+
+    def _get_tag_index(self):
+        """
+        Returns the persistent tag index for the repo, one per top_dir
+        """
+        top_dir = self.config['top_dir']
+        if getattr(self, '_tag_index_dir', None) != top_dir:
+            self._tag_index = TagIndex(top_dir, get_repo=self._get_repo)
+            self._tag_index_dir = top_dir
+        return self._tag_index
+
+    def _get_repo(self):
+        """
+        Returns the repo handle shared by the methods, one per top_dir.  The
+        handle is reopened once a ref changed.  Objects are read through a
+        cache bounded by deploy.object-cache-mb, kept across handles as
+        objects never change.
+        """
+        from repo_cache import CachedRepo, ObjectCache, refs_signature
+
+        top_dir = self.config['top_dir']
+        signature = refs_signature(os.path.join(top_dir, '.git'))
+        handle = getattr(self, '_repo_handle', None)
+        if handle and handle[0] == top_dir and handle[1] == signature:
+            return handle[2]
+
+        if handle:
+            handle[2].close()
+        if not handle or handle[0] != top_dir:
+            self._object_cache = ObjectCache(
+                int(self.config['deploy.object_cache_mb']) * 1024 * 1024)
+        _repo = CachedRepo(top_dir, self._object_cache)
+        self._repo_handle = (top_dir, signature, _repo)
+        return _repo
+
     def _make_tag(self, tag_type):
         timestamp = datetime.now().strftime(self.DATE_TIME_TAG_FORMAT)
         return '{0}-{1}-{2}'.format(self.config['repo_name'], tag_type,
                                     timestamp)
 
+    def _make_tag_message(self, env=None):
+        """ Deploy tag message, with a trailer naming the environment """
+        if not env:
+            return self.DEFAULT_TAG_MSG
+        return '{0}\n\n{1}: {2}\n'.format(self.DEFAULT_TAG_MSG, ENV_TRAILER,
+                                          env)
+
     def _make_author(self):
         return '{0} <{1}>'.format(self.config['user.name'],
                                   self.config['user.email'])
@@ -95,31 +182,71 @@ class GitMethods(object):
         """
         Generate an in-order list of commits
         """
-        _repo = Repo(self.config['top_dir'])
+        return list(self._git_commit_walk())
+
+    def _git_commit_walk(self, exclude=None):
+        """
+        Yield the shas of commits reachable from HEAD, newest first
+
+        :param exclude: commit shas whose ancestry ends the walk
+        """
+        from dulwich import walk
+        _repo = self._get_repo()
+
+        for entry in _repo.get_walker(exclude=exclude, order=walk.ORDER_DATE):
+            yield entry.commit.id
+
+    @traced('git commits since')
+    def _git_commits_since(self, commit_sha):
+        """
+        Returns the shas of the commits between HEAD and `commit_sha`, newest
+        first, without walking past `commit_sha`.  Returns None when
+        `commit_sha` is not an ancestor of HEAD.
+
+        :param commit_sha: ancestor commit sha to stop at
+        """
+        from dulwich import walk
+        _repo = self._get_repo()
+
+        if _repo.head() == commit_sha:
+            return []
 
         commits = []
-        for entry in _repo.get_walker(order=walk.ORDER_DATE):
+        reached = False
+        for entry in _repo.get_walker(exclude=[commit_sha],
+                                      order=walk.ORDER_DATE):
             commits.append(entry.commit.id)
+            if commit_sha in entry.commit.parents:
+                reached = True
 
-        return commits
+        return commits if reached else None
 
-    def _git_diff(self, sha_1, sha_2):
+    def _git_diff(self, sha_1, sha_2, fmt='patch', paths=None,
+                  renames=False):
         """Produce the diff between sha1 & sha2
 
+        Returns a generator of output chunks, the trees are only walked as
+        it is consumed.  See deploy_diff.
+
         :param sha_1: commit sha of "before" state
-        :param sha_2: commit sha of "before" state
+        :param sha_2: commit sha of "after" state
+        :param fmt: 'patch', 'stat' or 'name-only'
+        :param paths: only files at or below these paths
+        :param renames: detect renamed files
         """
-        _repo = Repo(self.config['top_dir'])
-
-        c_old = _repo.get_object(sha_1)
-        c_new = _repo.get_object(sha_1)
+        from deploy_diff import iter_changes, format_changes
+        _repo = self._get_repo()
 
-        # default writes to stdout
         try:
-            porcelain.diff_tree(_repo, c_old.tree, c_new.tree)
-        except:
+            tree_old = _repo[sha_1].tree
+            tree_new = _repo[sha_2].tree
+        except (KeyError, AttributeError):
             raise GitMethodsError(message=exit_codes[6], exit_code=6)
 
+        changes = iter_changes(_repo.object_store, tree_old, tree_new,
+                               paths=paths, renames=renames)
+        return format_changes(_repo.object_store, changes, fmt)
+
     def _git_revert(self, commit_sha):
         """Perform a no-commit revert
 
@@ -136,32 +263,114 @@ class GitMethods(object):
         if proc.returncode != 0:
             raise GitMethodsError(message=exit_codes[33], exit_code=33)
 
+    @traced('git rollback')
+    def _dulwich_rollback(self, commit_sha, author, message):
+        """Commit the tree of `commit_sha` on top of HEAD
+
+        The index and working tree are updated only for the paths that
+        differ between HEAD and `commit_sha`, the index is written once and
+        the result is committed with the target tree.  Returns the sha of
+        the new commit.
+
+        :param commit_sha: commit sha whose tree is restored
+        :param author: author string
+        :param message: commit message
+        """
+        from dulwich import index
+        from dulwich.objects import S_ISGITLINK
+        from dulwich.diff_tree import tree_changes
+        _repo = self._get_repo()
+        store = _repo.object_store
+        target_tree = _repo[commit_sha].tree
+        _index = _repo.open_index()
+
+        removed, added = [], []
+        for change in tree_changes(store, _repo[_repo.head()].tree,
+                                   target_tree):
+            if change.old.path is not None:
+                removed.append(change.old)
+            if change.new.path is not None:
+                added.append(change.new)
+
+        # Remove first, a removed file may be replaced by a directory
+        for entry in removed:
+            full_path = os.path.join(self.config['top_dir'], entry.path)
+            # A symlink to a directory is removed, not followed
+            if os.path.lexists(full_path) and \
+                    not stat.S_ISDIR(os.lstat(full_path).st_mode):
+                os.remove(full_path)
+            if entry.path in _index:
+                del _index[entry.path]
+            self._remove_empty_dirs(os.path.dirname(full_path))
+
+        for entry in added:
+            full_path = os.path.join(self.config['top_dir'], entry.path)
+            if not os.path.exists(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            if S_ISGITLINK(entry.mode):
+                if not os.path.isdir(full_path):
+                    os.mkdir(full_path)
+                st = os.lstat(full_path)
+            else:
+                st = index.build_file_from_blob(store[entry.sha], entry.mode,
+                                                full_path)
+            _index[entry.path] = index.index_entry_from_stat(st, entry.sha,
+                                                             0, entry.mode)
+
+        _index.write()
+        return _repo.do_commit(message, committer=author, author=author,
+                               tree=target_tree)
+
+    def _remove_empty_dirs(self, path):
+        """ Remove `path` and its parents up to top_dir while empty """
+        top_dir = os.path.abspath(self.config['top_dir'])
+        path = os.path.abspath(path)
+        while path.startswith(top_dir + os.sep):
+            try:
+                os.rmdir(path)
+            except OSError:
+                break
+            path = os.path.dirname(path)
+
     def _get_commit_sha_for_tag(self, tag):
         """Obtain the commit sha of an associated tag
 
         :param tag: git tag to match to commit sha
         """
-        for repo_tag, commit_obj in self._dulwich_get_tags():
-            if tag == repo_tag:
-                return commit_obj.id
+        _repo = self._get_repo()
+
+        # Read and peel only this tag's ref
+        try:
+            return _repo.object_store.peel_sha(
+                _repo.refs['refs/tags/' + tag]).id
+        except KeyError:
+            pass
+
+        entry = self._get_tag_index().get(tag)
+        if entry is not None:
+            return entry[0]
 
         raise GitMethodsError(message=exit_codes[8], exit_code=8)
 
+    @traced('git tag')
     def _dulwich_tag(self, tag_text, author, message=DEFAULT_TAG_MSG):
         """
-        Creates a tag in git via dulwich calls:
+        Creates an annotated tag in git via dulwich calls, the message
+        carries the environment trailer:
 
         :param tag_text:    tag string
         :param author:      author string
         :param message:     message string
         """
-        tag(self.config['top_dir'], tag_text, author, message)
+        from dulwich.porcelain import tag_create
+        tag_create(self.config['top_dir'], tag_text, author, message,
+                   annotated=True)
 
     def _dulwich_reset_to_tag(self, tag=None):
         """
         Resets the HEAD to the commit
         """
-        _repo = Repo(self.config['top_dir'])
+        _repo = self._get_repo()
 
         if not tag:
             sha = _repo.head()
@@ -173,62 +382,149 @@ class GitMethods(object):
         except AttributeError:
             raise GitMethodsError(message=exit_codes[7], exit_code=7)
 
+    @traced('git stage all')
     def _dulwich_stage_all(self):
         """
-        Stage modified files in the repo
+        Stage new and modified files in the repo
+
+        Files whose mode, size, inode and mtime match their index entry are
+        skipped without being read.  Changed files are hashed, on a thread
+        pool when deploy.stage-workers is above 1, and the index is written
+        once.
         """
-        _repo = Repo(self.config['top_dir'])
+        from dulwich import index
+        _repo = self._get_repo()
+        _index = _repo.open_index()
+
+        # Files modified in the same second as the index was written can't
+        # be told apart by mtime, always hash those
+        try:
+            index_mtime = int(os.stat(_repo.index_path()).st_mtime)
+        except OSError:
+            index_mtime = 0
+
+        changed = []
+        for root, dirs, files in os.walk(self.config['top_dir']):
+            if '.git' in dirs:
+                dirs.remove('.git')
+            for filename in files:
+                full_path = os.path.join(root, filename)
+                st = os.lstat(full_path)
+                if not (stat.S_ISREG(st.st_mode) or
+                        stat.S_ISLNK(st.st_mode)):
+                    continue
+
+                tree_path = os.path.relpath(
+                    full_path, self.config['top_dir']).replace(os.sep, '/')
+                if tree_path in _index and \
+                        int(st.st_mtime) < index_mtime and \
+                        _index_entry_matches(_index[tree_path], st):
+                    continue
+                changed.append((tree_path, full_path, st))
+
+        if not changed:
+            return
+
+        log.info(__name__ + ' :: Staging - {0}'.format(
+            [change[0] for change in changed]))
+
+        workers = int(self.config['deploy.stage_workers'])
+        if workers > 1 and len(changed) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(workers)
+            try:
+                blobs = pool.map(_blob_from_change, changed)
+            finally:
+                pool.close()
+        else:
+            blobs = map(_blob_from_change, changed)
 
-        # Iterate through files, those modified will be staged
-        for elem in os.walk(self.config['top_dir']):
-            relative_path = elem[0].split('./')[-1]
-            if not search(r'\.git', elem[0]):
-                files = [relative_path + '/' +
-                         filename for filename in elem[2]]
-                log.info(__name__ + ' :: Staging - {0}'.format(files))
-                _repo.stage(files)
+        for (tree_path, _, st), blob in zip(changed, blobs):
+            _repo.object_store.add_object(blob)
+            _index[tree_path] = index.index_entry_from_stat(st, blob.id, 0)
+        _index.write()
 
+    @traced('git commit')
     def _dulwich_commit(self, author, message=DEFAULT_COMMIT_MSG):
         """
         Commit staged files in the repo
         """
+        from dulwich.porcelain import commit
         commit(self.config['top_dir'], message=message, author=author)
 
+    @traced('git status')
     def _dulwich_status(self):
         """
         Return the git status
         """
-        _repo = Repo(self.config['top_dir'])
+        from dulwich.diff_tree import tree_changes
+        _repo = self._get_repo()
         index = _repo.open_index()
         return list(tree_changes(_repo, index.commit(_repo.object_store),
                                  _repo['HEAD'].tree))
 
+    @traced('git get tags')
     def _dulwich_get_tags(self):
         """
-        Get all tags & correspondin commit shas
-        """
-        _repo = Repo(self.config['top_dir'])
-        tags = _repo.refs.as_dict("refs/tags")
-        ordered_tags = {}
-        # Get the commit hashes associated with the tags
-        for tag, tag_commit in tags.items():
-            if tag not in ordered_tags:
-                ordered_tags[tag] = _repo.object_store.peel_sha(tag_commit)
-        # Sort by commit_time, then by tag name, as multiple tags can have
-        # the same commit_time for their commits
-        ordered_tags = OrderedDict(sorted(ordered_tags.items(),
-                                          key=lambda t: (t[1].commit_time, t)))
-        return ordered_tags
+        Get all tags & correspondin commit objects, ordered by commit_time
+        and then by tag name.  Peeling and ordering come from the tag index.
+        """
+        _repo = self._get_repo()
+        return OrderedDict((tag, _repo[sha]) for tag, (sha, _) in
+                           self._get_tag_index().tags().iteritems())
 
+    @traced('git push')
     def _dulwich_push(self, remote_location, refs_path):
-        """Remote push with dulwich.porcelain
+        """Remote push with dulwich.client
+
+        The refs the remote advertises are compared with the local ones
+        first.  Refs already up to date are left out and if none remain no
+        pack is sent.  Otherwise the pack only holds the objects the remote
+        is missing - those reachable from its refs are left out.
 
-        :param repo : Path to repository
         :param remote_location: Location of the remote
-        :param refs_path: relative path to the refs to push to remote
+        :param refs_path: remote ref to update from the local ref of the
+            same name, or a dict of remote ref -> local ref
+        :return: dict of remote ref -> sha for the refs updated
         """
-        push(self.config['top_dir'], remote_location, refs_path)
+        from dulwich.client import get_transport_and_path
+        from dulwich.errors import GitProtocolError, NotGitRepository
 
+        _repo = self._get_repo()
+        if not isinstance(refs_path, dict):
+            refs_path = {refs_path: refs_path}
+        try:
+            local_refs = dict((remote_ref, _repo.refs[local_ref])
+                              for remote_ref, local_ref in
+                              refs_path.iteritems())
+        except KeyError as e:
+            log.error('{0} :: Missing local ref {1}'.format(__name__, e))
+            raise GitMethodsError(message=exit_codes[46], exit_code=46)
+
+        updated = {}
+
+        def update_refs(remote_refs):
+            for remote_ref, sha in local_refs.iteritems():
+                if remote_refs.get(remote_ref) != sha:
+                    updated[remote_ref] = sha
+            return dict(updated)
+
+        client, path = get_transport_and_path(
+            remote_location, config=_repo.get_config_stack())
+        try:
+            client.send_pack(
+                path, update_refs,
+                generate_pack_data=_repo.object_store.generate_pack_data)
+        except (GitProtocolError, NotGitRepository) as e:
+            log.error('{0} :: Push to {1} failed -> {2}'.format(
+                __name__, remote_location, e))
+            raise GitMethodsError(message=exit_codes[46], exit_code=46)
+
+        log.info('{0} :: Pushed to {1} - {2}'.format(
+            __name__, remote_location, sorted(updated) or 'up to date'))
+        return updated
+
+    @traced('git pull')
     def _dulwich_pull(self, remote_location, refs_path, errstream=sys.stderr):
         """ Pull from remote via dulwich.porcelain
 
@@ -236,10 +532,12 @@ class GitMethods(object):
         :param remote_location: Location of the remote
         :param refs_path: relative path to the fetched refs
         """
+        from dulwich.porcelain import pull
         pull(self.config['top_dir'], remote_location, refs_path)
 
     def _dulwich_checkout(self, _repo):
         """ Perform 'git checkout .' - syncs staged changes """
+        from dulwich import index
 
         indexfile = _repo.index_path()
         tree = _repo["HEAD"].tree
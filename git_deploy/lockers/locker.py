@@ -5,8 +5,21 @@ Locking model that allows customized deploy locking bahaviour
 __date__ = '2013-12-20'
 __license__ = 'GPL v2.0 (or later)'
 
+import os
+import time
+import fcntl
+import shutil
+import socket
+import threading
+
+from pipes import quote
+from contextlib import contextmanager
+
 from git_deploy.utils import ssh_command_target
-from git_deploy.config import exit_codes, log, deploy_log
+from git_deploy.config import exit_codes, log
+from git_deploy import config
+from git_deploy.tracing import traced
+
 
 class DeployLockerError(Exception):
     """ Basic exception class for DeployLocker types """
@@ -49,19 +62,37 @@ class DeployLocker(object):
         """
         raise NotImplementedError()
 
+    def renew_lock(self):
+        """
+        lease renewal, for lockers whose locks expire
+        """
+        raise NotImplementedError()
+
+    def start_heartbeat(self, interval=None):
+        """
+        periodic lease renewal, a no-op for lockers without leases
+        """
+        pass
+
+    def stop_heartbeat(self):
+        """
+        stop periodic lease renewal
+        """
+        pass
+
 
-class DeployLockerDefault(DeployLocker):
+class DeployLockerLease(DeployLocker):
     """
-    Default Locker class - implements a lock file
+    Base class for lockers that keep a lock directory holding a `holder`
+    file, which names the user, host and pid that took the lock and when
+    its lease expires.  A lease of 0 never expires.
     """
 
-    # class instance
-    __instance = None
+    # Name of the file holding the lock metadata
+    HOLDER_FILE = 'holder'
 
     def __init__(self, *args, **kwargs):
         """ Initialize class instance """
-        self.__class__.__instance = self
-
         try:
             self.deploy_path = kwargs['deploy_path']
             self.target = kwargs['target']
@@ -72,6 +103,102 @@ class DeployLockerDefault(DeployLocker):
         except KeyError:
             raise DeployLockerError(message=exit_codes[18], exit_code=18)
 
+        self.lease = int(kwargs.get('lease', 0))
+
+        # Cached (held, local expiry time) of the last lock check
+        self._cached = None
+        self._heartbeat = None
+
+    def get_lock_name(self):
+        """ Generates the name of the lock directory """
+        return self.lock_handle + '.lock'
+
+    def _lock_path(self):
+        return '{0}/{1}'.format(self.deploy_path.rstrip('/'),
+                                self.get_lock_name())
+
+    def _parse_holder(self, lines):
+        """ Parse key=value lines of the holder file and the remote time """
+        holder = {}
+        for line in lines:
+            key, _, value = line.partition('=')
+            holder[key] = value
+        return holder
+
+    def _holds(self, holder):
+        """ Whether the holder data names this user with a live lease """
+        if holder.get('user') != self.user:
+            return False
+        try:
+            expires, now = int(holder['expires']), int(holder['now'])
+        except (KeyError, ValueError):
+            return False
+        return not expires or expires >= now
+
+    def _cache(self, held, holder=None):
+        """
+        Remember a held lock until its lease runs out.  Locks without a
+        lease, and locks not held, are checked again every time.
+        """
+        self._cached = None
+        if held and holder and int(holder.get('expires') or 0):
+            expiry = time.time() + int(holder['expires']) - \
+                int(holder['now'])
+            self._cached = (held, expiry)
+
+    def start_heartbeat(self, interval=None):
+        """
+        Renew the lease every `interval` seconds, a third of the lease by
+        default, from a background thread until stop_heartbeat is called.
+        """
+        if not self.lease or self._heartbeat:
+            return
+
+        stop = threading.Event()
+        interval = interval or max(self.lease / 3.0, 1)
+
+        def beat():
+            while not stop.wait(interval):
+                try:
+                    self.renew_lock()
+                except DeployLockerError:
+                    log.error('{0} :: Lease renewal failed.'.format(
+                        __name__))
+
+        thread = threading.Thread(target=beat, name='lock-heartbeat')
+        thread.daemon = True
+        thread.start()
+        self._heartbeat = (stop, thread)
+
+    def stop_heartbeat(self):
+        """ Stop renewing the lease """
+        if self._heartbeat:
+            stop, thread = self._heartbeat
+            stop.set()
+            thread.join()
+            self._heartbeat = None
+
+
+class DeployLockerDefault(DeployLockerLease):
+    """
+    Default Locker class - implements a lock directory on the target
+
+    The lock is taken with a single remote `mkdir`, which is atomic.  A lock
+    whose lease has expired is reclaimed by the next `add_lock`, by renaming
+    it away, which is atomic too.
+
+    Checks of a held lock with a lease are cached locally - only the holder
+    can release the lock, so it stays held until the lease runs out.
+    """
+
+    # class instance
+    __instance = None
+
+    def __init__(self, *args, **kwargs):
+        """ Initialize class instance """
+        self.__class__.__instance = self
+        super(DeployLockerDefault, self).__init__(*args, **kwargs)
+
     def __new__(cls, *args, **kwargs):
         """ This class is Singleton, return only one instance """
         if not cls.__instance:
@@ -80,72 +207,272 @@ class DeployLockerDefault(DeployLocker):
                                                                      **kwargs)
         return cls.__instance
 
-    def get_lock_name(self):
-        """ Generates the name of the lock file """
-        return self.lock_handle + '-' + self.user + '.lock'
-
-    def add_lock(self):
-        """ Write the lock file """
-
-        cmd = "touch {0}/{1}".format(self.deploy_path,
-                                     self.get_lock_name())
+    def _ssh(self, cmd):
+        """ Run a lock command on the target, returns its stdout lines """
         try:
-            ssh_command_target(cmd, self.target, self.user,
+            ret = ssh_command_target(cmd, self.target, self.user,
                                      self.key_path)
         except Exception as e:
-            log.error(__name__ + ' :: Failed to create lock -> ' + e.message)
+            log.error(__name__ + ' :: ' + str(e))
             raise DeployLockerError(message=exit_codes[16], exit_code=16)
+        return ret['stdout']
+
+    @traced('lock add')
+    def add_lock(self):
+        """
+        Take the lock in one round-trip - create the lock directory, or
+        replace it if its lease has expired, then write the holder file.
+
+        An expired lock is first renamed to a name unique to this call, so
+        that of several deployers reclaiming it only one gets it.  It is
+        only replaced if the renamed holder file is still the expired one,
+        otherwise another deployer reclaimed it in between and it is put
+        back.
+        """
+        path = quote(self._lock_path())
+        holder = quote(self._lock_path() + '/' + self.HOLDER_FILE)
+        cmd = (
+            'now=$(date +%s); stale={path}.stale.$$; '
+            'if mkdir {path} 2>/dev/null || {{ '
+            'old=$(cat {holder} 2>/dev/null); '
+            'exp=$(printf "%s\\n" "$old" | sed -n "s/^expires=//p"); '
+            '[ -n "$exp" ] && [ "$exp" != 0 ] && [ "$exp" -lt "$now" ] && '
+            'mv {path} "$stale" 2>/dev/null && '
+            'if [ "$(cat "$stale"/{holder_file} 2>/dev/null)" = "$old" ]; '
+            'then rm -rf "$stale"; mkdir {path} 2>/dev/null; '
+            'else [ -e {path} ] || mv "$stale" {path}; rm -rf "$stale"; '
+            'false; fi; }}; then '
+            'exp=0; [ {lease} -gt 0 ] && exp=$((now + {lease})); '
+            'printf "user=%s\\nhost=%s\\npid=%s\\nexpires=%s\\n" '
+            '{user} {host} {pid} "$exp" > {holder} && echo acquired=1; '
+            'else echo acquired=0; fi; '
+            'cat {holder} 2>/dev/null; echo now=$now'
+        ).format(path=path, holder=holder, holder_file=self.HOLDER_FILE,
+                 lease=self.lease, user=quote(self.user),
+                 host=quote(socket.gethostname()), pid=os.getpid())
+
+        holder_data = self._parse_holder(self._ssh(cmd))
+        if holder_data.get('acquired') != '1':
+            self._cache(self._holds(holder_data), holder_data)
+            log.error('{0} :: Lock at {1}:{2} is held by {3}@{4}.'.format(
+                __name__, self.target, self._lock_path(),
+                holder_data.get('user'), holder_data.get('host')))
+            raise DeployLockerError(message=exit_codes[2], exit_code=2)
+        self._cache(True, holder_data)
 
         # Logging
-        log.info('{0} :: Created lock file at {1}:{2}/{3}.'.format(
-            __name__, self.target, self.deploy_path, self.get_lock_name()))
-        deploy_log.log('Created lock.')
+        log.info('{0} :: Created lock at {1}:{2}.'.format(
+            __name__, self.target, self._lock_path()))
+        config.deploy_log.log('Created lock.')
 
+    @traced('lock check')
     def check_lock(self):
-        """ Returns boolean flag on lock file existence """
+        """ Returns boolean flag on whether this user holds the lock """
 
-        cmd = "ls {0}/{1}".format(self.deploy_path, self.get_lock_name())
+        if self._cached is not None:
+            held, expiry = self._cached
+            if time.time() < expiry:
+                return held
 
-        # log.debug('{0} :: Executing - "{1}"'.format(__name__, cmd))
-        log.info('{0} :: Checking for lock file at {1}.'.format(
+        log.info('{0} :: Checking for lock at {1}.'.format(
             __name__, self.target))
 
-        try:
-            ret = ssh_command_target(cmd, self.target, self.user,
-                                     self.key_path)
-        except Exception as e:
-            log.error(__name__ + ' :: ' + e.message)
-            raise DeployLockerError(message=exit_codes[16], exit_code=16)
+        cmd = 'cat {0} 2>/dev/null; echo now=$(date +%s)'.format(
+            quote(self._lock_path() + '/' + self.HOLDER_FILE))
+        holder = self._parse_holder(self._ssh(cmd))
 
-        # Pull the lock file handle from
-        try:
-            file_handle = ret['stdout'][0].split('/')[-1].strip()
-        except (IndexError, ValueError):
-            log.info('{0} :: No lock file exists.'.format(__name__,
-                                                          self.target))
-            return False
+        held = self._holds(holder)
+        self._cache(held, holder)
 
-        if file_handle == self.get_lock_name():
-            log.info('{0} :: {1} has lock.'.format(__name__,
-                                                   self.user))
-            return True
-        else:
+        if held:
+            log.info('{0} :: {1} has lock.'.format(__name__, self.user))
+        elif 'user' in holder:
             log.info('{0} :: Another user has lock.'.format(__name__))
-            return False
-
+        else:
+            log.info('{0} :: No lock file exists.'.format(__name__))
+        return held
+
+    @traced('lock renew')
+    def renew_lock(self):
+        """ Extend the lease of a lock held by this user """
+        holder = quote(self._lock_path() + '/' + self.HOLDER_FILE)
+        cmd = (
+            'now=$(date +%s); '
+            'if grep -qx {user_line} {holder} 2>/dev/null; then '
+            '{{ grep -v "^expires=" {holder}; '
+            'echo expires=$((now + {lease})); }} > {holder}.tmp && '
+            'mv {holder}.tmp {holder}; fi; '
+            'cat {holder} 2>/dev/null; echo now=$now'
+        ).format(holder=holder, lease=self.lease,
+                 user_line=quote('user=' + self.user))
+
+        holder_data = self._parse_holder(self._ssh(cmd))
+        held = self._holds(holder_data)
+        self._cache(held, holder_data)
+        return held
+
+    @traced('lock remove')
     def remove_lock(self):
-        """ Remove the lock file """
+        """ Remove the lock directory if this user holds it """
         log.info('{0} :: SSH Lock destroy.'.format(__name__))
 
-        cmd = "rm {0}/{1}".format(self.deploy_path, self.get_lock_name())
+        self.stop_heartbeat()
+        cmd = 'grep -qx {0} {1} && rm -rf {2}'.format(
+            quote('user=' + self.user),
+            quote(self._lock_path() + '/' + self.HOLDER_FILE),
+            quote(self._lock_path()))
+        self._ssh(cmd)
+        self._cached = None
+
+        # Logging
+        log.info('{0} :: Removed lock at {1}:{2}.'.format(
+            __name__, self.target, self._lock_path()))
+        config.deploy_log.log('Removed lock.')
+
+
+class DeployLockerLocal(DeployLockerLease):
+    """
+    Local Locker class - for deploys where the target is this host
+
+    Keeps the same lock directory and holder file as DeployLockerDefault,
+    under deploy_path on the local filesystem, without any SSH calls.  Every
+    lock operation runs while holding an exclusive fcntl.flock on a guard
+    file next to the lock directory, so check-and-take, renewal and removal
+    are atomic between processes.  The flock itself is only held for the
+    duration of an operation - the lock survives the process that took it.
+    """
+
+    # Suffix of the guard file serializing lock operations
+    GUARD_SUFFIX = '.flock'
+
+    # class instance
+    __instance = None
+
+    def __init__(self, *args, **kwargs):
+        """ Initialize class instance """
+        self.__class__.__instance = self
+        super(DeployLockerLocal, self).__init__(*args, **kwargs)
 
+    def __new__(cls, *args, **kwargs):
+        """ This class is Singleton, return only one instance """
+        if not cls.__instance:
+            cls.__instance = super(DeployLockerLocal, cls).__new__(cls, *args,
+                                                                   **kwargs)
+        return cls.__instance
+
+    @contextmanager
+    def _guard(self):
+        """ Hold the guard file's flock for the duration of the block """
+        path = self.deploy_path.rstrip('/') + '/' + self.lock_handle + \
+            self.GUARD_SUFFIX
         try:
-            ssh_command_target(cmd, self.target, self.user, self.key_path)
-        except Exception as e:
-            log.error(__name__ + ' :: Failed ot remove lock -> ' + e.message)
-            raise DeployLockerError(message=exit_codes[16], exit_code=16)
+            if not os.path.isdir(self.deploy_path):
+                os.makedirs(self.deploy_path)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        except OSError as e:
+            log.error(__name__ + ' :: ' + str(e))
+            raise DeployLockerError(message=exit_codes[18], exit_code=18)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _read_holder(self):
+        """ Returns the holder data, with the current time, or {} """
+        try:
+            with open(self._lock_path() + '/' + self.HOLDER_FILE) as f:
+                holder = self._parse_holder(f.read().splitlines())
+        except IOError:
+            holder = {}
+        holder['now'] = str(int(time.time()))
+        return holder
+
+    def _write_holder(self, now):
+        """ Atomically (re)write the holder file for this process """
+        expires = now + self.lease if self.lease else 0
+        path = self._lock_path() + '/' + self.HOLDER_FILE
+        with open(path + '.tmp', 'w') as f:
+            f.write('user={0}\nhost={1}\npid={2}\nexpires={3}\n'.format(
+                self.user, socket.gethostname(), os.getpid(), expires))
+        os.rename(path + '.tmp', path)
+
+    @traced('lock add')
+    def add_lock(self):
+        """
+        Create the lock directory, or replace it if its lease has expired,
+        then write the holder file.
+        """
+        with self._guard():
+            holder = self._read_holder()
+            if os.path.isdir(self._lock_path()):
+                try:
+                    expires = int(holder.get('expires'))
+                except (TypeError, ValueError):
+                    expires = 0
+                if not expires or expires >= int(holder['now']):
+                    log.error('{0} :: Lock at {1} is held by {2}@{3}.'.format(
+                        __name__, self._lock_path(), holder.get('user'),
+                        holder.get('host')))
+                    raise DeployLockerError(message=exit_codes[2],
+                                            exit_code=2)
+                shutil.rmtree(self._lock_path(), ignore_errors=True)
+
+            os.mkdir(self._lock_path())
+            self._write_holder(int(holder['now']))
+
+        # Logging
+        log.info('{0} :: Created lock at {1}.'.format(
+            __name__, self._lock_path()))
+        config.deploy_log.log('Created lock.')
+
+    @traced('lock check')
+    def check_lock(self):
+        """ Returns boolean flag on whether this user holds the lock """
+        with self._guard():
+            return self._holds(self._read_holder())
+
+    @traced('lock renew')
+    def renew_lock(self):
+        """ Extend the lease of a lock held by this user """
+        with self._guard():
+            holder = self._read_holder()
+            held = self._holds(holder)
+            if held:
+                self._write_holder(int(holder['now']))
+        return held
+
+    @traced('lock remove')
+    def remove_lock(self):
+        """ Remove the lock directory if this user holds it """
+        self.stop_heartbeat()
+        with self._guard():
+            if self._read_holder().get('user') == self.user:
+                shutil.rmtree(self._lock_path(), ignore_errors=True)
 
         # Logging
-        log.info('{0} :: Removed lock file at {1}:{2}/{3}.'.format(
-            __name__, self.target, self.deploy_path, self.get_lock_name()))
-        deploy_log.log('Removed lock.')
\ No newline at end of file
+        log.info('{0} :: Removed lock at {1}.'.format(
+            __name__, self._lock_path()))
+        config.deploy_log.log('Removed lock.')
+
+
+# Lock backends by name, selected with git config deploy.lock-backend
+LOCKER_BACKENDS = {
+    'ssh': DeployLockerDefault,
+    'local': DeployLockerLocal,
+}
+
+
+def register_locker(name, locker_class):
+    """ Make a DeployLocker subclass available as lock backend `name` """
+    LOCKER_BACKENDS[name] = locker_class
+
+
+def get_locker(name, **kwargs):
+    """ Returns an instance of the lock backend `name` """
+    try:
+        locker_class = LOCKER_BACKENDS[name]
+    except KeyError:
+        raise DeployLockerError(message=exit_codes[43], exit_code=43)
+    return locker_class(**kwargs)
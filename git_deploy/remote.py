@@ -0,0 +1,146 @@
+"""
+Concurrent execution of remote operations - commands and file transfers
+"""
+
+__date__ = '2026-10-18'
+__license__ = 'GPL v2.0 (or later)'
+
+import atexit
+import threading
+
+from utils import ssh_command_target, scp_file, get_file
+from tracing import span, get_tracer
+
+
+# Threads running remote operations
+REMOTE_WORKERS = 16
+
+# Remote operations running at once against one target, below the default
+# MaxSessions of sshd
+REMOTE_CHANNELS_PER_TARGET = 8
+
+
+class RemoteExecutor(object):
+    """
+    Runs remote operations on a pool of threads and returns a result handle
+    at once, so that independent remote I/O - a log flush, a lock check, a
+    command on each of many targets - overlaps.
+
+    `run`, `put_file` and `get_file` mirror ssh_command_target, scp_file and
+    get_file.  `submit` runs any callable.  Each returns a
+    multiprocessing.pool.AsyncResult, `get()` waits for the operation and
+    returns its value or raises its exception.  At most `workers`
+    operations run at once, and at most `per_target` against one target.
+
+    Usage:
+
+        executor = get_remote_executor()
+        flushed = executor.submit(deploy_log.flush)
+        results = [executor.run('uptime', target, user, key_path)
+                   for target in targets]
+        ...
+        flushed.get()
+        outputs = gather(results)
+    """
+
+    def __init__(self, workers=REMOTE_WORKERS,
+                 per_target=REMOTE_CHANNELS_PER_TARGET):
+        self.workers = workers
+        self.per_target = per_target
+        self._pool = None
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        """ The thread pool, started with the first operation """
+        with self._lock:
+            if self._pool is None:
+                from multiprocessing.pool import ThreadPool
+                self._pool = ThreadPool(max(1, self.workers))
+            return self._pool
+
+    def _limit(self, target):
+        """ The semaphore bounding the operations against `target` """
+        with self._lock:
+            if target not in self._limits:
+                self._limits[target] = threading.BoundedSemaphore(
+                    max(1, self.per_target))
+            return self._limits[target]
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Runs `func(*args, **kwargs)` on the pool.  If the keyword argument
+        `limit_target` is given the operation counts towards that target's
+        limit, it is not passed on to `func`.  The operation is recorded as
+        a span of the caller's innermost span.
+        """
+        target = kwargs.pop('limit_target', None)
+        parent = get_tracer().current()
+        name = 'remote ' + getattr(func, '__name__', 'call')
+
+        def call():
+            with span(name, parent=parent):
+                if target is None:
+                    return func(*args, **kwargs)
+                with self._limit(target):
+                    return func(*args, **kwargs)
+
+        return self._get_pool().apply_async(call)
+
+    def run(self, cmd, target, user, key_path, port=None, data=None,
+            timeout=None):
+        """ Runs `cmd` on `target`, see utils.ssh_command_target """
+        return self.submit(ssh_command_target, cmd, url=target, user=user,
+                           key_path=key_path, ssh_port=port, data=data,
+                           timeout=timeout, limit_target=target)
+
+    def put_file(self, target, source_path, target_path, user, key_path,
+                 port=None):
+        """ Copies a local file to `target`, see utils.scp_file """
+        return self.submit(scp_file, source_path=source_path,
+                           target_path=target_path, user=user,
+                           key_path=key_path, port=port, url=target,
+                           limit_target=target)
+
+    def get_file(self, target, source_path, target_path, user, key_path,
+                 port=None):
+        """ Copies a file from `target`, see utils.get_file """
+        return self.submit(get_file, source_path=source_path,
+                           target_path=target_path, user=user,
+                           key_path=key_path, port=port, url=target,
+                           limit_target=target)
+
+    def shutdown(self):
+        """ Waits for the running operations and stops the pool """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def gather(results, timeout=None):
+    """
+    Waits for every result handle in `results`, returns their values in
+    order.  The first exception raised by an operation is raised once all
+    of them finished.
+    """
+    values, error = [], None
+    for result in results:
+        try:
+            values.append(result.get(timeout))
+        except Exception as e:
+            values.append(None)
+            error = error or e
+    if error is not None:
+        raise error
+    return values
+
+
+_remote_executor = RemoteExecutor()
+atexit.register(_remote_executor.shutdown)
+
+
+def get_remote_executor():
+    """ Returns the process-wide remote executor """
+    return _remote_executor
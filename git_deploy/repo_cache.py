@@ -0,0 +1,125 @@
+"""
+Repository handle with a bounded cache of decompressed objects
+
+Imported on first use by git_methods, it loads dulwich.
+"""
+
+__date__ = '2026-10-18'
+__license__ = 'GPL v2.0 (or later)'
+
+import os
+import threading
+
+from collections import OrderedDict
+
+from dulwich.repo import Repo
+from dulwich.object_store import DiskObjectStore
+from dulwich.objects import sha_to_hex
+
+
+# Default bound of the object cache
+OBJECT_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class ObjectCache(object):
+    """
+    LRU map of object sha -> (type number, decompressed contents), bounded
+    by the total size of the contents.  Objects larger than a quarter of
+    the bound are not kept.
+    """
+
+    def __init__(self, max_bytes=OBJECT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._objects = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sha):
+        """ The cached (type number, contents) of `sha`, or None """
+        with self._lock:
+            value = self._objects.pop(sha, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self._objects[sha] = value
+            self.hits += 1
+            return value
+
+    def add(self, sha, value):
+        size = len(value[1])
+        if size > self.max_bytes / 4:
+            return
+        with self._lock:
+            if sha in self._objects:
+                return
+            self._objects[sha] = value
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._objects.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._objects.clear()
+            self.size = 0
+
+    def stats(self):
+        """ Hit, miss and eviction counts, objects and bytes held """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'objects': len(self._objects),
+                'bytes': self.size,
+            }
+
+
+class CachedObjectStore(DiskObjectStore):
+    """ DiskObjectStore reading objects through an ObjectCache """
+
+    def __init__(self, path, cache):
+        DiskObjectStore.__init__(self, path)
+        self.cache = cache
+
+    def get_raw(self, name):
+        sha = sha_to_hex(name) if len(name) == 20 else name
+        value = self.cache.get(sha)
+        if value is None:
+            value = DiskObjectStore.get_raw(self, name)
+            self.cache.add(sha, value)
+        return value
+
+
+class CachedRepo(Repo):
+    """ Repo whose object store shares `cache` """
+
+    def __init__(self, root, cache):
+        Repo.__init__(self, root)
+        self.object_store.close()
+        self.object_store = CachedObjectStore(self.object_store.path, cache)
+
+
+def refs_signature(controldir):
+    """
+    Returns the stat data of HEAD, packed-refs and the directories under
+    refs, which changes whenever a ref is added, removed or updated.
+    """
+    paths = [os.path.join(controldir, 'HEAD'),
+             os.path.join(controldir, 'packed-refs')]
+    for root, dirs, _ in os.walk(os.path.join(controldir, 'refs')):
+        dirs.sort()
+        paths.append(root)
+
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        signature.append((path, st.st_mtime, st.st_size))
+    return signature
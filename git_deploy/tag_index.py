@@ -0,0 +1,220 @@
+"""
+Persistent index of repository tags for deploy tag lookups
+"""
+
+__date__ = '2026-10-18'
+__license__ = 'GPL v2.0 (or later)'
+
+import os
+import re
+import json
+import heapq
+from collections import OrderedDict, namedtuple
+
+from config import log
+from tracing import traced
+
+
+# Trailer of a deploy tag message naming the environment deployed to
+ENV_TRAILER = 'Deploy-Env'
+
+_env_trailer = re.compile(r'^' + ENV_TRAILER + r': *(.*?) *$', re.M)
+
+
+# A tag as listed by TagIndex.newest
+TagInfo = namedtuple('TagInfo', 'tag sha time author env')
+
+
+def open_repo(path):
+    """ Open a dulwich Repo, dulwich is only imported when first needed """
+    from dulwich.repo import Repo
+    return Repo(path)
+
+
+def _utf8(value):
+    """ Valid UTF-8 of a string read from an object, for the index file """
+    return value.decode('utf-8', 'replace').encode('utf-8')
+
+
+class TagIndex(object):
+    """
+    On-disk index mapping tag -> (peeled commit sha, commit time, author,
+    environment).  The author is the tagger of an annotated tag, otherwise
+    the commit author.  The environment is read from the Deploy-Env trailer
+    of the tag message, it is empty for tags without one.
+
+    The index is stored in .git/deploy/tag-index along with the mtimes of
+    packed-refs and of every directory under refs/tags.  While those are
+    unchanged the stored index is used as is.  Otherwise the tag refs are
+    re-read and only tags whose ref sha changed are peeled again.  The
+    repository itself is only opened in that case.
+    """
+
+    INDEX_FILE = 'tag-index'
+    INDEX_VERSION = 2
+
+    def __init__(self, repo_path, get_repo=None):
+        self.controldir = os.path.join(repo_path, '.git')
+        if not os.path.isdir(self.controldir):
+            self.controldir = repo_path
+        self.repo_path = repo_path
+        self.get_repo = get_repo or (lambda: open_repo(repo_path))
+        self.path = os.path.join(self.controldir, 'deploy', self.INDEX_FILE)
+
+        # tag -> [ref sha, peeled sha, commit time, author, env]
+        self._entries = None
+        self._signature = None
+
+    def _ref_signature(self):
+        """
+        Returns the stat data that changes whenever a tag ref is added,
+        removed or updated.
+        """
+        controldir = self.controldir
+        paths = [os.path.join(controldir, 'packed-refs')]
+        for root, dirs, _ in os.walk(os.path.join(controldir, 'refs',
+                                                  'tags')):
+            dirs.sort()
+            paths.append(root)
+
+        signature = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            signature.append([os.path.relpath(path, controldir),
+                              st.st_mtime, st.st_size])
+        return signature
+
+    def _load(self):
+        """ Read the index file, returns (signature, entries) """
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None, {}
+
+        if data.get('version') != self.INDEX_VERSION:
+            return None, {}
+
+        entries = {}
+        for tag, entry in data['tags'].iteritems():
+            entries[tag.encode('utf-8')] = [entry[0].encode('utf-8'),
+                                            entry[1].encode('utf-8'),
+                                            entry[2],
+                                            entry[3].encode('utf-8'),
+                                            entry[4].encode('utf-8')]
+        return data['signature'], entries
+
+    def _save(self):
+        """ Atomically write the index file """
+        data = {
+            'version': self.INDEX_VERSION,
+            'signature': self._signature,
+            'tags': self._entries,
+        }
+        tmp_path = self.path + '.tmp'
+        try:
+            if not os.path.exists(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            log.info('{0} :: Could not write tag index -> {1}'.format(
+                __name__, e))
+
+    @traced('tag index refresh')
+    def _refresh(self, entries):
+        """
+        Rebuild the entries from the tag refs, reusing `entries` for tags
+        whose ref sha is unchanged.
+        """
+        _repo = self.get_repo()
+        refs = _repo.refs.as_dict('refs/tags')
+        object_store = _repo.object_store
+
+        updated = {}
+        for tag, ref_sha in refs.iteritems():
+            entry = entries.get(tag)
+            if entry and entry[0] == ref_sha:
+                updated[tag] = entry
+                continue
+            tag_obj = object_store[ref_sha]
+            obj = object_store.peel_sha(ref_sha)
+
+            # Annotated deploy tags carry the deployer and the environment
+            author = getattr(tag_obj, 'tagger', None) or \
+                getattr(obj, 'author', None) or ''
+            message = getattr(tag_obj, 'message', None) or ''
+            env = _env_trailer.search(message)
+
+            updated[tag] = [ref_sha, obj.id, getattr(obj, 'commit_time', 0),
+                            _utf8(author), _utf8(env.group(1)) if env else '']
+        return updated
+
+    def entries(self):
+        """
+        Returns the up to date tag -> [ref sha, peeled sha, time, author,
+        env] map
+        """
+        signature = self._ref_signature()
+        if self._entries is not None and signature == self._signature:
+            return self._entries
+
+        stored_signature, entries = self._load()
+        if stored_signature != signature:
+            entries = self._refresh(entries)
+            self._entries, self._signature = entries, signature
+            self._save()
+        else:
+            self._entries, self._signature = entries, signature
+
+        return self._entries
+
+    def tags(self):
+        """
+        Returns an OrderedDict of tag -> (peeled sha, commit time), sorted by
+        commit time then by tag name.
+        """
+        entries = self.entries()
+        ordered = sorted(entries.iteritems(),
+                         key=lambda t: (t[1][2], t[0]))
+        return OrderedDict((tag, (entry[1], entry[2]))
+                           for tag, entry in ordered)
+
+    def latest(self, match=None):
+        """
+        Returns the most recent tag, optionally only tags for which
+        `match(tag)` is true.  Returns None if there is no such tag.
+        """
+        latest = None
+        for tag, entry in self.entries().iteritems():
+            if match and not match(tag):
+                continue
+            if latest is None or (entry[2], tag) > latest[0]:
+                latest = ((entry[2], tag), tag)
+        return latest[1] if latest else None
+
+    def newest(self, num, skip=0, match=None):
+        """
+        Returns a list of TagInfo of the `num` most recent tags after the
+        `skip` most recent ones, newest first.  Only tags for which
+        `match(info)` is true are counted.  The tags are selected with a
+        heap, not sorted as a whole.
+        """
+        infos = (TagInfo(tag, entry[1], entry[2], entry[3], entry[4])
+                 for tag, entry in self.entries().iteritems())
+        if match:
+            infos = (info for info in infos if match(info))
+        newest = heapq.nlargest(max(0, skip + num), infos,
+                                key=lambda info: (info.time, info.tag))
+        return newest[skip:]
+
+    def get(self, tag):
+        """ Returns (peeled sha, commit time) for a tag or None """
+        entry = self.entries().get(tag)
+        if entry is None:
+            return None
+        return entry[1], entry[2]
@@ -0,0 +1,222 @@
+"""
+In-process SSH server standing in for a deploy target in tests and benchmarks
+"""
+
+__date__ = '2026-10-18'
+__license__ = 'GPL v2.0 (or later)'
+
+import os
+import time
+import socket
+import threading
+import subprocess
+
+import paramiko
+
+
+class SSHStandInCounters(object):
+    """ What the clients of an SSHStandIn did """
+
+    def __init__(self):
+        self.connections = 0
+        self.channels = 0
+        self.commands = []
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def as_dict(self):
+        return {
+            'connections': self.connections,
+            'channels': self.channels,
+            'commands': len(self.commands),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+        }
+
+
+class _StandInServer(paramiko.ServerInterface):
+    """ Accepts any public key and runs exec requests """
+
+    def __init__(self, stand_in):
+        self.stand_in = stand_in
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind != 'session':
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+        self.stand_in._count(channels=1)
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.stand_in._run,
+                                  args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class SSHStandIn(object):
+    """
+    SSH server on 127.0.0.1 running each exec request with `sh -c` in
+    `root`, for any user and any key.
+
+    Every command is delayed by `latency` seconds, standing in for a network
+    round-trip.  Connections, channels, commands and the payload bytes sent
+    and received are counted in `counters`.
+
+    Usage:
+
+        with SSHStandIn(root) as server:
+            ssh_command_target('ls', '127.0.0.1', user, key_path,
+                               ssh_port=server.port)
+    """
+
+    def __init__(self, root, latency=0.0, host_key=None):
+        self.root = root
+        self.latency = latency
+        self.host_key = host_key or paramiko.RSAKey.generate(1024)
+        self.counters = SSHStandInCounters()
+
+        self._lock = threading.Lock()
+        self._socket = None
+        self._transports = []
+        self._channels = set()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def port(self):
+        return self._socket.getsockname()[1]
+
+    def start(self):
+        """ Listen on a free port and accept connections in the background """
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(100)
+
+        self._thread = threading.Thread(target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop listening and close every connection """
+        sock, self._socket = self._socket, None
+        if sock is not None:
+            sock.close()
+        with self._lock:
+            transports, self._transports = self._transports, []
+        for transport in transports:
+            transport.close()
+
+    def reset(self):
+        """ Zero the counters """
+        with self._lock:
+            self.counters = SSHStandInCounters()
+
+    def _count(self, **increments):
+        with self._lock:
+            for name, value in increments.iteritems():
+                setattr(self.counters, name,
+                        getattr(self.counters, name) + value)
+
+    def _accept(self):
+        while self._socket is not None:
+            try:
+                conn, _ = self._socket.accept()
+            except (socket.error, AttributeError):
+                return
+            self._count(connections=1)
+
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.host_key)
+            with self._lock:
+                self._transports.append(transport)
+            try:
+                transport.start_server(server=_StandInServer(self))
+            except (paramiko.SSHException, EOFError, socket.error):
+                continue
+
+            # Accept the transport's channels, requests are served by
+            # _StandInServer
+            thread = threading.Thread(target=self._serve, args=(transport,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, transport):
+        # The transport only holds weak references to its channels
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel is not None:
+                with self._lock:
+                    self._channels.add(channel)
+
+    def _run(self, channel, command):
+        """ Run an exec request, relaying stdin, stdout, stderr and status """
+        with self._lock:
+            self.counters.commands.append(command)
+            self.counters.bytes_in += len(command)
+        if self.latency:
+            time.sleep(self.latency)
+
+        proc = subprocess.Popen(['sh', '-c', command], cwd=self.root,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+
+        def pump_stdin():
+            try:
+                while True:
+                    data = channel.recv(32768)
+                    if not data:
+                        break
+                    self._count(bytes_in=len(data))
+                    proc.stdin.write(data)
+                    proc.stdin.flush()
+            except (IOError, socket.error):
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except IOError:
+                    pass
+
+        def pump_out(pipe, send):
+            for data in iter(lambda: os.read(pipe.fileno(), 32768), ''):
+                self._count(bytes_out=len(data))
+                send(data)
+
+        pumps = [threading.Thread(target=pump_stdin),
+                 threading.Thread(target=pump_out,
+                                  args=(proc.stderr, channel.sendall_stderr))]
+        for thread in pumps:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            pump_out(proc.stdout, channel.sendall)
+            pumps[1].join()
+            channel.send_exit_status(proc.wait())
+        except socket.error:
+            proc.kill()
+        finally:
+            channel.close()
+            with self._lock:
+                self._channels.discard(channel)
+
+
+def make_key(path):
+    """ Write a new RSA private key to `path`, for clients of SSHStandIn """
+    paramiko.RSAKey.generate(1024).write_private_key_file(path)
+    return path
@@ -8,6 +8,10 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import os
+import sys
+import json
+import time
 import unittest
 import tempfile
 
@@ -15,12 +19,32 @@ from collections import namedtuple
 from git_deploy.config import log
 from git_deploy.git_deploy import GitDeploy, GitMethods, GitDeployError, \
     exit_codes
+from git_deploy.git_methods import GitMethodsError
 from dulwich.repo import Repo
-from os import mkdir, chdir
-from os.path import exists
+from dulwich.diff_tree import tree_changes
+from os import mkdir, chdir, remove
+from os.path import exists, dirname, abspath
+from subprocess import Popen, PIPE
 from shutil import rmtree
 
+from git_deploy import config as config_module
 from git_deploy.config import configure
+from git_deploy.utils import SSHConnectionPool, SCPError, _scp_send_file, \
+    ssh_command_target, scp_file
+from git_deploy.deploylog.deploylog import DeployLogDefault
+from git_deploy.deploylog import deploylog
+from git_deploy.tag_index import TagIndex
+from git_deploy.repo_cache import ObjectCache, CachedRepo, refs_signature
+from git_deploy.deploy_diff import iter_changes, format_changes
+from git_deploy.fanout import fan_out, parse_batches
+from git_deploy.lockers import locker
+from git_deploy import utils
+from git_deploy.drivers import driver, hooks
+from git_deploy.tracing import Tracer, load_runs, format_profile, span_env, \
+    RUN_ID_ENV
+from git_deploy.remote import RemoteExecutor, gather
+from git_deploy import daemon
+from ssh_server import SSHStandIn, make_key
 
 
 # Create the initial singleton
@@ -92,6 +116,65 @@ class TestGitDeployInit(unittest.TestCase):
         self.assertEquals(s1, s2)
 
 
+class TestConfigSnapshot(unittest.TestCase):
+    """ Test cases for the cached git config snapshot """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        Repo.init(self.path)
+        mkdir(os.path.join(self.path, '.git', 'deploy'))
+        self._git_config('deploy.tag-prefix', 'first')
+
+    def tearDown(self):
+        config_module._config_snapshots.pop(self.path, None)
+        rmtree(self.path)
+
+    def _git_config(self, name, value):
+        Popen(['git', 'config', name, value], cwd=self.path).wait()
+
+    def test_find_top_dir(self):
+        sub_dir = os.path.join(self.path, 'a', 'b')
+        os.makedirs(sub_dir)
+        self.assertEquals(config_module.find_top_dir(sub_dir), self.path)
+        self.assertEquals(config_module.find_top_dir(self.path), self.path)
+
+    def test_items_cached_until_config_changes(self):
+        items = config_module._config_items(self.path)
+        self.assertEquals(items['repo_name'], 'first')
+        self.assertEquals(items['deploy.trace'], None)
+
+        # Read back from .git/deploy/config-cache
+        cache_path = os.path.join(self.path, '.git', 'deploy',
+                                  config_module.CONFIG_CACHE_FILE)
+        with open(cache_path) as f:
+            data = json.load(f)
+        data['items']['repo_name'] = 'cached'
+        with open(cache_path, 'w') as f:
+            json.dump(data, f)
+        config_module._config_snapshots.pop(self.path)
+        items = config_module._config_items(self.path)
+        self.assertEquals(items['repo_name'], 'cached')
+        self.assertTrue(isinstance(items['repo_name'], str))
+
+        # Editing the git config invalidates both
+        time.sleep(0.01)
+        self._git_config('deploy.tag-prefix', 'second')
+        self.assertEquals(config_module._config_items(self.path)['repo_name'],
+                          'second')
+
+
+class TestLazyImports(unittest.TestCase):
+    """ Start-up must not load the SSH and porcelain dependencies """
+
+    def test_heavy_modules_not_imported(self):
+        snippet = 'import sys, git_deploy.git_deploy; ' \
+                  'print [m for m in ("paramiko", "dulwich.porcelain") ' \
+                  'if m in sys.modules]'
+        proc = Popen([sys.executable, '-c', snippet], stdout=PIPE,
+                     cwd=dirname(dirname(dirname(abspath(__file__)))))
+        self.assertEquals(proc.communicate()[0].strip(), '[]')
+
+
 class TestGitDeployFunctionality(unittest.TestCase):
 
     @setup_deco
@@ -234,6 +317,146 @@ class TestGitDeployDulwichDeps(unittest.TestCase):
         tags = s._dulwich_get_tags()
         self.assertEquals(tags.keys()[0], tag)
 
+    @setup_deco
+    def test_release_tag_records_env(self):
+        """
+        Tests that a release tag made by the driver is annotated with the
+        deployer and the environment
+        """
+        s = GitMethods()
+        _repo = Repo(s.config['top_dir'])
+        author = s._make_author()
+        sha = _repo.do_commit('commit', committer=author)
+        tag = s._make_tag('sync')
+        driver._make_release_tag(tag, author, 'prod')
+
+        deploys = s._get_deploy_history(5, env='prod')
+        self.assertEquals([d.tag for d in deploys], [tag])
+        self.assertEquals(deploys[0].env, 'prod')
+        self.assertEquals(deploys[0].author, author)
+        self.assertEquals(s._get_commit_sha_for_tag(tag), sha)
+        self.assertEquals(s._get_deploy_history(5, env='dev'), [])
+
+    @setup_deco
+    def test_get_commit_sha_for_tag(self):
+        """
+        Tests method GitDeploy::_get_commit_sha_for_tag
+        """
+        s = GitMethods()
+        _repo = Repo(s.config['top_dir'])
+        sha = _repo.do_commit('commit', committer=s._make_author())
+        tag = 'test_tag'
+        s._dulwich_tag(tag, s._make_author())
+        self.assertEquals(s._get_commit_sha_for_tag(tag), sha)
+        self.assertRaises(GitMethodsError, s._get_commit_sha_for_tag,
+                          'missing_tag')
+
+    @setup_deco
+    def test_git_commits_since(self):
+        """
+        Tests method GitDeploy::_git_commits_since
+        """
+        s = GitMethods()
+        _repo = Repo(s.config['top_dir'])
+        author = s._make_author()
+        shas = [_repo.do_commit('commit {0}'.format(i), committer=author,
+                                commit_timestamp=1000 + i)
+                for i in range(3)]
+        self.assertEquals(s._git_commits_since(shas[0]),
+                          [shas[2], shas[1]])
+        self.assertEquals(s._git_commits_since(shas[2]), [])
+
+        # A commit that is not an ancestor of HEAD
+        orphan_sha = _repo.do_commit('orphan', committer=author, ref=None)
+        self.assertEquals(s._git_commits_since(orphan_sha), None)
+
+    @setup_deco
+    def test_dulwich_rollback(self):
+        """
+        Tests method GitDeploy::_dulwich_rollback
+        """
+        s = GitMethods()
+        _repo = Repo(s.config['top_dir'])
+        author = s._make_author()
+
+        def write_and_commit(files, removed=()):
+            for path, content in files.items():
+                if not exists(path.rsplit('/', 1)[0]) and '/' in path:
+                    mkdir(path.rsplit('/', 1)[0])
+                with open(path, 'w') as f:
+                    f.write(content)
+            for path in removed:
+                remove(path)
+            _repo.stage(list(files.keys()) + list(removed))
+            return _repo.do_commit('commit', committer=author)
+
+        first_sha = write_and_commit({'a.txt': 'a1', 'b.txt': 'b1'})
+        write_and_commit({'a.txt': 'a2', 'dir/c.txt': 'c2'})
+        write_and_commit({}, removed=['b.txt'])
+
+        commit_sha = s._dulwich_rollback(first_sha, author, 'Rollback.')
+
+        self.assertEquals(_repo.head(), commit_sha)
+        self.assertEquals(_repo[commit_sha].tree, _repo[first_sha].tree)
+        self.assertEquals(open('a.txt').read(), 'a1')
+        self.assertEquals(open('b.txt').read(), 'b1')
+        self.assertFalse(exists('dir'))
+        self.assertEquals(s._dulwich_status(), [])
+
+    @setup_deco
+    def test_dulwich_rollback_directory_symlink(self):
+        """
+        Tests that _dulwich_rollback removes a symlink to a directory
+        """
+        s = GitMethods()
+        _repo = Repo(s.config['top_dir'])
+        author = s._make_author()
+
+        with open('a.txt', 'w') as f:
+            f.write('a1')
+        _repo.stage(['a.txt'])
+        first_sha = _repo.do_commit('commit', committer=author)
+
+        mkdir('sub')
+        with open('sub/x.txt', 'w') as f:
+            f.write('x')
+        os.symlink('sub', 'link')
+        _repo.stage(['sub/x.txt', 'link'])
+        _repo.do_commit('commit', committer=author)
+
+        s._dulwich_rollback(first_sha, author, 'Rollback.')
+        self.assertFalse(os.path.lexists('link'))
+        self.assertFalse(exists('sub'))
+        self.assertEquals(s._dulwich_status(), [])
+
+    @setup_deco
+    def test_dulwich_push(self):
+        """
+        Tests method GitDeploy::_dulwich_push
+        """
+        s = GitMethods()
+        _repo = Repo(s.config['top_dir'])
+        sha = _repo.do_commit('commit', committer=s._make_author())
+        remote_path = tempfile.mkdtemp()
+        try:
+            remote = Repo.init_bare(remote_path)
+            refs = {'refs/heads/master': 'refs/heads/master'}
+            self.assertEquals(s._dulwich_push(remote_path, refs),
+                              {'refs/heads/master': sha})
+            self.assertEquals(remote.refs['refs/heads/master'], sha)
+
+            # Up to date, nothing is sent
+            packs = os.listdir(os.path.join(remote_path, 'objects', 'pack'))
+            self.assertEquals(s._dulwich_push(remote_path, refs), {})
+            self.assertEquals(
+                os.listdir(os.path.join(remote_path, 'objects', 'pack')),
+                packs)
+
+            self.assertRaises(GitMethodsError, s._dulwich_push, remote_path,
+                              'refs/heads/missing')
+        finally:
+            rmtree(remote_path)
+
     @setup_deco
     def test_dulwich_reset_to_tag(self):
         """
@@ -252,7 +475,29 @@ class TestGitDeployDulwichDeps(unittest.TestCase):
         #   1. Create a dummy file - use object store
         #   2. Call _dulwich_stage
         #   3. Use dulwich.diff_tree.tree_changes to ensure changes are staged
-        self.assertTrue(False)
+        s = GitMethods()
+        _repo = Repo(s.config['top_dir'])
+        with open('dummy.txt', 'w') as f:
+            f.write('dummy')
+        mkdir('dummy_dir')
+        with open('dummy_dir/dummy.txt', 'w') as f:
+            f.write('dummy')
+        s._dulwich_stage_all()
+
+        _index = _repo.open_index()
+        self.assertEquals(sorted(_index), ['dummy.txt', 'dummy_dir/dummy.txt'])
+        tree = _index.commit(_repo.object_store)
+        self.assertEquals(
+            sorted(c.new.path for c in tree_changes(_repo.object_store,
+                                                    None, tree)),
+            ['dummy.txt', 'dummy_dir/dummy.txt'])
+
+        # A modified file is re-staged
+        with open('dummy.txt', 'w') as f:
+            f.write('modified')
+        s._dulwich_stage_all()
+        blob_id = _repo.open_index()['dummy.txt'].sha
+        self.assertEquals(_repo[blob_id].data, 'modified')
 
     @setup_deco
     def test_dulwich_commit(self):
@@ -263,3 +508,932 @@ class TestGitDeployDulwichDeps(unittest.TestCase):
         #   2. Perform commit
         #   3. Ensure that _repo['HEAD'] matches the commit.id
         self.assertTrue(False)
+
+
+class FakeSSHClient(object):
+    """ Stands in for paramiko.SSHClient in the connection pool tests """
+
+    def __init__(self):
+        self.closed = False
+
+    def get_transport(self):
+        return None if self.closed else self
+
+    def is_active(self):
+        return not self.closed
+
+    def send_ignore(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSSHConnectionPool(SSHConnectionPool):
+
+    def _connect(self, url, user, key_path, port, timeout=None):
+        return FakeSSHClient()
+
+
+class TestSSHConnectionPool(unittest.TestCase):
+    """ Test cases for the pooled SSH connections in git_deploy.utils """
+
+    def test_connection_reused(self):
+        pool = FakeSSHConnectionPool()
+        with pool.client('host', 'user', 'key') as ssh_1:
+            pass
+        with pool.client('host', 'user', 'key') as ssh_2:
+            pass
+        with pool.client('host', 'user', 'key', port=2222) as ssh_3:
+            pass
+        self.assertIs(ssh_1, ssh_2)
+        self.assertIsNot(ssh_1, ssh_3)
+
+    def test_idle_and_dead_connections_evicted(self):
+        pool = FakeSSHConnectionPool(idle_timeout=0)
+        with pool.client('host', 'user', 'key') as ssh_1:
+            pass
+        pool.evict_idle()
+        self.assertTrue(ssh_1.closed)
+
+        pool = FakeSSHConnectionPool()
+        with pool.client('host', 'user', 'key') as ssh_1:
+            pass
+        ssh_1.close()
+        with pool.client('host', 'user', 'key') as ssh_2:
+            pass
+        self.assertIsNot(ssh_1, ssh_2)
+
+
+class FakeSCPChannel(object):
+    """ Records what is sent and acknowledges every message """
+
+    def __init__(self, ack='\0'):
+        self.sent = []
+        self.ack = ack
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+    def recv(self, size):
+        ack, self.ack = self.ack[:size], self.ack[size:] or '\0'
+        return ack
+
+
+class TestSCP(unittest.TestCase):
+    """ Test cases for the streaming SCP upload in git_deploy.utils """
+
+    def test_file_streamed_in_chunks(self):
+        handle, path = tempfile.mkstemp()
+        try:
+            with open(path, 'wb') as f:
+                f.write('x' * 10)
+            channel = FakeSCPChannel()
+            _scp_send_file(channel, path, 'artefact', 4)
+            self.assertEquals(channel.sent[1:], ['xxxx', 'xxxx', 'xx', '\0'])
+            self.assertTrue(channel.sent[0].startswith('C0'))
+            self.assertTrue(channel.sent[0].endswith(' 10 artefact\n'))
+
+            channel = FakeSCPChannel(ack='\2no space left\n')
+            self.assertRaises(SCPError, _scp_send_file, channel, path,
+                              'artefact', 4)
+        finally:
+            remove(path)
+
+
+class DeployLogTestCase(unittest.TestCase):
+    """ Base for DeployLogDefault test cases run against a local shell """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.ssh_command_target = deploylog.ssh_command_target
+        deploylog.ssh_command_target = local_command
+
+    def tearDown(self):
+        deploylog.ssh_command_target = self.ssh_command_target
+        rmtree(self.path)
+
+    def make_log(self, buffered=True):
+        deploy_log = object.__new__(DeployLogDefault)
+        deploy_log.__init__('target', self.path, 'user', 'key',
+                            buffered=buffered, spool_dir=self.path)
+        return deploy_log
+
+    def read_remote(self, name):
+        with open(os.path.join(self.path, 'logs', name)) as f:
+            return f.read()
+
+
+def archive_and_unlock(buffered):
+    """
+    Runs GitDeploy._archive_log_and_unlock with a slow archive, returns the
+    order in which the archive and the lock removal finished
+    """
+    events = []
+
+    class Log(object):
+        def log_archive(self):
+            time.sleep(0.05)
+            events.append('archive')
+
+    class Locker(object):
+        def remove_lock(self):
+            events.append('unlock')
+
+    deploy = object.__new__(GitDeploy)
+    deploy.deploy_log, deploy._locker = Log(), Locker()
+    deploy.deploy_log.buffered = buffered
+    deploy._archive_log_and_unlock()
+    return events
+
+
+class TestDeployLogDefault(DeployLogTestCase):
+    """ Test cases for the unbuffered mode of DeployLogDefault """
+
+    def test_check_and_add_creates_missing_file(self):
+        # The file used to be touched only when it already existed
+        deploy_log = self.make_log(buffered=False)
+        mkdir(deploy_log.path)
+        deploy_log._check_and_add(deploy_log.path,
+                                  DeployLogDefault.LOGNAME_ARCHIVE)
+        self.assertEquals(self.read_remote(DeployLogDefault.LOGNAME_ARCHIVE),
+                          '')
+
+    def test_log_archived_before_unlock(self):
+        # Lines logged by remove_lock would race the archive
+        self.assertEquals(archive_and_unlock(False), ['archive', 'unlock'])
+
+
+class TestDeployLogBuffered(DeployLogTestCase):
+    """ Test cases for the buffered mode of DeployLogDefault """
+
+    def test_lines_spooled_locally(self):
+        deploy_log = self.make_log()
+        self.assertTrue(deploy_log.log('line 1'))
+        self.assertTrue(deploy_log.log('line\n2'))
+        self.assertEquals(deploy_log._read_spool(), 'line 1\nline 2\n')
+
+    def test_log_archived_while_unlocking(self):
+        self.assertEquals(archive_and_unlock(True), ['unlock', 'archive'])
+
+    def test_flush_sends_and_clears_spool(self):
+        deploy_log = self.make_log()
+        deploy_log.log('line 1')
+        deploy_log.log('line 2')
+        self.assertTrue(deploy_log.flush())
+        self.assertEquals(deploy_log._read_spool(), '')
+        self.assertEquals(self.read_remote(DeployLogDefault.LOGNAME_ACTIVE),
+                          'line 1\nline 2\n')
+
+        # Only the lines spooled since are sent with the next flush
+        deploy_log.log('line 3')
+        self.assertTrue(deploy_log.flush())
+        self.assertEquals(self.read_remote(DeployLogDefault.LOGNAME_ACTIVE),
+                          'line 1\nline 2\nline 3\n')
+
+    def test_failed_flush_keeps_spool(self):
+        deploy_log = self.make_log()
+        deploy_log.log('line 1')
+        deploy_log.path = '/dev/null/logs'
+        self.assertFalse(deploy_log.flush())
+        self.assertEquals(deploy_log._read_spool(), 'line 1\n')
+
+    def test_spool_of_crashed_run_replayed(self):
+        # A run that spooled lines and died before flushing
+        self.make_log().log('crashed line')
+
+        deploy_log = self.make_log()
+        deploy_log.log('next line')
+        self.assertTrue(deploy_log.log_archive())
+        self.assertEquals(deploy_log._read_spool(), '')
+        self.assertEquals(self.read_remote(DeployLogDefault.LOGNAME_ARCHIVE),
+                          'crashed line\nnext line\n')
+        self.assertFalse(exists(os.path.join(
+            deploy_log.path, DeployLogDefault.LOGNAME_ACTIVE)))
+
+
+class TestTagIndex(unittest.TestCase):
+    """ Test cases for the persistent tag index """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.repo = Repo.init(self.path)
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def _commit_and_tag(self, tag, commit_time):
+        sha = self.repo.do_commit('commit ' + tag, committer='a <a@b>',
+                                  author='a <a@b>',
+                                  commit_timestamp=commit_time)
+        self.repo.refs['refs/tags/' + tag] = sha
+        return sha
+
+    def test_tags_ordered_by_commit_time(self):
+        sha_b = self._commit_and_tag('b-sync-1', 1000)
+        sha_a = self._commit_and_tag('a-sync-2', 2000)
+        tags = TagIndex(self.path).tags()
+        self.assertEquals(tags.keys(), ['b-sync-1', 'a-sync-2'])
+        self.assertEquals(tags['a-sync-2'], (sha_a, 2000))
+        self.assertEquals(TagIndex(self.path).get('b-sync-1'),
+                          (sha_b, 1000))
+
+    def test_index_persisted_and_updated(self):
+        self._commit_and_tag('t-sync-1', 1000)
+        index = TagIndex(self.path)
+        self.assertEquals(index.latest(), 't-sync-1')
+        self.assertTrue(exists(index.path))
+
+        self._commit_and_tag('t-sync-2', 2000)
+        self._commit_and_tag('t-other-3', 3000)
+        self.assertEquals(index.latest(), 't-other-3')
+        self.assertEquals(index.latest(match=lambda t: '-sync-' in t),
+                          't-sync-2')
+
+    def test_newest_with_author_and_env(self):
+        from dulwich.objects import Tag
+        sha = self._commit_and_tag('t-sync-1', 1000)
+        self._commit_and_tag('t-sync-2', 2000)
+        self._commit_and_tag('t-sync-3', 3000)
+
+        tag = Tag()
+        tag.name, tag.object = 't-sync-4', (self.repo[sha].__class__, sha)
+        tag.tagger, tag.tag_time, tag.tag_timezone = 'd <d@b>', 4000, 0
+        tag.message = 'GitDeploy Tag.\n\nDeploy-Env: prod\n'
+        self.repo.object_store.add_object(tag)
+        self.repo.refs['refs/tags/t-sync-4'] = tag.id
+
+        index = TagIndex(self.path)
+        self.assertEquals([i.tag for i in index.newest(2)],
+                          ['t-sync-3', 't-sync-2'])
+        self.assertEquals([i.tag for i in index.newest(2, skip=2)],
+                          ['t-sync-4', 't-sync-1'])
+
+        # The tagger and env of the annotated tag, the peeled commit time
+        info = index.newest(1, match=lambda i: i.env == 'prod')[0]
+        self.assertEquals(info, ('t-sync-4', sha, 1000, 'd <d@b>', 'prod'))
+        self.assertEquals(TagIndex(self.path).newest(
+            5, match=lambda i: i.author == 'a <a@b>')[0].tag, 't-sync-3')
+
+
+class TestDeployDiff(unittest.TestCase):
+    """ Test cases for the streaming deploy diff """
+
+    def setUp(self):
+        from dulwich.objects import Blob
+        from dulwich.index import commit_tree
+        self.path = tempfile.mkdtemp()
+        self.repo = Repo.init(self.path)
+
+        def tree(files):
+            blobs = []
+            for path, data in sorted(files.iteritems()):
+                blob = Blob.from_string(data)
+                self.repo.object_store.add_object(blob)
+                blobs.append((path, blob.id, 0100644))
+            return commit_tree(self.repo.object_store, blobs)
+
+        body = ''.join('line {0}\n'.format(i) for i in range(20))
+        self.old = tree({'lib/a.py': 'a\nb\n', 'lib/old.py': body,
+                         'doc/x.txt': 'x\n'})
+        self.new = tree({'lib/a.py': 'a\nc\nd\n', 'lib/new.py': body,
+                         'doc/x.txt': 'x\n', 'doc/y.bin': '\0\1'})
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def _diff(self, fmt, **kwargs):
+        store = self.repo.object_store
+        changes = iter_changes(store, self.old, self.new, **kwargs)
+        return ''.join(format_changes(store, changes, fmt))
+
+    def test_name_only_and_paths(self):
+        self.assertEquals(self._diff('name-only'),
+                          'doc/y.bin\nlib/a.py\nlib/new.py\nlib/old.py\n')
+        self.assertEquals(self._diff('name-only', paths=['lib/a.py', 'doc/']),
+                          'doc/y.bin\nlib/a.py\n')
+
+    def test_stat(self):
+        lines = self._diff('stat', paths=['lib/a.py', 'doc']).splitlines()
+        self.assertEquals(lines, [' doc/y.bin | Bin 0 -> 2 bytes',
+                                  ' lib/a.py | 3 ++-',
+                                  ' 2 files changed, 2 insertions(+), '
+                                  '1 deletion(-)'])
+
+    def test_paths_bound_the_walk(self):
+        from dulwich.object_store import tree_lookup_path
+        store = self.repo.object_store
+        read = []
+
+        class Store(object):
+            def __getitem__(self, sha):
+                read.append(sha)
+                return store[sha]
+
+        lib = tree_lookup_path(store.__getitem__, self.old, 'lib')[1]
+        changes = list(iter_changes(Store(), self.old, self.new,
+                                    paths=['doc', 'doc/y.bin']))
+        self.assertEquals([c.new.path for c in changes], ['doc/y.bin'])
+        self.assertTrue(lib not in read)
+
+    def test_stat_of_large_file(self):
+        from git_deploy import deploy_diff
+        old = ['line {0}\n'.format(i) for i in range(10000)]
+        new = old[:5000] + ['changed\n'] + old[5001:] + ['added\n']
+        self.assertEquals(deploy_diff._count_lines(old, new), (2, 1))
+        self.assertEquals(deploy_diff._count_lines(old, list(reversed(old))),
+                          (0, 0))
+
+    def test_patch_with_renames(self):
+        patch = self._diff('patch', paths=['lib'], renames=True)
+        self.assertTrue('rename from lib/old.py\nrename to lib/new.py\n'
+                        in patch)
+        self.assertTrue('-b\n+c\n+d\n' in patch)
+        self.assertEquals(patch.count('diff --git'), 2)
+
+
+class TestObjectCache(unittest.TestCase):
+    """ Test cases for the shared repo handle's object cache """
+
+    def test_lru_bounded_by_size(self):
+        cache = ObjectCache(max_bytes=100)
+        cache.add('a', (3, 'x' * 20))
+        cache.add('b', (3, 'x' * 20))
+        cache.add('c', (3, 'x' * 25))
+        self.assertEquals(cache.get('a'), (3, 'x' * 20))
+
+        # 'b' is the least recently used
+        cache.add('d', (3, 'x' * 25))
+        cache.add('e', (3, 'x' * 20))
+        self.assertEquals(cache.get('b'), None)
+
+        # Larger than a quarter of the bound
+        cache.add('f', (3, 'x' * 26))
+        self.assertEquals(cache.get('f'), None)
+        self.assertEquals(cache.stats(), {'hits': 1, 'misses': 2,
+                                          'evictions': 1, 'objects': 4,
+                                          'bytes': 90})
+
+    def test_cached_repo(self):
+        path = tempfile.mkdtemp()
+        try:
+            Repo.init(path)
+            sha = Repo(path).do_commit('commit', committer='a <a@b>')
+            cache = ObjectCache()
+            repo = CachedRepo(path, cache)
+            self.assertEquals(repo[sha].message, 'commit')
+            self.assertEquals(repo[sha].message, 'commit')
+            self.assertEquals((cache.hits, cache.misses), (1, 1))
+
+            # Shared by a new handle
+            self.assertEquals(CachedRepo(path, cache)[sha].id, sha)
+            self.assertEquals(cache.hits, 2)
+
+            signature = refs_signature(os.path.join(path, '.git'))
+            Repo(path).refs['refs/tags/t'] = sha
+            self.assertNotEquals(refs_signature(os.path.join(path, '.git')),
+                                 signature)
+        finally:
+            rmtree(path)
+
+
+class TestFanOut(unittest.TestCase):
+    """ Test cases for multi-target fan-out """
+
+    def test_parse_batches(self):
+        self.assertEquals(parse_batches('1,10%,100%', 300), [1, 30, 300])
+        self.assertEquals(parse_batches('1,10%', 5), [1, 5])
+        self.assertEquals(parse_batches('100%', 3), [3])
+
+    def test_failed_batch_stops_fan_out(self):
+        def pull(target):
+            if target == 'host2':
+                raise Exception('pull failed')
+            return target
+
+        targets = ['host1', 'host2', 'host3', 'host4']
+        results = fan_out(pull, targets, workers=2, batches='1,2,100%')
+        self.assertEquals([r.target for r in results], targets)
+        self.assertEquals([r.status for r in results],
+                          ['ok', 'failed', 'skipped', 'skipped'])
+        self.assertEquals(results[1].error, 'pull failed')
+
+    def test_target_timeout(self):
+        import threading
+        hung = threading.Event()
+
+        def pull(target):
+            if target == 'host1':
+                hung.wait(5)
+            return target
+
+        start = time.time()
+        results = fan_out(pull, ['host1', 'host2', 'host3'], workers=1,
+                          timeout=0.2)
+        hung.set()
+        self.assertTrue(time.time() - start < 2)
+        self.assertEquals([r.status for r in results],
+                          ['failed', 'ok', 'ok'])
+        self.assertEquals(results[0].error, 'timed out after 0.2s')
+
+
+def local_command(cmd, url, user, key_path, ssh_port=22, data=None,
+                  timeout=None):
+    """ Runs an ssh_command_target command locally """
+    proc = Popen(['sh', '-c', cmd], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    stdout, stderr = proc.communicate(data or '')
+    return {
+        'stdout': [line.strip() for line in stdout.splitlines()],
+        'stderr': [line.strip() for line in stderr.splitlines()],
+        'exit_status': proc.returncode,
+    }
+
+
+class TestDeployLockerDefault(unittest.TestCase):
+    """ Test cases for the lease based lock, run against a local shell """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.ssh_command_target = locker.ssh_command_target
+        locker.ssh_command_target = local_command
+        self.deploy_log = locker.config.deploy_log
+        locker.config.deploy_log = DeployLogDefault(
+            'target', self.path, 'user', 'key', buffered=True,
+            spool_dir=self.path)
+
+    def tearDown(self):
+        locker.ssh_command_target = self.ssh_command_target
+        locker.config.deploy_log = self.deploy_log
+        rmtree(self.path)
+
+    def make_locker(self, user, lease=60):
+        lock = object.__new__(locker.DeployLockerDefault)
+        lock.__init__(deploy_path=self.path, target='target', user=user,
+                      key_path='key', lock_handle='lock', lease=lease)
+        return lock
+
+    def test_lock_exclusive_and_cached(self):
+        lock_1, lock_2 = self.make_locker('user1'), self.make_locker('user2')
+        lock_1.add_lock()
+        self.assertRaises(locker.DeployLockerError, lock_2.add_lock)
+        self.assertTrue(lock_1.check_lock())
+        self.assertFalse(lock_2.check_lock())
+
+        # Cached until the lease expires
+        rmtree(lock_1._lock_path())
+        self.assertTrue(lock_1.check_lock())
+
+    def test_lock_without_lease_not_cached(self):
+        lock = self.make_locker('user1', lease=0)
+        lock.add_lock()
+        self.assertTrue(lock.check_lock())
+        rmtree(lock._lock_path())
+        self.assertFalse(lock.check_lock())
+
+    def test_locker_kept_across_git_deploy_calls(self):
+        self.assertTrue(GitDeploy()._locker is GitDeploy()._locker)
+
+    def test_expired_lock_reclaimed(self):
+        lock_1, lock_2 = self.make_locker('user1'), self.make_locker('user2')
+        lock_1.add_lock()
+        with open(lock_1._lock_path() + '/holder', 'w') as f:
+            f.write('user=user1\nexpires=1\n')
+        lock_2.add_lock()
+        self.assertTrue(lock_2.check_lock())
+        self.assertEquals([name for name in os.listdir(self.path)
+                           if '.stale' in name], [])
+        lock_1.remove_lock()
+        self.assertTrue(exists(lock_2._lock_path()))
+        lock_2.remove_lock()
+        self.assertFalse(exists(lock_2._lock_path()))
+
+
+class TestDeployLockerLocal(TestDeployLockerDefault):
+    """ Test cases for the flock based local lock """
+
+    def make_locker(self, user, lease=60):
+        lock = object.__new__(locker.DeployLockerLocal)
+        lock.__init__(deploy_path=self.path, target='target', user=user,
+                      key_path='key', lock_handle='lock', lease=lease)
+        return lock
+
+    def test_lock_exclusive_and_cached(self):
+        lock_1, lock_2 = self.make_locker('user1'), self.make_locker('user2')
+        lock_1.add_lock()
+        self.assertRaises(locker.DeployLockerError, lock_2.add_lock)
+        self.assertTrue(lock_1.check_lock())
+        self.assertFalse(lock_2.check_lock())
+        self.assertTrue(lock_1.renew_lock())
+        self.assertFalse(lock_2.renew_lock())
+
+    def test_get_locker(self):
+        self.assertTrue(isinstance(
+            locker.get_locker('local', deploy_path=self.path, target='t',
+                              user='u', key_path='k', lock_handle='lock'),
+            locker.DeployLockerLocal))
+        self.assertRaises(locker.DeployLockerError, locker.get_locker,
+                          'missing')
+
+
+class TestHookGraph(unittest.TestCase):
+    """ Test cases for hook dependencies and concurrent hook runs """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def write_hook(self, name, body):
+        with open(self.path + '/' + name, 'w') as f:
+            f.write('#!/bin/sh\n' + body + '\n')
+        os.chmod(self.path + '/' + name, 0755)
+
+    def test_hook_graph(self):
+        for name in ['pre-sync.a', 'pre-sync.b', 'pre-sync.c',
+                     'post-sync.a']:
+            self.write_hook(name, 'true')
+        with open(self.path + '/' + hooks.HOOK_MANIFEST, 'w') as f:
+            f.write('[phase pre-sync]\ntimeout = 60\n[pre-sync.b]\nafter =\n'
+                    '[pre-sync.c]\nafter = pre-sync.b\ntimeout = 5\n')
+
+        names, deps, limits = hooks.hook_graph(self.path, 'pre-sync',
+                                               {'memory': '512'})
+        self.assertEquals(names, ['pre-sync.a', 'pre-sync.b', 'pre-sync.c'])
+        self.assertEquals(deps, {'pre-sync.a': set(), 'pre-sync.b': set(),
+                                 'pre-sync.c': set(['pre-sync.b'])})
+        self.assertEquals(limits['pre-sync.a'],
+                          {'timeout': 60, 'cpu': 0, 'memory': 512})
+        self.assertEquals(limits['pre-sync.c']['timeout'], 5)
+
+    def test_run_graph_order_and_failure(self):
+        names = ['a', 'b', 'c', 'd']
+        deps = {'a': set(), 'b': set(), 'c': set(['a']), 'd': set(['c'])}
+        started, reported = [], []
+
+        def run(name):
+            started.append(name)
+            return (1 if name == 'c' else 0), name
+
+        failed = hooks.run_graph(names, deps, run, workers=2,
+                                 report=lambda n, r: reported.append(n))
+        self.assertEquals(failed, ('c', (1, 'c')))
+        self.assertNotIn('d', started)
+        self.assertEquals(reported, ['a', 'b', 'c'])
+
+    def test_run_graph_cycle(self):
+        self.assertRaises(hooks.HookGraphError, hooks.run_graph,
+                          ['a', 'b'], {'a': set(['b']), 'b': set(['a'])},
+                          lambda name: (0, ''))
+
+    def test_call_hooks_parallel(self):
+        # Both hooks wait for each other, only passes if run concurrently
+        self.write_hook('pre-sync.a', 'cd {0}; touch a; while [ ! -e b ]; '
+                                      'do sleep 0.01; done'.format(self.path))
+        self.write_hook('pre-sync.b', 'cd {0}; touch b; while [ ! -e a ]; '
+                                      'do sleep 0.01; done'.format(self.path))
+        with open(self.path + '/' + hooks.HOOK_MANIFEST, 'w') as f:
+            f.write('[pre-sync.a]\n[pre-sync.b]\n')
+        driver._call_hooks(self.path, 'pre-sync', workers=2)
+
+        self.write_hook('pre-sync.c', 'exit 3')
+        self.assertRaises(driver.DeployDriverError, driver._call_hooks,
+                          self.path, 'pre-sync', workers=2)
+
+    def test_stream_output(self):
+        self.write_hook('pre-sync.a', 'for i in 1 2 3; do echo out$i; done; '
+                                      'echo err >&2')
+        lines = []
+        proc = Popen(self.path + '/pre-sync.a', stdout=PIPE, stderr=PIPE,
+                     cwd=self.path)
+        tail = hooks.stream_output(proc, 'pre-sync.a', lines.append,
+                                   tail_lines=2)
+        self.assertEquals(proc.returncode, 0)
+        self.assertEquals(len(lines), 4)
+        self.assertTrue(all(' pre-sync.a [' in line for line in lines))
+        self.assertEquals([line.split()[3] for line in lines
+                           if '[out]' in line], ['out1', 'out2', 'out3'])
+        self.assertEquals(len(tail), 2)
+        self.assertIn('pre-sync.a [err] err', '\n'.join(lines))
+
+    def test_run_hook_timeout(self):
+        # The hook's child must be killed along with it
+        self.write_hook('pre-sync.a', 'sleep 30 & sleep 30')
+        lines = []
+        start = time.time()
+        returncode, tail = hooks.run_hook(self.path + '/pre-sync.a',
+                                          'pre-sync.a', lines.append,
+                                          limits={'timeout': 1})
+        self.assertTrue(time.time() - start < 10)
+        self.assertNotEquals(returncode, 0)
+        self.assertTrue(tail[-1].endswith('[limit] timeout of 1s'))
+
+
+class TestTracing(unittest.TestCase):
+    """ Test cases for timing spans and the profile report """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.trace_path = self.path + '/trace.jsonl'
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_spans(self):
+        tracer = Tracer(self.trace_path, run_id='run1')
+        with tracer.span('sync'):
+            with tracer.span('hook', name_attr='a'):
+                pass
+            try:
+                with tracer.span('ssh'):
+                    raise ValueError()
+            except ValueError:
+                pass
+        self.assertEquals(tracer.current(), None)
+        tracer.flush()
+
+        runs = load_runs(self.trace_path, 5)
+        self.assertEquals(len(runs), 1)
+        spans = dict((record['name'], record) for record in runs[0])
+        self.assertEquals(spans['hook']['parent'], spans['sync']['id'])
+        self.assertEquals(spans['ssh']['status'], 'error')
+        self.assertEquals(spans['hook']['attrs'], {'name_attr': 'a'})
+
+    def test_disabled(self):
+        tracer = Tracer()
+        with tracer.span('sync') as span_id:
+            self.assertEquals(span_id, None)
+        tracer.flush()
+        self.assertFalse(exists(self.trace_path))
+
+    def test_hook_joins_run(self):
+        tracer = Tracer(self.trace_path, run_id='run1')
+        with tracer.span('sync'):
+            with tracer.span('hook') as span_id:
+                # The hook process, started with the run and span ids
+                env = dict(os.environ)
+                try:
+                    os.environ[RUN_ID_ENV] = tracer.run_id
+                    os.environ.update(span_env(span_id))
+                    hook_tracer = Tracer()
+                    hook_tracer.join(self.trace_path)
+                    with hook_tracer.span('push'):
+                        with hook_tracer.span('ssh'):
+                            pass
+                    hook_tracer.flush()
+                finally:
+                    os.environ.clear()
+                    os.environ.update(env)
+        tracer.flush()
+
+        runs = load_runs(self.trace_path, 5)
+        self.assertEquals(len(runs), 1)
+        spans = dict((record['name'], record) for record in runs[0])
+        self.assertEquals(spans['push']['parent'], spans['hook']['id'])
+        self.assertEquals(spans['ssh']['parent'], spans['push']['id'])
+        self.assertEquals(len(set(record['id'] for record in runs[0])), 4)
+        self.assertEquals([line.split()[3] for line in
+                           format_profile(runs)[1:-1]],
+                          ['sync', 'hook', 'push', 'ssh'])
+
+    def test_profile(self):
+        for run_id in ['run1', 'run2', 'run3']:
+            tracer = Tracer(self.trace_path, run_id=run_id)
+            with tracer.span('sync'):
+                with tracer.span('hook'):
+                    pass
+                with tracer.span('hook'):
+                    pass
+            tracer.flush()
+
+        runs = load_runs(self.trace_path, 2)
+        self.assertEquals([run[0]['run'] for run in runs], ['run2', 'run3'])
+        lines = format_profile(runs)
+        self.assertEquals(len(lines), 4)
+        self.assertIn('100.0%      2  sync', lines[1])
+        self.assertIn('     4    hook', lines[2])
+        self.assertTrue(lines[-1].startswith('2 run(s)'))
+
+
+class TestSSHStandIn(unittest.TestCase):
+    """ Test cases for remote calls against the in-process SSH server """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.key = make_key(self.path + '/key')
+        self.server = SSHStandIn(self.path)
+        self.server.start()
+        self.pool = SSHConnectionPool(port=self.server.port)
+        self.ssh_pool = utils._ssh_pool
+        utils._ssh_pool = self.pool
+
+    def tearDown(self):
+        utils._ssh_pool = self.ssh_pool
+        self.pool.close_all()
+        self.server.stop()
+        rmtree(self.path)
+
+    def test_ssh_command_target(self):
+        ret = ssh_command_target('cat > in; echo out; echo err >&2; exit 3',
+                                 '127.0.0.1', 'user', self.key, data='abc')
+        self.assertEquals(ret, {'stdout': ['out'], 'stderr': ['err'],
+                                'exit_status': 3})
+        with open(self.path + '/in') as f:
+            self.assertEquals(f.read(), 'abc')
+
+        ssh_command_target('true', '127.0.0.1', 'user', self.key)
+        counters = self.server.counters.as_dict()
+        self.assertEquals(counters['connections'], 1)
+        self.assertEquals(counters['channels'], 2)
+
+    def test_scp_file(self):
+        with open(self.path + '/source', 'w') as f:
+            f.write('x' * 100000)
+        scp_file('127.0.0.1', self.path + '/source', self.path + '/copy',
+                 'user', self.key)
+        self.assertEquals(os.path.getsize(self.path + '/copy'), 100000)
+
+    def test_latency(self):
+        self.server.latency = 0.2
+        start = time.time()
+        ssh_command_target('true', '127.0.0.1', 'user', self.key)
+        self.assertTrue(time.time() - start >= 0.2)
+
+
+class TestRemoteExecutor(TestSSHStandIn):
+    """ Test cases for concurrent remote operations """
+
+    def setUp(self):
+        TestSSHStandIn.setUp(self)
+        self.executor = RemoteExecutor(workers=4, per_target=4)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        TestSSHStandIn.tearDown(self)
+
+    def test_run_overlaps(self):
+        self.server.latency = 0.3
+        start = time.time()
+        results = gather([self.executor.run('echo {0}'.format(i),
+                                            '127.0.0.1', 'user', self.key)
+                          for i in range(4)])
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertEquals([r['stdout'] for r in results],
+                          [['0'], ['1'], ['2'], ['3']])
+
+    def test_per_target_limit(self):
+        self.executor.per_target = 1
+        self.server.latency = 0.2
+        start = time.time()
+        gather([self.executor.run('true', '127.0.0.1', 'user', self.key)
+                for _ in range(3)])
+        self.assertTrue(time.time() - start >= 0.6)
+
+    def test_put_and_get_file(self):
+        with open(self.path + '/source', 'w') as f:
+            f.write('y' * 100000)
+        self.executor.put_file('127.0.0.1', self.path + '/source',
+                               self.path + '/remote', 'user',
+                               self.key).get()
+        self.executor.get_file('127.0.0.1', self.path + '/remote',
+                               self.path + '/back', 'user', self.key).get()
+        with open(self.path + '/back') as f:
+            self.assertEquals(f.read(), 'y' * 100000)
+
+        result = self.executor.get_file('127.0.0.1', self.path + '/missing',
+                                        self.path + '/none', 'user',
+                                        self.key)
+        self.assertRaises(SCPError, result.get)
+        self.assertFalse(exists(self.path + '/none'))
+
+
+class TestDeployDaemon(unittest.TestCase):
+    """ Test cases for commands run by the git-deploy daemon """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.repo = os.path.join(self.path, 'repo')
+        self.env = dict(os.environ)
+        self.env.update({
+            'HOME': self.path,
+            'PYTHONPATH': dirname(dirname(dirname(abspath(__file__)))),
+            'GIT_COMMITTER_NAME': 'a',
+            'GIT_COMMITTER_EMAIL': 'a@b',
+        })
+        self.env.pop(daemon.NO_DAEMON_ENV, None)
+        self._git(self.path, 'init', '-q', self.repo)
+        for name in ['hook-dir', 'path', 'user', 'target', 'client-path',
+                     'key-path', 'test-repo-path', 'remote-url']:
+            self._git(self.repo, 'config', 'deploy.' + name, self.path)
+        for name, value in [('deploy.tag-prefix', 'd'),
+                            ('deploy.daemon', 'true'),
+                            ('deploy.lock-backend', 'local'),
+                            ('user.name', 'a'), ('user.email', 'a@b')]:
+            self._git(self.repo, 'config', name, value)
+        self._git(self.repo, 'commit', '-q', '--allow-empty', '-m', 'one')
+        self._git(self.repo, 'tag', 'd-sync-20260101-000000')
+        mkdir(os.path.join(self.repo, '.git', 'deploy'))
+
+    def tearDown(self):
+        daemon.stop(self.repo)
+        rmtree(self.path)
+
+    def _git(self, cwd, *args):
+        Popen(('git',) + args, cwd=cwd, env=self.env).wait()
+
+    def _git_deploy(self, *args):
+        script = os.path.join(self.env['PYTHONPATH'], 'scripts',
+                              'git-deploy')
+        proc = Popen([sys.executable, '-W', 'ignore', script] + list(args),
+                     cwd=self.repo, env=self.env, stdout=PIPE, stderr=PIPE)
+        out, err = proc.communicate()
+        return proc.returncode, out, err
+
+    def test_commands_served_by_daemon(self):
+        socket_path = os.path.join(self.repo, '.git', 'deploy',
+                                   daemon.DAEMON_SOCKET)
+        self.assertEquals(self._git_deploy('show_tag')[:2],
+                          (0, 'd-sync-20260101-000000\n'))
+        self.assertTrue(exists(socket_path))
+        self.assertEquals(self._git_deploy('show_tag')[:2],
+                          (0, 'd-sync-20260101-000000\n'))
+        self.assertEquals(self._git_deploy()[0], 2)
+
+        # A git config change replaces the daemon
+        self._git(self.repo, 'config', 'deploy.tag-prefix', 'e')
+        self._git(self.repo, 'tag', 'e-sync-20260102-000000')
+        self.assertEquals(self._git_deploy('show_tag')[:2],
+                          (0, 'e-sync-20260102-000000\n'))
+
+        self.assertTrue(daemon.stop(self.repo))
+        for _ in range(100):
+            if not exists(socket_path):
+                break
+            time.sleep(0.05)
+        self.assertFalse(exists(socket_path))
+
+    def test_non_ascii_environment(self):
+        self.env['GIT_DEPLOY_TEST'] = 'caf\xc3\xa9'
+        for _ in range(2):
+            self.assertEquals(self._git_deploy('show_tag')[:2],
+                              (0, 'd-sync-20260101-000000\n'))
+
+    def test_unknown_lock_backend(self):
+        self._git(self.repo, 'config', 'deploy.lock-backend', 'missing')
+        for no_daemon in ['1', '']:
+            self.env[daemon.NO_DAEMON_ENV] = no_daemon
+            returncode, _, err = self._git_deploy('show_tag')
+            self.assertEquals(returncode, 43)
+            self.assertTrue('Traceback' not in err)
+
+    def test_busy_daemon_runs_in_process(self):
+        import socket
+        socket_path = os.path.join(self.repo, '.git', 'deploy',
+                                   daemon.DAEMON_SOCKET)
+        busy = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        busy.bind(socket_path)
+        busy.listen(1)
+        cwd = os.getcwd()
+        try:
+            chdir(self.repo)
+            start = time.time()
+            self.assertEquals(daemon.call(['show_tag']), None)
+            self.assertTrue(time.time() - start <
+                            daemon.DAEMON_BUSY_TIMEOUT + 1)
+        finally:
+            chdir(cwd)
+            busy.close()
+            remove(socket_path)
+
+    def test_daemon_exit_after_request_fails(self):
+        import socket
+        import threading
+        from StringIO import StringIO
+        socket_path = os.path.join(self.repo, '.git', 'deploy',
+                                   daemon.DAEMON_SOCKET)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        server.listen(1)
+        requests = []
+
+        # Takes the request and exits before replying
+        def crash():
+            conn, _ = server.accept()
+            daemon._send(conn, ready=True)
+            requests.append(conn.makefile('r').readline())
+            conn.close()
+
+        thread = threading.Thread(target=crash)
+        thread.start()
+        cwd = os.getcwd()
+        err = StringIO()
+        try:
+            chdir(self.repo)
+            self.assertEquals(daemon.call(['sync'], StringIO(), err), 1)
+        finally:
+            chdir(cwd)
+            thread.join()
+            server.close()
+            remove(socket_path)
+        self.assertEquals(json.loads(requests[0])['argv'], ['sync'])
+        self.assertTrue(daemon.DAEMON_LOG in err.getvalue())
@@ -0,0 +1,253 @@
+"""
+Timing spans for deploy phases, hooks, SSH commands and git operations
+"""
+
+__date__ = '2026-10-18'
+__license__ = 'GPL v2.0 (or later)'
+
+import os
+import time
+import json
+import atexit
+import threading
+import itertools
+
+from functools import wraps
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from config import log
+
+
+# Trace file, in the deploy directory, holding one JSON span per line
+TRACE_FILE = 'trace.jsonl'
+
+# Size at which the trace file is rotated to TRACE_FILE.1
+TRACE_MAX_BYTES = 10 * 1024 * 1024
+
+# Environment variable carrying the run id, passed on to hooks
+RUN_ID_ENV = 'GIT_DEPLOY_RUN_ID'
+
+# Environment variable carrying the id of the span a hook runs in
+SPAN_ID_ENV = 'GIT_DEPLOY_SPAN_ID'
+
+
+class Tracer(object):
+    """
+    Records spans - a name, start time, duration, status and the enclosing
+    span - for one git-deploy run.  Spans are kept in memory and appended
+    to the trace file by flush, at exit.  A tracer without a path records
+    nothing.
+
+    A hook process joins the run that started it, see `join`.
+    """
+
+    def __init__(self, path=None, run_id=None):
+        self.path = path
+        self.enabled = path is not None
+        self.run_id = run_id or os.environ.get(RUN_ID_ENV) or \
+            os.urandom(6).encode('hex')
+
+        # Parent of the outermost spans and prefix of the span ids, set
+        # in a hook process
+        self.root = None
+        self._prefix = None
+
+        self._spans = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self, path):
+        """ Record spans to the trace file `path` """
+        self.path = path
+        self.enabled = True
+
+    def join(self, path):
+        """
+        Record spans to the trace file `path` as part of the run of the
+        git-deploy process that started this hook.  The outermost spans
+        belong to the hook's span, given by SPAN_ID_ENV, and span ids are
+        prefixed with its id to stay unique within the run.
+        """
+        self.enable(path)
+        try:
+            self.root = json.loads(os.environ[SPAN_ID_ENV])
+        except (KeyError, ValueError):
+            return
+        self._prefix = self.root
+
+    def disable(self):
+        """ Stop recording, spans not yet closed are dropped """
+        self.enabled = False
+
+    def current(self):
+        """ Id of the innermost open span of this thread, or None """
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def span(self, name, parent=None, **attrs):
+        """
+        Times the enclosed block.  The span's parent is the innermost open
+        span of this thread unless `parent` is given, e.g. for work handed
+        to another thread.
+        """
+        if not self.enabled:
+            yield None
+            return
+
+        span_id = next(self._ids)
+        if self._prefix is not None:
+            span_id = '{0}.{1}'.format(self._prefix, span_id)
+        if parent is None:
+            parent = self.current()
+        if parent is None:
+            parent = self.root
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(span_id)
+
+        status = 'ok'
+        start = time.time()
+        try:
+            yield span_id
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            stack.pop()
+            record = {
+                'run': self.run_id,
+                'id': span_id,
+                'parent': parent,
+                'name': name,
+                'start': start,
+                'duration': time.time() - start,
+                'status': status,
+            }
+            if attrs:
+                record['attrs'] = attrs
+            if self.enabled:
+                with self._lock:
+                    self._spans.append(record)
+
+    def flush(self):
+        """ Append the recorded spans to the trace file """
+        with self._lock:
+            spans, self._spans = self._spans, []
+        if not spans or not self.path:
+            return
+
+        try:
+            if not os.path.exists(os.path.dirname(self.path) or '.'):
+                os.makedirs(os.path.dirname(self.path))
+            if os.path.exists(self.path) and \
+                    os.path.getsize(self.path) > TRACE_MAX_BYTES:
+                os.rename(self.path, self.path + '.1')
+            with open(self.path, 'a') as f:
+                for record in spans:
+                    f.write(json.dumps(record) + '\n')
+        except (IOError, OSError) as e:
+            log.info('{0} :: Could not write trace -> {1}'.format(
+                __name__, e))
+
+
+_tracer = Tracer()
+atexit.register(lambda: _tracer.flush())
+
+
+def get_tracer():
+    """ Returns the process-wide tracer """
+    return _tracer
+
+
+def span(name, parent=None, **attrs):
+    """ A span of the process-wide tracer, see Tracer.span """
+    return _tracer.span(name, parent=parent, **attrs)
+
+
+def span_env(span_id):
+    """ Environment of a hook run within the span `span_id`, see join """
+    if span_id is None:
+        return {}
+    return {SPAN_ID_ENV: json.dumps(span_id)}
+
+
+def traced(name):
+    """ Decorator recording a span for every call of the function """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with _tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def load_runs(path, count):
+    """
+    Returns the spans of the last `count` runs in the trace file `path`
+    and its rotated predecessor, one list per run, oldest first.
+    """
+    runs = OrderedDict()
+    for trace_path in (path + '.1', path):
+        try:
+            with open(trace_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    runs.setdefault(record['run'], []).append(record)
+        except IOError:
+            continue
+    return runs.values()[-count:] if count > 0 else []
+
+
+def format_profile(runs):
+    """
+    Returns the lines of a flame-style profile of `runs` - spans with the
+    same path of names are merged, each line shows the mean time per run,
+    its share of the run time, the number of calls and a bar.
+    """
+    totals = OrderedDict()
+    run_time = 0.0
+
+    for spans in runs:
+        by_id = dict((record['id'], record) for record in spans)
+
+        def path_of(record):
+            names = [record['name']]
+            while record.get('parent') in by_id:
+                record = by_id[record['parent']]
+                names.insert(0, record['name'])
+            return tuple(names)
+
+        for record in sorted(spans, key=lambda r: r['start']):
+            path = path_of(record)
+            if len(path) == 1:
+                run_time += record['duration']
+            total = totals.setdefault(path, [0.0, 0])
+            total[0] += record['duration']
+            total[1] += 1
+
+    # Children are listed under their parent, in order of first start
+    def ordered(prefix):
+        for path in totals:
+            if path[:-1] == prefix:
+                yield path
+                for child in ordered(path):
+                    yield child
+
+    count = max(len(runs), 1)
+    lines = ['{0:>10} {1:>6} {2:>6}  {3}'.format('mean', '%', 'calls',
+                                                 'span')]
+    for path in ordered(()):
+        duration, calls = totals[path]
+        share = 100.0 * duration / run_time if run_time else 0.0
+        lines.append('{0:>9.3f}s {1:>5.1f}% {2:>6}  {3}{4}  {5}'.format(
+            duration / count, share, calls, '  ' * (len(path) - 1),
+            path[-1], '#' * int(share / 2.5)))
+    lines.append('{0} run(s), mean run time {1:.3f}s.'.format(
+        len(runs), run_time / count))
+    return lines
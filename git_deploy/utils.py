@@ -5,11 +5,26 @@ General utils for Git deploy
 __date__ = '2013-12-13'
 __license__ = 'GPL v2.0 (or later)'
 
+# paramiko is imported when the first connection is made, commands that
+# don't talk to a target start without loading it
 
-import paramiko
 import stat
 import socket
 import os
+import time
+import atexit
+import threading
+
+from contextlib import contextmanager
+
+from tracing import span
+
+
+# Seconds a pooled SSH connection may sit unused before it is closed
+SSH_IDLE_TIMEOUT = 300
+
+# Bytes read from disk and sent per write when streaming files over SCP
+SCP_CHUNK_SIZE = 64 * 1024
 
 
 def remove_readonly(fn, path, excinfo):
@@ -25,45 +40,295 @@ def remove_readonly(fn, path, excinfo):
         os.remove(path)
 
 
+class SCPError(Exception):
+    """ Basic exception class for SCP transfers """
+    def __init__(self, message="SCP error.", exit_code=39):
+        Exception.__init__(self, message)
+        self._exit_code = int(exit_code)
+
+    @property
+    def exit_code(self):
+        return self._exit_code
+
+
+def _scp_check_ack(channel):
+    """
+    Read the acknowledgement of the remote scp - a zero byte, or 1 (warning)
+    or 2 (error) followed by a message line.
+    """
+    code = channel.recv(1)
+    if code == '\0':
+        return
+    if not code:
+        raise SCPError(message='Remote scp closed the connection.')
+
+    message = ''
+    while not message.endswith('\n'):
+        char = channel.recv(1)
+        if not char:
+            break
+        message += char
+    raise SCPError(message='Remote scp: ' + message.strip())
+
+
+def _scp_send_file(channel, source_path, name, chunk_size):
+    """ Stream one file to the remote scp in chunks of chunk_size bytes """
+    with open(source_path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        channel.sendall('C%04o %d %s\n' % (stat.S_IMODE(st.st_mode),
+                                           st.st_size, name))
+        _scp_check_ack(channel)
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            channel.sendall(chunk)
+    channel.sendall('\0')
+    _scp_check_ack(channel)
+
+
+def _scp_send_dir(channel, source_path, name, chunk_size):
+    """ Send a directory tree to the remote scp, which must be in -r mode """
+    channel.sendall('D%04o 0 %s\n' % (
+        stat.S_IMODE(os.stat(source_path).st_mode), name))
+    _scp_check_ack(channel)
+    for entry in sorted(os.listdir(source_path)):
+        entry_path = os.path.join(source_path, entry)
+        if os.path.isdir(entry_path):
+            _scp_send_dir(channel, entry_path, entry, chunk_size)
+        else:
+            _scp_send_file(channel, entry_path, entry, chunk_size)
+    channel.sendall('E\n')
+    _scp_check_ack(channel)
+
+
+@contextmanager
+def _scp_channel(url, user, key_path, port, cmd, window_size=None):
+    """
+    Runs the remote scp command `cmd` on a channel of a pooled connection
+    and yields the channel once the remote scp is ready.
+    """
+    with _ssh_pool.client(url, user, key_path, port) as ssh:
+        channel = ssh.get_transport().open_session(window_size=window_size)
+        try:
+            channel.exec_command(cmd)
+            _scp_check_ack(channel)
+            yield channel
+            channel.shutdown_write()
+            if channel.recv_exit_status() != 0:
+                raise SCPError(message='Remote scp failed.')
+        finally:
+            channel.close()
+
+
+def scp_files(
+        url,
+        source_paths,
+        target_path,
+        user,
+        key_path,
+        port=None,
+        recursive=False,
+        chunk_size=SCP_CHUNK_SIZE,
+        window_size=None):
+    """
+    SCP several files via paramiko over a single channel.
+
+    Params:
+
+        source_paths    - Local files, or directories when recursive is set
+        target_path     - Remote directory to copy into
+        recursive       - Copy directories and their contents
+        chunk_size      - Bytes read and sent per write
+        window_size     - Optional SSH channel window size in bytes
+    """
+    cmd = 'scp -t %s%s' % ('-r ' if recursive else '', target_path)
+
+    with span('scp', target=url), \
+            _scp_channel(url, user, key_path, port, cmd,
+                         window_size) as channel:
+        for source_path in source_paths:
+            name = os.path.basename(source_path.rstrip('/'))
+            if not os.path.isdir(source_path):
+                _scp_send_file(channel, source_path, name, chunk_size)
+            elif recursive:
+                _scp_send_dir(channel, source_path, name, chunk_size)
+            else:
+                raise SCPError(message='{0} is a directory.'.format(
+                    source_path))
+
+
 def scp_file(
         url,
         source_path,
         target_path,
         user,
         key_path,
-        port=22):
+        port=None,
+        chunk_size=SCP_CHUNK_SIZE,
+        window_size=None):
     """
     SCP files via paramiko.
+
+    The file is streamed in chunks, memory use does not depend on its size.
+    """
+    cmd = 'scp -t %s' % '/'.join(target_path.split('/')[:-1])
+
+    with _scp_channel(url, user, key_path, port, cmd,
+                      window_size) as channel:
+        _scp_send_file(channel, source_path, target_path.split('/')[-1],
+                       chunk_size)
+
+
+def get_file(
+        url,
+        source_path,
+        target_path,
+        user,
+        key_path,
+        port=None,
+        chunk_size=SCP_CHUNK_SIZE):
+    """
+    Copy the file source_path on the target to the local target_path.
+
+    The file is streamed in chunks over one channel of a pooled connection,
+    target_path is only replaced once the whole file was read.
+    """
+    tmp_path = '{0}.{1}.part'.format(target_path, os.getpid())
+
+    with span('get file', target=url), \
+            _ssh_pool.client(url, user, key_path, port) as ssh:
+        channel = ssh.get_transport().open_session()
+        try:
+            channel.exec_command('cat %s' % source_path)
+            with open(tmp_path, 'wb') as f:
+                for chunk in iter(lambda: channel.recv(chunk_size), ''):
+                    f.write(chunk)
+            if channel.recv_exit_status() != 0:
+                raise SCPError(message='Could not read {0}.'.format(
+                    source_path))
+            os.rename(tmp_path, target_path)
+        finally:
+            channel.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class SSHConnectionPool(object):
+    """
+    Process-wide pool of authenticated SSH connections.
+
+    Connections are keyed on (url, user, key_path, port).  The first request
+    for a key performs the TCP connect, key exchange and authentication; later
+    requests open a new channel on the same transport.  Connections idle for
+    longer than ``idle_timeout`` seconds are closed, as are connections whose
+    transport fails a health check.  Requests without a port use ``port``.
     """
 
-    # Socket connection to remote host
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((url, port))
+    def __init__(self, idle_timeout=SSH_IDLE_TIMEOUT, port=22):
+        self.idle_timeout = idle_timeout
+        self.port = port
+        self._clients = {}
+        self._last_used = {}
+        self._in_use = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, url, user, key_path, port, timeout=None):
+        import paramiko
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(url, username=user, key_filename=key_path, port=port,
+                    timeout=timeout)
+        return ssh
+
+    def _is_healthy(self, ssh):
+        """ Check that the transport is up and still accepts writes """
+        import paramiko
+        transport = ssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (socket.error, EOFError, paramiko.SSHException):
+            return False
+        return True
+
+    def _discard(self, key):
+        """ Drop a connection from the pool and close it """
+        ssh = self._clients.pop(key, None)
+        self._last_used.pop(key, None)
+        if ssh is not None:
+            ssh.close()
+
+    def evict_idle(self):
+        """ Close connections that have not been used for idle_timeout """
+        now = time.time()
+        with self._lock:
+            for key, last_used in self._last_used.items():
+                if self._in_use.get(key) or \
+                        now - last_used < self.idle_timeout:
+                    continue
+                self._discard(key)
+
+    def acquire(self, url, user, key_path, port=None, timeout=None):
+        """ Returns a connected paramiko.SSHClient for the key """
+        self.evict_idle()
+        port = port or self.port
+        key = (url, user, key_path, port)
+
+        with self._lock:
+            ssh = self._clients.get(key)
+            if ssh is not None and not self._in_use.get(key) and \
+                    not self._is_healthy(ssh):
+                self._discard(key)
+                ssh = None
+            if ssh is not None:
+                self._in_use[key] = self._in_use.get(key, 0) + 1
+                return ssh
+
+        # Connect outside of the lock so that hosts connect concurrently
+        ssh = self._connect(url, user, key_path, port, timeout)
+
+        with self._lock:
+            if key in self._clients:
+                ssh.close()
+                ssh = self._clients[key]
+            else:
+                self._clients[key] = ssh
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+            return ssh
+
+    def release(self, url, user, key_path, port=None):
+        """ Marks a connection returned by acquire as no longer in use """
+        key = (url, user, key_path, port or self.port)
+        with self._lock:
+            self._in_use[key] = max(self._in_use.get(key, 0) - 1, 0)
+            self._last_used[key] = time.time()
+
+    @contextmanager
+    def client(self, url, user, key_path, port=None, timeout=None):
+        """ Context manager wrapping acquire & release """
+        ssh = self.acquire(url, user, key_path, port, timeout)
+        try:
+            yield ssh
+        finally:
+            self.release(url, user, key_path, port)
 
-    # Build a SSH transport
-    t = paramiko.Transport(sock)
-    t.start_client()
+    def close_all(self):
+        """ Close every pooled connection """
+        with self._lock:
+            for key in self._clients.keys():
+                self._discard(key)
+            self._in_use.clear()
 
-    rsa_key = paramiko.RSAKey.from_private_key_file(key_path)
-    t.auth_publickey(user, rsa_key)
 
-    # Start a scp channel
-    scp_channel = t.open_session()
+_ssh_pool = SSHConnectionPool()
+atexit.register(_ssh_pool.close_all)
 
-    f = file(source_path, 'rb')
-    scp_channel.exec_command('scp -v -t %s\n'
-                             % '/'.join(target_path.split('/')[:-1]))
-    scp_channel.send('C%s %d %s\n'
-                     % (oct(os.stat(source_path).st_mode)[-4:],
-                        os.stat(source_path)[6],
-                        target_path.split('/')[-1]))
-    scp_channel.sendall(f.read())
 
-    # Cleanup
-    f.close()
-    scp_channel.close()
-    t.close()
-    sock.close()
+def get_ssh_pool():
+    """ Returns the process-wide SSH connection pool """
+    return _ssh_pool
 
 
 def ssh_command_target(
@@ -71,28 +336,37 @@ def ssh_command_target(
         url,
         user,
         key_path,
-        ssh_port=22):
+        ssh_port=None,
+        data=None,
+        timeout=None):
     """
-    Talk to the target via SSHClient
+    Talk to the target via a pooled SSH connection
 
     Params:
 
         cmd         - The command to issue on SSH connection
-        ssh_port    - SSH port on remote, defaults to 22
+        ssh_port    - SSH port on remote, defaults to the pool's port - 22
+                      or git config deploy.ssh-port
+        data        - Optional string written to the command's stdin
+        timeout     - Optional seconds allowed for connecting and for each
+                      read from the command, socket.timeout is raised
     """
 
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(
-        url, username=user, key_filename=key_path, port=ssh_port)
-    stdin, stdout, stderr = ssh.exec_command(cmd)
+    with span('ssh', target=url, cmd=cmd.split(' ', 1)[0]), \
+            _ssh_pool.client(url, user, key_path, ssh_port, timeout) as ssh:
+        stdin, stdout, stderr = ssh.exec_command(cmd, timeout=timeout)
 
-    stdout = [line.strip() for line in stdout.readlines()]
-    stderr = [line.strip() for line in stderr.readlines()]
+        if data is not None:
+            stdin.write(data)
+            stdin.flush()
+            stdin.channel.shutdown_write()
 
-    ssh.close()
+        stdout_lines = [line.strip() for line in stdout.readlines()]
+        stderr_lines = [line.strip() for line in stderr.readlines()]
+        exit_status = stdout.channel.recv_exit_status()
 
     return {
-        'stdout': stdout,
-        'stderr': stderr,
-    }
\ No newline at end of file
+        'stdout': stdout_lines,
+        'stderr': stderr_lines,
+        'exit_status': exit_status,
+    }
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    bench-e2e
+    ~~~~~~~~~
+
+    Measures a full deploy - git-deploy start, sync and finish - against an
+    in-process SSH server standing in for the target, see
+    git_deploy/tests/ssh_server.py.  Each action runs in a fresh
+    interpreter; the server counts the SSH connections, channels, commands
+    and payload bytes it causes.
+
+    The client repository, the remote it pushes to and the target checkout
+    are created in a temporary directory, with HOME pointing there too, so
+    no git config or SSH host is needed.  --latency adds a delay to every
+    remote command, standing in for the network round-trip.
+
+    Usage:
+
+        python scripts/bench-e2e.py [-n RUNS] [--latency 0,0.05] [--json]
+            [--daemon]
+
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from subprocess import Popen, PIPE
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'git_deploy', 'tests'))
+sys.path.insert(1, ROOT)
+
+from ssh_server import SSHStandIn, make_key
+
+ACTIONS = ['start', 'sync', 'finish']
+
+
+def parseargs():
+    parser = argparse.ArgumentParser(
+        description="Measure a deploy against a local SSH stand-in.")
+    parser.add_argument("-n", "--runs", default=3, type=int,
+                        help="number of deploys per latency")
+    parser.add_argument("--latency", default='0,0.05', type=str,
+                        help="comma separated seconds added per command")
+    parser.add_argument("--json", action='store_true',
+                        help="emit the results as a JSON line")
+    parser.add_argument("--daemon", action='store_true',
+                        help="run the actions through the git-deploy daemon")
+    parser.add_argument("--keep", action='store_true',
+                        help="keep the temporary directory")
+    return parser.parse_args()
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+
+class Sandbox(object):
+    """ Client repo, remote and target checkout in a temporary directory """
+
+    def __init__(self, path):
+        self.path = path
+        self.home = os.path.join(path, 'home')
+        self.client = os.path.join(path, 'client')
+        self.remote = os.path.join(path, 'remote.git')
+        self.target = os.path.join(path, 'target')
+        self.key = os.path.join(path, 'id_rsa')
+        self.env = dict(os.environ)
+        self.env.update({
+            'HOME': self.home,
+            'PYTHONPATH': ROOT + os.pathsep + os.environ.get('PYTHONPATH',
+                                                             ''),
+            'GIT_AUTHOR_NAME': 'bench',
+            'GIT_AUTHOR_EMAIL': 'bench@localhost',
+            'GIT_COMMITTER_NAME': 'bench',
+            'GIT_COMMITTER_EMAIL': 'bench@localhost',
+        })
+
+    def git(self, cwd, *args):
+        proc = Popen(('git',) + args, cwd=cwd, stdout=PIPE, stderr=PIPE,
+                     env=self.env)
+        out, err = proc.communicate()
+        if proc.returncode:
+            raise RuntimeError('git {0} failed: {1}'.format(args[0], err))
+        return out
+
+    def create(self, port, daemon=False):
+        os.mkdir(self.home)
+        make_key(self.key)
+
+        os.mkdir(self.client)
+        self.git(self.client, 'init', '-q')
+        with open(os.path.join(self.client, 'README'), 'w') as f:
+            f.write('bench\n')
+        self.git(self.client, 'add', 'README')
+        self.git(self.client, 'commit', '-q', '-m', 'initial')
+
+        self.git(self.path, 'clone', '-q', '--bare', self.client,
+                 self.remote)
+        self.git(self.path, 'clone', '-q', self.remote, self.target)
+        os.makedirs(os.path.join(self.target, '.git', 'deploy'))
+        self.git(self.client, 'remote', 'add', 'origin', self.remote)
+        self.git(self.client, 'fetch', '-q', 'origin')
+
+        # Hooks - an empty common directory and the default sync
+        deploy_dir = os.path.join(self.client, '.git', 'deploy')
+        os.makedirs(os.path.join(deploy_dir, 'apps', 'common'))
+        os.makedirs(os.path.join(deploy_dir, 'sync'))
+        hook = os.path.join(deploy_dir, 'sync', 'default.sync')
+        with open(os.path.join(ROOT, 'git_deploy', 'default.sync')) as f:
+            script = f.read().split('\n', 1)[1]
+        with open(hook, 'w') as f:
+            f.write('#!{0}\n{1}'.format(sys.executable, script))
+        os.chmod(hook, 0755)
+
+        for name, value in [('user.name', 'bench'),
+                            ('user.email', 'bench@localhost'),
+                            ('deploy.hook-dir', deploy_dir),
+                            ('deploy.path', self.target + '/'),
+                            ('deploy.user', 'bench'),
+                            ('deploy.target', '127.0.0.1'),
+                            ('deploy.ssh-port', str(port)),
+                            ('deploy.tag-prefix', 'bench'),
+                            ('deploy.client-path', self.client),
+                            ('deploy.key-path', self.key),
+                            ('deploy.test-repo-path', self.path),
+                            ('deploy.remote-url', self.remote)]:
+            self.git(self.client, 'config', name, value)
+        if daemon:
+            self.git(self.client, 'config', 'deploy.daemon', 'true')
+
+    def commit(self, num):
+        """ A change to deploy """
+        with open(os.path.join(self.client, 'README'), 'a') as f:
+            f.write('change {0}\n'.format(num))
+        self.git(self.client, 'commit', '-q', '-a', '-m',
+                 'change {0}'.format(num))
+
+    def run(self, action):
+        """ Run a git-deploy action, returns (seconds, returncode, stderr) """
+        script = os.path.join(ROOT, 'scripts', 'git-deploy')
+        start = time.time()
+        proc = Popen([sys.executable, '-W', 'ignore', script, action],
+                     cwd=self.client, stdout=PIPE, stderr=PIPE, env=self.env)
+        _, err = proc.communicate()
+        return time.time() - start, proc.returncode, err
+
+
+def bench(sandbox, server, runs):
+    """ Returns action -> dict of median time and mean counters """
+    samples = dict((action, []) for action in ACTIONS)
+    for num in range(runs):
+        sandbox.commit(num)
+        for action in ACTIONS:
+            server.reset()
+            elapsed, returncode, err = sandbox.run(action)
+            if returncode:
+                print >> sys.stderr, 'git-deploy {0} exited with {1}:\n{2}'\
+                    .format(action, returncode, err)
+            counters = server.counters.as_dict()
+            counters['elapsed'] = elapsed
+            samples[action].append(counters)
+
+    results = {}
+    for action in ACTIONS:
+        results[action] = {'ms': median([s['elapsed'] for s in
+                                         samples[action]]) * 1000}
+        for name in ['connections', 'channels', 'commands', 'bytes_in',
+                     'bytes_out']:
+            results[action][name] = \
+                sum(s[name] for s in samples[action]) / float(runs)
+    return results
+
+
+def main():
+    args = parseargs()
+    logging.getLogger('paramiko').addHandler(logging.NullHandler())
+
+    path = tempfile.mkdtemp(prefix='bench-e2e-')
+    results = {'runs': args.runs, 'latency': {}}
+    try:
+        sandbox = Sandbox(path)
+        with SSHStandIn(sandbox.target) as server:
+            sandbox.create(server.port, daemon=args.daemon)
+            for latency in args.latency.split(','):
+                server.latency = float(latency)
+                results['latency'][latency] = bench(sandbox, server,
+                                                    args.runs)
+    finally:
+        if args.daemon:
+            from git_deploy.daemon import stop
+            stop(sandbox.client)
+        if args.keep:
+            print >> sys.stderr, 'sandbox kept in {0}'.format(path)
+        else:
+            shutil.rmtree(path)
+
+    if args.json:
+        print json.dumps(results)
+        return
+
+    for latency, actions in sorted(results['latency'].iteritems()):
+        print 'latency {0}s per command (median of {1}):'.format(
+            latency, args.runs)
+        for action in ACTIONS:
+            r = actions[action]
+            print '  {0:<8} {1:9.1f} ms  {2:4.1f} conn  {3:5.1f} chan  ' \
+                  '{4:5.1f} cmd  {5:8.0f} B in  {6:8.0f} B out'.format(
+                      action, r['ms'], r['connections'], r['channels'],
+                      r['commands'], r['bytes_in'], r['bytes_out'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    bench-git-methods
+    ~~~~~~~~~~~~~~~~~
+
+    Times git_methods operations against a synthetic repository with a
+    configurable number of commits, deploy tags and files.  The repository
+    is generated with git fast-import in a temporary directory, no git
+    config or SSH target is needed.
+
+    Timed operations:
+
+        * _dulwich_get_tags, with a cold and a warm tag index
+        * _get_deploy_tags, _get_commit_sha_for_tag, _git_commit_list
+        * _get_deploy_history, the 10 newest deploys as log_deploys lists
+        * _dulwich_stage_all and _dulwich_status with --dirty files changed
+          (the GitMethods object cache is reported, --object-cache-mb 0
+          disables it)
+        * the revert path - _git_commits_since and _dulwich_rollback to a
+          tag --revert-depth commits back
+
+    Usage:
+
+        python scripts/bench-git-methods.py [--commits 1000] [--tags 100]
+            [--files 2000] [-n RUNS] [--json] [--output results.jsonl]
+
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from collections import OrderedDict
+from subprocess import Popen, PIPE
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Required git config items, passed to configure() directly
+REPO_NAME = 'bench'
+CONFIG = {
+    'hook_dir': '/nonexistent',
+    'path': '/nonexistent',
+    'user': 'bench',
+    'target': 'localhost',
+    'repo_name': REPO_NAME,
+    'client_path': '/nonexistent',
+    'user.name': 'bench',
+    'user.email': 'bench@localhost',
+    'deploy.key_path': '/nonexistent',
+    'deploy.test_repo': '/nonexistent',
+    'deploy.remote_url': '/nonexistent',
+}
+
+# Files changed by each generated commit
+FILES_PER_COMMIT = 5
+
+
+def parseargs():
+    parser = argparse.ArgumentParser(
+        description="Time git_methods operations on a synthetic repo.")
+    parser.add_argument("--commits", default=1000, type=int,
+                        help="number of commits")
+    parser.add_argument("--tags", default=100, type=int,
+                        help="number of deploy tags, spread over the commits")
+    parser.add_argument("--files", default=2000, type=int,
+                        help="number of files in the tree")
+    parser.add_argument("--dirty", default=10, type=int,
+                        help="files changed before stage_all/status")
+    parser.add_argument("--revert-depth", default=10, type=int,
+                        help="commits between HEAD and the revert tag")
+    parser.add_argument("--object-cache-mb", default=64, type=int,
+                        help="bound of the GitMethods object cache")
+    parser.add_argument("-n", "--runs", default=5, type=int,
+                        help="number of samples per operation")
+    parser.add_argument("--label", default='', type=str,
+                        help="label stored with the results, e.g. a version")
+    parser.add_argument("--json", action='store_true',
+                        help="emit the results as a JSON line")
+    parser.add_argument("--output", default='', type=str,
+                        help="append the JSON results to this file")
+    parser.add_argument("--keep", action='store_true',
+                        help="keep the generated repository")
+    return parser.parse_args()
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+
+def file_path(idx):
+    return 'dir{0:03d}/file{1:05d}.txt'.format(idx / 100, idx)
+
+
+def fast_import_stream(commits, tags, files):
+    """
+    Yields a git fast-import stream - an initial commit with every file,
+    then commits changing FILES_PER_COMMIT files each.  Deploy tags are
+    spread evenly, alternately annotated and lightweight, the newest one
+    on HEAD.
+    """
+    tag_every = max(commits / max(tags, 1), 1)
+    when = 1400000000
+    tagged = 0
+
+    for num in range(1, commits + 1):
+        when += 60
+        message = 'commit {0}'.format(num)
+        yield 'commit refs/heads/master\nmark :{0}\n'.format(num)
+        yield 'committer bench <bench@localhost> {0} +0000\n'.format(when)
+        yield 'data {0}\n{1}\n'.format(len(message), message)
+        if num == 1:
+            changed = range(files)
+        else:
+            changed = [(num * FILES_PER_COMMIT + i) % files
+                       for i in range(FILES_PER_COMMIT)]
+        for idx in changed:
+            content = 'file {0} commit {1}\n'.format(idx, num)
+            yield 'M 100644 inline {0}\ndata {1}\n{2}\n'.format(
+                file_path(idx), len(content), content)
+
+        if tagged < tags and (commits - num) % tag_every == 0:
+            tag = '{0}-sync-{1}'.format(
+                REPO_NAME, time.strftime('%Y%m%d-%H%M%S',
+                                         time.gmtime(when)))
+            if tagged % 2:
+                yield 'reset refs/tags/{0}\nfrom :{1}\n\n'.format(tag, num)
+            else:
+                yield 'tag {0}\nfrom :{1}\n'.format(tag, num)
+                yield 'tagger bench <bench@localhost> {0} +0000\n'.format(
+                    when)
+                yield 'data 4\nsync\n'
+            tagged += 1
+
+
+def make_repo(path, commits, tags, files):
+    """ Generate the synthetic repo and check out its working tree """
+    def git(*args, **kwargs):
+        proc = Popen(('git',) + args, cwd=path, stdin=PIPE, stdout=PIPE,
+                     stderr=PIPE)
+        out, err = proc.communicate(kwargs.get('data'))
+        if proc.returncode:
+            raise RuntimeError('git {0} failed: {1}'.format(args[0], err))
+        return out
+
+    git('init', '-q')
+    git('fast-import', '--quiet',
+        data=''.join(fast_import_stream(commits, tags, files)))
+    git('reset', '-q', '--hard', 'master')
+    return git
+
+
+def timed(func, runs, setup=None):
+    """ Returns the samples of `runs` calls of func, in seconds """
+    samples = []
+    for _ in range(runs):
+        if setup:
+            setup()
+        start = time.time()
+        func()
+        samples.append(time.time() - start)
+    return samples
+
+
+def bench(args, path, git):
+    """ Returns a dict of operation -> list of samples """
+    os.chdir(path)
+    from git_deploy.git_methods import GitMethods
+    config = dict(CONFIG)
+    config['deploy.object_cache_mb'] = args.object_cache_mb
+    gm = GitMethods(**config)
+
+    def cold_index():
+        index_path = os.path.join(path, '.git', 'deploy', 'tag-index')
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        gm._tag_index_dir = None
+
+    deploy_tags = gm._get_deploy_tags()
+    revert_tag = None
+    head = git('rev-parse', 'HEAD').strip()
+    revert_sha = git('rev-parse',
+                     'HEAD~{0}'.format(args.revert_depth)).strip()
+    for tag in deploy_tags:
+        if gm._get_commit_sha_for_tag(tag) == revert_sha:
+            revert_tag = tag
+    if revert_tag is None:
+        git('tag', '{0}-sync-revert'.format(REPO_NAME), revert_sha)
+        revert_tag = '{0}-sync-revert'.format(REPO_NAME)
+
+    def dirty():
+        git('reset', '-q', '--hard', head)
+        for idx in range(min(args.dirty, args.files)):
+            with open(os.path.join(path, file_path(idx)), 'a') as f:
+                f.write('dirty\n')
+
+    def rollback():
+        sha = gm._get_commit_sha_for_tag(revert_tag)
+        gm._git_commits_since(sha)
+        gm._dulwich_rollback(sha, gm._make_author(), 'Rollback.')
+
+    samples = OrderedDict()
+    samples['dulwich_get_tags_cold'] = timed(gm._dulwich_get_tags,
+                                             args.runs, setup=cold_index)
+    samples['dulwich_get_tags'] = timed(gm._dulwich_get_tags, args.runs)
+    samples['get_deploy_tags'] = timed(gm._get_deploy_tags, args.runs)
+    samples['get_deploy_history'] = timed(
+        lambda: gm._get_deploy_history(10), args.runs)
+    samples['get_commit_sha_for_tag'] = timed(
+        lambda: gm._get_commit_sha_for_tag(deploy_tags[0]), args.runs)
+    samples['git_commit_list'] = timed(gm._git_commit_list, args.runs)
+    samples['dulwich_status'] = timed(gm._dulwich_status, args.runs,
+                                      setup=dirty)
+    samples['dulwich_stage_all'] = timed(gm._dulwich_stage_all, args.runs,
+                                         setup=dirty)
+    samples['revert'] = timed(rollback, args.runs,
+                              setup=lambda: git('reset', '-q', '--hard',
+                                                head))
+    return samples, gm._get_repo().object_store.cache.stats()
+
+
+def main():
+    args = parseargs()
+
+    import dulwich
+    path = tempfile.mkdtemp(prefix='bench-git-methods-')
+    try:
+        start = time.time()
+        git = make_repo(path, args.commits, args.tags, args.files)
+        generate_s = time.time() - start
+        samples, cache_stats = bench(args, path, git)
+    finally:
+        if args.keep:
+            print >> sys.stderr, 'repository kept in {0}'.format(path)
+        else:
+            shutil.rmtree(path)
+
+    results = {
+        'label': args.label,
+        'time': int(time.time()),
+        'python': sys.version.split()[0],
+        'dulwich': '.'.join(str(v) for v in dulwich.__version__),
+        'params': {
+            'commits': args.commits,
+            'tags': args.tags,
+            'files': args.files,
+            'dirty': args.dirty,
+            'revert_depth': args.revert_depth,
+            'object_cache_mb': args.object_cache_mb,
+            'runs': args.runs,
+        },
+        'object_cache': cache_stats,
+        'generate_s': generate_s,
+        'results': dict((name, {'median_ms': median(values) * 1000,
+                                'min_ms': min(values) * 1000})
+                        for name, values in samples.iteritems()),
+    }
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(results) + '\n')
+
+    if args.json:
+        print json.dumps(results)
+        return
+
+    print '{0} commits, {1} tags, {2} files (generated in {3:.1f} s)'.format(
+        args.commits, args.tags, args.files, generate_s)
+    for name in samples:
+        print '  {0:<26} {1:9.2f} ms median {2:9.2f} ms min'.format(
+            name, results['results'][name]['median_ms'],
+            results['results'][name]['min_ms'])
+    print '  object cache: {hits} hits, {misses} misses, {evictions} ' \
+          'evictions, {objects} objects, {bytes} bytes'.format(**cache_stats)
+
+
+if __name__ == '__main__':
+    main()
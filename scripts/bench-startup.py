@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    bench-startup
+    ~~~~~~~~~~~~~
+
+    Measures git-deploy start-up time.  Each sample runs in a fresh
+    interpreter:
+
+        * import of git_deploy.git_deploy, reporting which of the heavy
+          dependencies (paramiko, dulwich) were loaded by the import
+        * optionally a full CLI command, e.g. show_tag, run in the current
+          repository
+
+    Usage:
+
+        python scripts/bench-startup.py [-n RUNS] [--command show_tag]
+
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from subprocess import Popen, PIPE
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ['paramiko', 'dulwich.repo', 'dulwich.porcelain',
+                 'dulwich.client', 'multiprocessing']
+
+IMPORT_SNIPPET = """
+import sys, time, json
+start = time.time()
+import git_deploy.git_deploy
+elapsed = time.time() - start
+print json.dumps({'elapsed': elapsed,
+                  'loaded': [m for m in %r if m in sys.modules]})
+""" % HEAVY_MODULES
+
+
+def parseargs():
+    parser = argparse.ArgumentParser(
+        description="Measure git-deploy start-up time.")
+    parser.add_argument("-n", "--runs", default=10, type=int,
+                        help="number of samples per measurement")
+    parser.add_argument("--command", default='', type=str,
+                        help="git-deploy method to time, e.g. show_tag")
+    parser.add_argument("--json", action='store_true',
+                        help="emit the results as a JSON line")
+    return parser.parse_args()
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+
+def bench_import(runs):
+    """ Times the import in fresh interpreters, in seconds """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    samples, loaded = [], []
+    for _ in range(runs):
+        proc = Popen([sys.executable, '-W', 'ignore', '-c', IMPORT_SNIPPET],
+                     stdout=PIPE, env=env)
+        result = json.loads(proc.communicate()[0])
+        samples.append(result['elapsed'])
+        loaded = result['loaded']
+    return samples, loaded
+
+
+def bench_command(command, runs):
+    """ Times a full git-deploy run of `command`, in seconds """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    script = os.path.join(ROOT, 'scripts', 'git-deploy')
+    samples = []
+    for _ in range(runs):
+        start = time.time()
+        proc = Popen([sys.executable, '-W', 'ignore', script, command,
+                      '--silent'], stdout=PIPE, stderr=PIPE, env=env)
+        proc.communicate()
+        samples.append(time.time() - start)
+        if proc.returncode:
+            print >> sys.stderr, 'git-deploy {0} exited with {1}'.format(
+                command, proc.returncode)
+    return samples
+
+
+def main():
+    args = parseargs()
+
+    results = {}
+    samples, loaded = bench_import(args.runs)
+    results['import_ms'] = median(samples) * 1000
+    results['import_loaded'] = loaded
+
+    if args.command:
+        results['command'] = args.command
+        results['command_ms'] = median(bench_command(args.command,
+                                                     args.runs)) * 1000
+
+    if args.json:
+        print json.dumps(results)
+        return
+
+    print 'import git_deploy.git_deploy: {0:.1f} ms (median of {1})'.format(
+        results['import_ms'], args.runs)
+    print '  heavy modules loaded: {0}'.format(', '.join(loaded) or 'none')
+    if args.command:
+        print 'git-deploy {0}: {1:.1f} ms (median of {2})'.format(
+            args.command, results['command_ms'], args.runs)
+
+
+if __name__ == '__main__':
+    main()